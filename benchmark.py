@@ -0,0 +1,429 @@
+#!/usr/bin/python
+"""Benchmark individual stages of the pipeline on synthetic data."""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+from lib.aln_helpers import parse_alignment
+from lib.aln_helpers import summarize_genomes
+from lib.bench_helpers import throughput
+from lib.bench_helpers import measure_function
+from lib.bench_helpers import write_synthetic_fastq
+from lib.bench_helpers import make_synthetic_metadata
+from lib.bench_helpers import make_synthetic_abundances
+from lib.bench_helpers import write_synthetic_img_vr
+from lib.bench_helpers import write_synthetic_prefilter_data
+from lib.bench_helpers import write_synthetic_alignment
+from lib.fastq_helpers import count_fastq_reads
+from lib.fastq_helpers import clean_fastq_headers
+from lib.img_vr_helpers import index_img_vr
+from lib.exec_helpers import command_exists
+from lib.prefilter_helpers import Prefilter
+from lib.prefilter_helpers import build_prefilter
+from lib.prefilter_helpers import prefilter_fastq
+
+
+def synthetic_fastq(args, temp_folder):
+    """Path to the synthetic FASTQ, which is written the first time."""
+    fp = os.path.join(temp_folder, "synthetic.fastq")
+    if not os.path.exists(fp):
+        write_synthetic_fastq(fp, args.n_reads, read_len=args.read_len)
+    return fp
+
+
+def synthetic_alignment(args, temp_folder):
+    """Path to the synthetic alignments, which are written the first time."""
+    fp = os.path.join(temp_folder, "synthetic.aln")
+    if not os.path.exists(fp):
+        write_synthetic_alignment(
+            fp,
+            args.n_hits,
+            n_subjects=args.n_subjects,
+            skew=args.skew,
+        )
+    return fp
+
+
+def benchmark_clean_fastq_headers(args, temp_folder):
+    """Time clean_fastq_headers on a synthetic FASTQ file."""
+    fastq_fp = synthetic_fastq(args, temp_folder)
+    cleaned_fp = os.path.join(temp_folder, "cleaned.fastq")
+
+    read_stats, elapsed, memory = measure_function(
+        clean_fastq_headers, fastq_fp, cleaned_fp
+    )
+    assert read_stats["reads"] == args.n_reads
+    os.unlink(cleaned_fp)
+    return [throughput(
+        "clean_fastq_headers", args.n_reads, os.path.getsize(fastq_fp),
+        elapsed, memory, read_len=args.read_len,
+    )]
+
+
+def benchmark_count_fastq_reads(args, temp_folder):
+    """Time count_fastq_reads on a synthetic FASTQ file."""
+    fastq_fp = synthetic_fastq(args, temp_folder)
+
+    n_reads, elapsed, memory = measure_function(count_fastq_reads, fastq_fp)
+    assert n_reads == args.n_reads
+    return [throughput(
+        "count_fastq_reads", args.n_reads, os.path.getsize(fastq_fp),
+        elapsed, memory, read_len=args.read_len,
+    )]
+
+
+def benchmark_parse_alignment(args, temp_folder):
+    """Time parse_alignment on a synthetic BLAST6 file."""
+    align_fp = synthetic_alignment(args, temp_folder)
+
+    output, elapsed, memory = measure_function(parse_alignment, align_fp)
+    return [throughput(
+        "parse_alignment", args.n_hits, os.path.getsize(align_fp),
+        elapsed, memory, n_subjects=args.n_subjects, skew=args.skew,
+    )]
+
+
+def benchmark_parse_scaling(args, temp_folder):
+    """Time parse_alignment on a synthetic file with 1 to N workers."""
+    align_fp = synthetic_alignment(args, temp_folder)
+
+    results = []
+    workers = 1
+    while workers <= args.max_workers:
+        output, elapsed, memory = measure_function(
+            parse_alignment, align_fp, workers=workers
+        )
+        results.append(throughput(
+            "parse_alignment_{}_workers".format(workers),
+            args.n_hits, os.path.getsize(align_fp), elapsed, memory,
+            workers=workers, speedup=round(
+                results[0]["seconds"] / elapsed if len(results) > 0 else 1, 2
+            ),
+        ))
+        workers *= 2
+    return results
+
+
+def benchmark_summarize_genomes(args, temp_folder):
+    """Time summarize_genomes against a large synthetic metadata table."""
+    metadata = make_synthetic_metadata(args.n_proteins)
+    protein_abund = make_synthetic_abundances(metadata, args.n_detected)
+
+    output, elapsed, memory = measure_function(
+        summarize_genomes, protein_abund, metadata
+    )
+    return [throughput(
+        "summarize_genomes", args.n_proteins,
+        int(metadata.memory_usage(deep=True).sum()), elapsed, memory,
+        n_detected=args.n_detected,
+    )]
+
+
+def benchmark_index_img_vr(args, temp_folder):
+    """Time index_img_vr on synthetic IMG/VR metadata and proteins."""
+    metadata_fp = os.path.join(temp_folder, "img_vr.tsv")
+    faa_fp = os.path.join(temp_folder, "img_vr.faa.gz")
+    write_synthetic_img_vr(metadata_fp, faa_fp, args.n_img_vr_proteins)
+    prefix = os.path.join(temp_folder, "img_vr_index")
+
+    manifest, elapsed, memory = measure_function(
+        index_img_vr, metadata_fp, faa_fp, prefix,
+        chunk_size=args.img_vr_chunk_size
+    )
+    assert manifest["protein"].shape[0] == args.n_img_vr_proteins
+    return [throughput(
+        "index_img_vr", args.n_img_vr_proteins, os.path.getsize(faa_fp),
+        elapsed, memory, chunk_size=args.img_vr_chunk_size,
+    )]
+
+
+def fastq_names(fp):
+    """The name of every read in a FASTQ file."""
+    with open(fp, "rt") as f:
+        return [line[1:].split()[0] for ix, line in enumerate(f) if ix % 4 == 0]
+
+
+def diamond_aligned(db_fp, read_fp, threads):
+    """Align reads with DIAMOND, returning the reads aligned and the time."""
+    align_fp = read_fp + ".aln"
+    start = time.time()
+    subprocess.check_call([
+        "diamond", "blastx", "--query", read_fp, "--db", db_fp,
+        "--threads", str(threads), "--outfmt", "6", "qseqid",
+        "--max-target-seqs", "1", "--out", align_fp, "--quiet",
+    ])
+    elapsed = time.time() - start
+    with open(align_fp, "rt") as f:
+        aligned = set(line.rstrip("\n") for line in f)
+    os.unlink(align_fp)
+    return aligned, elapsed
+
+
+def benchmark_prefilter(args, temp_folder):
+    """
+    Time build_prefilter and prefilter_fastq on synthetic proteins and
+    reads (some translated back from the proteins with substitutions),
+    and report the fraction of each kind of read which is kept. If
+    DIAMOND is installed, also time the alignment of all of the reads
+    and of the reads which were kept.
+    """
+    fasta_fp = os.path.join(temp_folder, "prefilter_ref.fasta")
+    fastq_fp = os.path.join(temp_folder, "prefilter_reads.fastq")
+    write_synthetic_prefilter_data(
+        fasta_fp, fastq_fp, args.n_ref_proteins, args.n_prefilter_reads,
+        viral_fraction=args.viral_fraction, divergence=args.divergence,
+        read_len=args.read_len,
+    )
+    prefilter_fp = os.path.join(temp_folder, "prefilter_ref.prefilter")
+    kept_fp = os.path.join(temp_folder, "prefilter_kept.fastq")
+
+    results = []
+    output, elapsed, memory = measure_function(
+        build_prefilter, fasta_fp, prefilter_fp
+    )
+    results.append(throughput(
+        "build_prefilter", args.n_ref_proteins, os.path.getsize(fasta_fp),
+        elapsed, memory,
+    ))
+
+    prefilter = Prefilter(prefilter_fp)
+    counts, elapsed, memory = measure_function(
+        prefilter_fastq, fastq_fp, kept_fp, prefilter,
+        min_hits=args.prefilter_min_hits, threads=args.prefilter_threads,
+    )
+    prefilter_seconds = elapsed
+
+    # The reads translated back from the reference should all be kept
+    names = fastq_names(fastq_fp)
+    kept = set(fastq_names(kept_fp))
+    n_viral = sum(1 for n in names if n.startswith("viral-"))
+    n_viral_kept = sum(1 for n in kept if n.startswith("viral-"))
+    stats = {
+        "min_hits": args.prefilter_min_hits,
+        "threads": args.prefilter_threads,
+        "divergence": args.divergence,
+        "kept_fraction": round(counts["kept"] / float(counts["reads"]), 4),
+        "viral_kept": round(n_viral_kept / float(max(n_viral, 1)), 4),
+        "other_kept": round(
+            (counts["kept"] - n_viral_kept) /
+            float(max(counts["reads"] - n_viral, 1)), 4
+        ),
+        "fill": round(prefilter.attrs["fill"], 4),
+    }
+    logging.info(
+        "Prefilter kept {:.1%} of reads ({:.1%} of viral reads, {:.1%} of "
+        "other reads)".format(
+            stats["kept_fraction"], stats["viral_kept"], stats["other_kept"]
+        )
+    )
+
+    # Compare to the reads which DIAMOND aligns, if it is installed
+    if command_exists("diamond"):
+        db_fp = os.path.join(temp_folder, "prefilter_ref.dmnd")
+        subprocess.check_call([
+            "diamond", "makedb", "--in", fasta_fp, "--db", db_fp, "--quiet"
+        ])
+        aligned, full_seconds = diamond_aligned(
+            db_fp, fastq_fp, args.prefilter_threads
+        )
+        aligned_kept, kept_seconds = diamond_aligned(
+            db_fp, kept_fp, args.prefilter_threads
+        )
+        stats["diamond_aligned_kept"] = round(
+            len(aligned & kept) / float(max(len(aligned), 1)), 4
+        )
+        stats["diamond_speedup"] = round(
+            full_seconds / (kept_seconds + prefilter_seconds), 2
+        )
+        logging.info(
+            "DIAMOND aligned {:,} reads in {:.2f}s, and {:,} of the kept "
+            "reads in {:.2f}s ({:.2f}x faster including the prefilter)".format(
+                len(aligned), full_seconds, len(aligned_kept), kept_seconds,
+                stats["diamond_speedup"]
+            )
+        )
+    else:
+        # Alignment time is roughly proportional to the number of reads
+        stats["estimated_speedup"] = round(
+            counts["reads"] / float(max(counts["kept"], 1)), 2
+        )
+
+    results.append(throughput(
+        "prefilter_fastq", counts["reads"], os.path.getsize(fastq_fp),
+        prefilter_seconds, memory, **stats
+    ))
+    return results
+
+
+STAGES = {
+    "clean_fastq_headers": benchmark_clean_fastq_headers,
+    "count_fastq_reads": benchmark_count_fastq_reads,
+    "index_img_vr": benchmark_index_img_vr,
+    "parse_alignment": benchmark_parse_alignment,
+    "parse_scaling": benchmark_parse_scaling,
+    "prefilter": benchmark_prefilter,
+    "summarize_genomes": benchmark_summarize_genomes,
+}
+
+
+def current_commit():
+    """Return the git commit of this code, if available."""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).decode("utf-8").strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def compare_results(results, previous_fp):
+    """Log the change in time for each stage since a previous run."""
+    with open(previous_fp, "rt") as f:
+        previous = json.load(f)
+    before = {r["stage"]: r for r in previous["results"]}
+    logging.info("Compared to {} (commit {})".format(
+        previous_fp, previous.get("commit")
+    ))
+    for r in results:
+        if r["stage"] not in before:
+            continue
+        b = before[r["stage"]]
+        logging.info("{}: {:.2f}s -> {:.2f}s ({:.2f}x), peak {:,.1f} MB -> {:,.1f} MB".format(
+            r["stage"], b["seconds"], r["seconds"],
+            b["seconds"] / r["seconds"], b["peak_rss_mb"], r["peak_rss_mb"]
+        ))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="""
+    Benchmark stages of the pipeline on synthetic data.
+    """)
+
+    parser.add_argument("--stages",
+                        type=str,
+                        nargs="+",
+                        choices=sorted(STAGES.keys()),
+                        default=sorted(STAGES.keys()),
+                        help="Stages to benchmark.")
+    parser.add_argument("--n-reads",
+                        type=int,
+                        default=10000000,
+                        help="Number of synthetic reads.")
+    parser.add_argument("--read-len",
+                        type=int,
+                        default=150,
+                        help="Length of the synthetic reads.")
+    parser.add_argument("--n-hits",
+                        type=int,
+                        default=100000000,
+                        help="Number of synthetic alignments.")
+    parser.add_argument("--n-subjects",
+                        type=int,
+                        default=1000,
+                        help="Number of distinct reference proteins aligned.")
+    parser.add_argument("--skew",
+                        type=float,
+                        default=0,
+                        help="""Skew of the depth across proteins (0 for even
+                                depth, larger for a few abundant proteins).""")
+    parser.add_argument("--max-workers",
+                        type=int,
+                        default=16,
+                        help="Largest number of workers used parsing.")
+    parser.add_argument("--n-proteins",
+                        type=int,
+                        default=10000000,
+                        help="Number of proteins in the synthetic metadata.")
+    parser.add_argument("--n-detected",
+                        type=int,
+                        default=500,
+                        help="Number of proteins detected in the sample.")
+    parser.add_argument("--n-img-vr-proteins",
+                        type=int,
+                        default=1000000,
+                        help="Number of proteins in the synthetic IMG/VR data.")
+    parser.add_argument("--img-vr-chunk-size",
+                        type=int,
+                        default=1000000,
+                        help="Number of proteins indexed at a time from IMG/VR.")
+    parser.add_argument("--n-ref-proteins",
+                        type=int,
+                        default=20000,
+                        help="Number of reference proteins for the prefilter.")
+    parser.add_argument("--n-prefilter-reads",
+                        type=int,
+                        default=1000000,
+                        help="Number of synthetic reads to prefilter.")
+    parser.add_argument("--viral-fraction",
+                        type=float,
+                        default=0.1,
+                        help="""Fraction of the reads to prefilter which are
+                                translated back from a reference protein.""")
+    parser.add_argument("--divergence",
+                        type=float,
+                        default=0.2,
+                        help="""Fraction of the amino acids changed in each
+                                read translated back from the reference.""")
+    parser.add_argument("--prefilter-min-hits",
+                        type=int,
+                        default=1,
+                        help="Number of seeds a read must share with the reference.")
+    parser.add_argument("--prefilter-threads",
+                        type=int,
+                        default=1,
+                        help="Number of threads used to prefilter the reads.")
+    parser.add_argument("--temp-folder",
+                        type=str,
+                        default=None,
+                        help="Folder used for temporary files.")
+    parser.add_argument("--output",
+                        type=str,
+                        default=None,
+                        help="Save the results as JSON.")
+    parser.add_argument("--compare",
+                        type=str,
+                        default=None,
+                        help="Compare to the results saved from a previous run.")
+
+    args = parser.parse_args()
+
+    # Set up logging
+    logFormatter = logging.Formatter(
+        '%(asctime)s %(levelname)-8s [benchmark.py] %(message)s'
+    )
+    rootLogger = logging.getLogger()
+    rootLogger.setLevel(logging.INFO)
+    consoleHandler = logging.StreamHandler()
+    consoleHandler.setFormatter(logFormatter)
+    rootLogger.addHandler(consoleHandler)
+
+    results = []
+    temp_folder = tempfile.mkdtemp(dir=args.temp_folder)
+    try:
+        for stage in args.stages:
+            results.extend(STAGES[stage](args, temp_folder))
+    finally:
+        shutil.rmtree(temp_folder)
+
+    if args.output is not None:
+        with open(args.output, "wt") as fo:
+            json.dump({
+                "commit": current_commit(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": sys.version.split()[0],
+                "host": platform.node(),
+                "args": vars(args),
+                "results": results,
+            }, fo, indent=4, sort_keys=True)
+        logging.info("Wrote results to {}".format(args.output))
+
+    if args.compare is not None:
+        compare_results(results, args.compare)
@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 
 import os
-import gzip
+import sys
+import logging
 import argparse
-import pandas as pd
 from subprocess import call
-from Bio.SeqIO.FastaIO import SimpleFastaParser
+from lib.img_vr_helpers import index_img_vr
+from lib.manifest_helpers import file_hash
+from lib.manifest_helpers import write_diff
+from lib.manifest_helpers import read_manifest
+from lib.manifest_helpers import write_manifest
+from lib.manifest_helpers import diff_manifests
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="""
@@ -24,56 +29,69 @@ if __name__ == "__main__":
                         type=str,
                         required=True,
                         help="Prefix for output files.")
+    parser.add_argument("--rebuild",
+                        action="store_true",
+                        help="""Rebuild every output file, even if the inputs
+                                have not changed since the last build.""")
+
+    parser.add_argument("--chunk-size",
+                        type=int,
+                        default=1000000,
+                        help="""Number of proteins read and written at a time
+                                (more proteins use more memory).""")
 
     args = parser.parse_args()
 
+    # Set up logging
+    logFormatter = logging.Formatter(
+        '%(asctime)s %(levelname)-8s [index_img_vr.py] %(message)s'
+    )
+    rootLogger = logging.getLogger()
+    rootLogger.setLevel(logging.INFO)
+    consoleHandler = logging.StreamHandler()
+    consoleHandler.setFormatter(logFormatter)
+    rootLogger.addHandler(consoleHandler)
+
     assert os.path.exists(args.img_vr_metadata)
     assert os.path.exists(args.img_vr_proteins)
 
-    # Read in the metadata
-    print("Reading in " + args.img_vr_metadata)
-    metadata = pd.read_table(args.img_vr_metadata)
-    assert metadata.shape[0] == metadata["mVCs"].unique().shape[0]
-
-    # Keep track of all of the genome IDs with metadata
-    all_genome_ids = set(metadata["mVCs"].tolist())
-
-    # Index on the genome ID
-    metadata.set_index("mVCs", inplace=True)
-
-    # Read in each of the protein names and genome names from the FAA input file
-    proteins = []
-    print("Reading in " + args.img_vr_proteins)
-    with gzip.open(args.img_vr_proteins, "rt") as f:
-        ix = 0
-        for header, seq in SimpleFastaParser(f):
-            # Split the header by "_____"
-            genome_id = "_____".join(header.split("_____")[:2])
-            # Make sure we have metadata for this genome
-            assert genome_id in all_genome_ids, "No metadata for " + genome_id
-
-            # Add to the list
-            proteins.append({
-                "protein": header,
-                "length": len(seq),
-                "genome": genome_id
-            })
-            ix += 1
-            if ix % 100000 == 0:
-                print("Read in {:,} proteins".format(ix))
+    # Compare the inputs to those used for the last build
+    manifest_fp = args.output_prefix + ".manifest"
+    db_fp = args.output_prefix + ".dmnd"
+    inputs = [
+        [os.path.basename(fp), file_hash(fp)]
+        for fp in [args.img_vr_metadata, args.img_vr_proteins]
+    ]
+    old_manifest = None
+    if not args.rebuild and os.path.exists(manifest_fp):
+        old_manifest, old_attrs = read_manifest(manifest_fp)
+        if old_attrs["inputs"] == inputs and all(
+            os.path.exists(args.output_prefix + ending)
+            for ending in [".tsv", ".idx", ".dmnd"]
+        ):
+            logging.info("Input files are unchanged, database is up to date")
+            sys.exit(0)
 
-    # Format as a DataFrame
-    proteins = pd.DataFrame(proteins)
+    # Write the metadata for each protein, and the metadata index
+    manifest = index_img_vr(
+        args.img_vr_metadata,
+        args.img_vr_proteins,
+        args.output_prefix,
+        chunk_size=args.chunk_size,
+    )
 
-    # Now add the metadata from IMG/VR
-    for k in metadata.columns:
-        print("Adding metadata for " + k)
-        proteins[k] = proteins["genome"].apply(metadata[k].to_dict().get)
+    # Report the proteins which have changed since the last build
+    diff = diff_manifests(old_manifest, manifest)
+    write_diff(args.output_prefix + ".diff.json", diff)
 
-    proteins.to_csv(args.output_prefix + ".tsv", sep="\t", index=False)
+    # Now index the protein sequences with DIAMOND, if they have changed
+    if diff["sequences_changed"] or not os.path.exists(db_fp):
+        if os.path.exists(db_fp):
+            os.unlink(db_fp)
+        logging.info("Making DIAMOND database, writing to " + db_fp)
+        call(["diamond", "makedb", "--in", args.img_vr_proteins, "--db", db_fp])
+        assert os.path.exists(db_fp)
+    else:
+        logging.info("Protein sequences are unchanged, keeping " + db_fp)
 
-    # Now index the protein sequences with DIAMOND
-    db_fp = args.output_prefix + ".dmnd"
-    print("Making DIAMOND database, writing to " + db_fp)
-    call(["diamond", "makedb", "--in", args.img_vr_proteins, "--db", db_fp])
-    assert os.path.exists(db_fp)
+    write_manifest(manifest_fp, manifest, attrs={"inputs": inputs})
@@ -1,129 +1,1212 @@
 #!/usr/bin/python
 
+import io
+import os
 import logging
+import multiprocessing
 import numpy as np
 import pandas as pd
 from collections import defaultdict
 
 
+def _as_number(v):
+    """Return whole numbers as int, and fractional numbers as float."""
+    v = float(v)
+    return int(v) if v.is_integer() else v
+
+
 def summarize_genomes(protein_abund, metadata):
     """From a set of protein abundances, summarize the genomes."""
 
-    # Format the protein data as a DataFrame
-    protein_abund = pd.DataFrame(protein_abund).set_index("protein")
+    # Format the protein data as a DataFrame, using the protein
+    # lengths from the metadata
+    protein_abund = pd.DataFrame(protein_abund)
+    if protein_abund.shape[0] == 0:
+        return [], []
+    protein_abund = protein_abund.drop(
+        [k for k in ["length"] if k in protein_abund.columns], axis=1
+    ).set_index("protein")
+    protein_abund = protein_abund.loc[protein_abund["coverage"] > 0]
+    metrics = protein_abund.columns.tolist()
 
-    # Add the detected protein information to the metadata table
-    for k in [
-        "coverage", "depth", "pctid", "bitscore", "alen", "nreads"
-    ]:
-        metadata[k] = metadata["protein"].apply(
-            protein_abund[k].to_dict().get
-        ).fillna(0)
+    # Subset to the GENOMES that have _any_ proteins detected
+    detected_genomes = metadata.loc[
+        metadata["protein"].isin(protein_abund.index), "genome"
+    ].unique()
+    if len(detected_genomes) == 0:
+        return [], []
+    genome_proteins = metadata.loc[metadata["genome"].isin(detected_genomes)]
 
-    assert (metadata["length"] > 0).all()
+    # Group the proteins by genome, keeping the original order within each
+    genome_proteins = genome_proteins.sort_values(
+        by="genome", kind="mergesort"
+    )
 
-    # Subset to the GENOMES that have _any_ proteins detected
-    metadata = pd.concat([
-        genome_dat
-        for genome, genome_dat in metadata.groupby("genome")
-        if (genome_dat["coverage"] > 0).any()
-    ])
+    assert (genome_proteins["length"] > 0).all()
 
-    # Save the protein summary for these genomes
-    protein_abund = metadata.to_dict(orient="records")
+    # Add the detected protein information to the metadata for these genomes
+    genome_proteins = genome_proteins.drop(
+        [k for k in metrics if k in genome_proteins.columns], axis=1
+    ).merge(
+        protein_abund, left_on="protein", right_index=True, how="left"
+    )
+    genome_proteins[metrics] = genome_proteins[metrics].fillna(0)
 
-    # Now make a summary on a per-genome basis
-    genome_abund = []
-    # Iterate over all of the genomes
-    for genome, proteins in metadata.groupby("genome"):
+    # Save the protein summary for these genomes
+    protein_abund = genome_proteins.to_dict(orient="records")
 
-        # Calculate the aggregate genome length
-        agg_len = proteins["length"].sum()
+    # Now make a summary on a per-genome basis, calculating the aggregate
+    # length, number of proteins, and length-adjusted average of each metric
+    weighted = ["coverage", "depth", "pctid", "bitscore", "alen"]
+    agg = genome_proteins[["genome", "length", "nreads"]].copy()
+    agg["total_proteins"] = 1
+    agg["detected_proteins"] = (genome_proteins["coverage"] > 0).astype(int)
+    for k in weighted:
+        agg[k] = genome_proteins[k] * genome_proteins["length"]
+    agg = agg.groupby("genome", sort=True).sum()
 
-        # Calculate the aggregate coverage, depth, number of proteins, etc.
+    genome_abund = []
+    for genome, r in zip(agg.index.values, agg.to_dict(orient="records")):
         dat = {
-            "total_length": int(agg_len),
-            "total_proteins": proteins.shape[0],
-            "detected_proteins": (proteins["coverage"] > 0).sum(),
+            "total_length": int(r["length"]),
+            "total_proteins": int(r["total_proteins"]),
+            "detected_proteins": int(r["detected_proteins"]),
             "genome": genome,
-            "nreads": int(proteins["nreads"].sum()),
+            "nreads": _as_number(r["nreads"]),
         }
+        for k in weighted:
+            dat[k] = r[k] / r["length"]
+        genome_abund.append(dat)
 
-        for k in ["coverage", "depth", "pctid", "bitscore", "alen"]:
-            # Make a length-adjusted average
-            dat[k] = (proteins[k] * proteins["length"]).sum() / agg_len
+    return protein_abund, genome_abund
 
-        # For all of the other columns, add them if they are unique
-        for k in proteins.columns:
-            if k not in dat:
-                if len(proteins[k].unique()) == 0:
-                    dat[k] = proteins[k].values[0]
 
-        genome_abund.append(dat)
+# Columns written by exec_helpers.align_reads (--outfmt 6)
+ALIGNMENT_COLUMNS = [
+    "qseqid", "sseqid",
+    "pident", "length",
+    "qstart", "qend",
+    "sstart", "send",
+    "evalue", "bitscore",
+    "qlen", "slen",
+]
+ALIGNMENT_DTYPES = {
+    "qseqid": "category",
+    "sseqid": "category",
+    "pident": np.float32,
+    "length": np.int32,
+    "qstart": np.int32,
+    "qend": np.int32,
+    "sstart": np.int32,
+    "send": np.int32,
+    "evalue": np.float64,
+    "bitscore": np.float32,
+    "qlen": np.int32,
+    "slen": np.int32,
+}
 
-    return protein_abund, genome_abund
+
+def read_alignment_chunks(align_fp, chunksize=1000000, usecols=None):
+    """
+    Yield typed DataFrames with up to `chunksize` alignments each,
+    optionally with only a subset of the columns.
+    """
+    if usecols is None:
+        usecols = ALIGNMENT_COLUMNS
+    try:
+        for chunk in pd.read_csv(
+            align_fp,
+            sep="\t",
+            header=None,
+            names=ALIGNMENT_COLUMNS,
+            usecols=usecols,
+            dtype={k: ALIGNMENT_DTYPES[k] for k in usecols},
+            chunksize=chunksize,
+        ):
+            yield chunk
+    except pd.errors.EmptyDataError:
+        logging.info("No alignments found")
+
+
+def _grow(arr, n):
+    """Return a copy of `arr` with space for at least `n` elements."""
+    if arr.shape[0] >= n:
+        return arr
+    new_arr = np.zeros(max(n, 2 * arr.shape[0]), dtype=arr.dtype)
+    new_arr[:arr.shape[0]] = arr
+    return new_arr
+
+
+def encode_strings(values):
+    """Encode a list of strings as a fixed-width bytes array."""
+    if isinstance(values, np.ndarray) and values.dtype.kind in "SU":
+        return values if values.dtype.kind == "S" else np.char.encode(
+            values, "utf-8"
+        )
+    encoded = []
+    for v in values:
+        if not isinstance(v, (bytes, type(u""))):
+            v = str(v)
+        if not isinstance(v, bytes):
+            v = v.encode("utf-8")
+        encoded.append(v)
+    return np.array(encoded, dtype=bytes)
+
+
+class SubjectVocabulary(object):
+    """
+    Dense integer index for subject names. Names can be provided up front
+    (e.g. from the metadata) as a sorted bytes array, and any other names
+    are added to the end as they are seen.
+    """
+
+    def __init__(self, sorted_names=None):
+        if sorted_names is None:
+            sorted_names = np.zeros(0, dtype="S1")
+        self.sorted_names = sorted_names
+        self.extra_ix = {}
+        self.extra_names = []
+
+    def __len__(self):
+        return self.sorted_names.shape[0] + len(self.extra_names)
+
+    def lookup(self, names):
+        """Return the index of each name (bytes array), adding new ones."""
+        names = encode_strings(names)
+        n_sorted = self.sorted_names.shape[0]
+        if n_sorted > 0:
+            pos = np.searchsorted(self.sorted_names, names)
+            pos = np.minimum(pos, n_sorted - 1)
+            found = self.sorted_names[pos] == names
+        else:
+            pos = np.zeros(names.shape[0], dtype=np.int64)
+            found = np.zeros(names.shape[0], dtype=bool)
+
+        ix = pos.astype(np.int64)
+        for i in np.flatnonzero(~found):
+            name = names[i]
+            if name not in self.extra_ix:
+                self.extra_ix[name] = n_sorted + len(self.extra_names)
+                self.extra_names.append(name)
+            ix[i] = self.extra_ix[name]
+        return ix
+
+    def name(self, ix):
+        """Return the name for an index, as a string."""
+        return self._name(ix).decode("utf-8")
+
+    def names(self, ix):
+        """Return the name for each index, as a bytes array."""
+        return np.array([self._name(i) for i in ix], dtype=bytes)
+
+    def _name(self, ix):
+        n_sorted = self.sorted_names.shape[0]
+        if ix < n_sorted:
+            return self.sorted_names[ix]
+        return self.extra_names[ix - n_sorted]
+
+
+# Initial range and number of bins of the histogram kept for each
+# statistic. The range of a subject's histogram is doubled (merging pairs
+# of bins) whenever it has a value above the top of the range.
+HISTOGRAM_BINS = {
+    "pctid": (0., 100., 200),
+    "alen": (0., 200., 200),
+    "bitscore": (0., 200., 200),
+}
+
+
+class SubjectMoments(object):
+    """
+    Running count, sum and sum of squares of a value for each subject,
+    with an optional fixed-width histogram for quantiles. Values are
+    stored in fixed point, so that partial results can be merged exactly
+    in any order.
+
+    Each histogram starts out covering the range given in bins, and is
+    doubled in range as often as needed to hold the largest value seen
+    for that subject. Since a doubled histogram is the same as binning
+    every value at twice the width, this doesn't depend on the order in
+    which values are added or merged.
+    """
+
+    def __init__(self, scale=100, bins=None):
+        self.scale = scale
+        self.count = np.zeros(0, dtype=np.int64)
+        self.total = np.zeros(0, dtype=np.int64)
+        self.total_sq = np.zeros(0, dtype=np.int64)
+
+        # Histograms are only allocated for subjects with values
+        self.bins = bins
+        if bins is not None:
+            self.slot = np.zeros(0, dtype=np.int64)
+            self.hist = np.zeros((0, bins[2]), dtype=np.uint32)
+            self.doublings = np.zeros(0, dtype=np.int64)
+            self.slots_used = 0
+
+    def grow(self, n):
+        """Make space for at least n subjects."""
+        old_n = self.count.shape[0]
+        if n <= old_n:
+            return
+        self.count = _grow(self.count, n)
+        self.total = _grow(self.total, n)
+        self.total_sq = _grow(self.total_sq, n)
+        if self.bins is not None:
+            self.slot = _grow(self.slot, n)
+            self.slot[old_n:] = -1
+
+    def _add_slots(self, ix):
+        """Allocate a histogram for any subjects which lack one."""
+        new = np.unique(ix)
+        new = new[self.slot[new] < 0]
+        if new.shape[0] == 0:
+            return
+        self.slot[new] = self.slots_used + np.arange(new.shape[0])
+        self.slots_used += new.shape[0]
+        if self.slots_used > self.hist.shape[0]:
+            hist = np.zeros(
+                (max(self.slots_used, 2 * self.hist.shape[0]), self.bins[2]),
+                dtype=np.uint32
+            )
+            hist[:self.hist.shape[0]] = self.hist
+            self.hist = hist
+            self.doublings = _grow(self.doublings, hist.shape[0])
+
+    def _widen(self, slots, doublings):
+        """Double the range of histograms until they reach the doublings."""
+        n_bins = self.bins[2]
+        while True:
+            narrow = self.doublings[slots] < doublings
+            if not narrow.any():
+                return
+            slots, doublings = slots[narrow], doublings[narrow]
+            merged = self.hist[slots].reshape(-1, n_bins // 2, 2).sum(axis=2)
+            self.hist[slots] = 0
+            self.hist[slots, :n_bins // 2] = merged
+            self.doublings[slots] += 1
+
+    def _bin_width(self, slots):
+        lo, hi, n_bins = self.bins
+        return (hi - lo) / n_bins * np.ldexp(1., self.doublings[slots])
+
+    def add(self, ix, values):
+        """Add a value for each subject index."""
+        if ix.shape[0] == 0:
+            return
+        n = ix.max() + 1
+        self.grow(n)
+
+        # Sum in integers, so that the result doesn't depend on the order
+        scaled = np.round(
+            values.astype(np.float64) * self.scale
+        ).astype(np.int64)
+        self.count[:n] += np.bincount(ix, minlength=n)
+        self.total[:n] += _int_bincount(ix, scaled, n)
+        self.total_sq[:n] += _int_bincount(ix, scaled * scaled, n)
+
+        if self.bins is not None:
+            self._add_slots(ix)
+            lo, hi, n_bins = self.bins
+            values = values.astype(np.float64)
+            slots = self.slot[ix]
+
+            # Widen the histograms of any subjects with values past the top
+            over = values > hi
+            if over.any():
+                need = np.ceil(
+                    np.log2((values[over] - lo) / (hi - lo))
+                ).astype(np.int64)
+                order = np.lexsort((need, slots[over]))
+                widen, last = np.unique(
+                    slots[over][order][::-1], return_index=True
+                )
+                self._widen(widen, need[order][::-1][last])
+
+            b = np.floor((values - lo) / self._bin_width(slots)).astype(np.int64)
+            b = np.clip(b, 0, n_bins - 1)
+            pos, n = np.unique(slots * n_bins + b, return_counts=True)
+            flat = self.hist.reshape(-1)
+            flat[pos] += n.astype(np.uint32)
+
+    def merge(self, other, ix=None):
+        """
+        Add the totals from another set of moments, optionally mapping
+        its subjects to a different index.
+        """
+        n = other.count.shape[0]
+        if ix is None:
+            ix = np.arange(n)
+        ix = ix[:n]
+        if ix.shape[0] == 0:
+            return
+        self.grow(ix.max() + 1)
+        self.count[ix] += other.count[:n]
+        self.total[ix] += other.total[:n]
+        self.total_sq[ix] += other.total_sq[:n]
+
+        if self.bins is not None and other.bins is not None:
+            has_hist = other.slot[:n] >= 0
+            self._add_slots(ix[has_hist])
+            slots = self.slot[ix[has_hist]]
+            other_slots = other.slot[:n][has_hist]
+
+            # Bring both sets of histograms to the wider of the two ranges
+            other = other._copy_hist(other_slots)
+            other_slots = np.arange(other_slots.shape[0])
+            self._widen(slots, other.doublings)
+            other._widen(other_slots, self.doublings[slots])
+            self.hist[slots] += other.hist
+
+    def _copy_hist(self, slots):
+        """Return the histograms for a set of slots, as a new object."""
+        copy = SubjectMoments(scale=self.scale, bins=self.bins)
+        copy.hist = self.hist[slots].copy()
+        copy.doublings = self.doublings[slots].copy()
+        return copy
+
+    def to_arrays(self, ix, prefix):
+        """Return the totals for a set of subjects as a dict of arrays."""
+        arrays = {
+            prefix + "_count": self.count[ix],
+            prefix + "_total": self.total[ix],
+            prefix + "_total_sq": self.total_sq[ix],
+        }
+        if self.bins is not None:
+            arrays[prefix + "_hist"] = self.hist[self.slot[ix]]
+            arrays[prefix + "_doublings"] = self.doublings[self.slot[ix]]
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix, scale=100, bins=None):
+        """Read the totals written by to_arrays."""
+        if prefix + "_hist" not in arrays:
+            bins = None
+        moments = cls(scale=scale, bins=bins)
+        moments.count = np.array(arrays[prefix + "_count"], dtype=np.int64)
+        moments.total = np.array(arrays[prefix + "_total"], dtype=np.int64)
+        moments.total_sq = np.array(
+            arrays[prefix + "_total_sq"], dtype=np.int64
+        )
+        if bins is not None:
+            moments.hist = np.array(arrays[prefix + "_hist"], dtype=np.uint32)
+            moments.slots_used = moments.count.shape[0]
+            moments.slot = np.arange(moments.slots_used)
+            moments.doublings = np.zeros(moments.slots_used, dtype=np.int64)
+            if prefix + "_doublings" in arrays:
+                moments.doublings[:] = arrays[prefix + "_doublings"]
+        return moments
+
+    def mean(self, ix):
+        return self.total[ix] / float(self.scale) / self.count[ix]
+
+    def var(self, ix):
+        """Population variance."""
+        n = self.count[ix].astype(np.float64)
+        mean = self.total[ix] / n
+        var = self.total_sq[ix] / n - mean * mean
+        return np.maximum(var, 0) / (self.scale * self.scale)
+
+    def quantile(self, ix, q):
+        """Approximate quantile, interpolated within the histogram bins."""
+        lo, hi, n_bins = self.bins
+        width = self._bin_width(self.slot[ix])
+        hist = self.hist[self.slot[ix]].astype(np.float64)
+        cumulative = np.cumsum(hist, axis=1)
+        target = q * cumulative[:, -1]
+        b = np.array([
+            np.searchsorted(row, t) for row, t in zip(cumulative, target)
+        ])
+        b = np.minimum(b, n_bins - 1)
+        rows = np.arange(b.shape[0])
+        below = np.where(b > 0, cumulative[rows, np.maximum(b - 1, 0)], 0)
+        frac = (target - below) / np.maximum(hist[rows, b], 1)
+        return lo + (b + frac) * width
+
+
+def _int_bincount(ix, values, n):
+    """
+    Exact sum of int64 values for each index. The values are split into
+    high and low bits, so that neither half loses precision when summed
+    as a float by bincount.
+    """
+    low = values & 0xFFFFF
+    high = values >> 20
+    return (
+        np.bincount(ix, weights=low, minlength=n).astype(np.int64) +
+        (np.bincount(ix, weights=high, minlength=n).astype(np.int64) << 20)
+    )
+
+
+def _segment_positions(starts, lengths):
+    """Position of every element of a set of segments in a flat buffer."""
+    ends = np.cumsum(lengths)
+    return np.arange(int(lengths.sum())) + np.repeat(starts - ends + lengths, lengths)
+
+
+class AlignmentAccumulator(object):
+    """
+    Accumulate per-subject coverage and alignment statistics. Each subject
+    is given a slot (numbered in the order first seen) when it first has
+    an alignment, and every per-subject array is indexed by slot, so that
+    memory scales with the subjects detected rather than the vocabulary.
+    """
+
+    def __init__(self, vocabulary=None, quantiles=False):
+        # Integer index for each subject name
+        if vocabulary is None:
+            vocabulary = SubjectVocabulary()
+        self.vocabulary = vocabulary
+
+        # Vocabulary index of the subject in each slot, and the same
+        # indices sorted (with their slots) to look up the slot for each
+        self.n_subjects = 0
+        self.slot_subject = np.zeros(0, dtype=np.int64)
+        self.sorted_subjects = np.zeros(0, dtype=np.int64)
+        self.sorted_slots = np.zeros(0, dtype=np.int64)
+
+        # Each subject has a difference array (one longer than the
+        # subject) stored at an offset within a single flat buffer,
+        # which is allocated when the subject is first seen
+        self.subject_len = np.zeros(0, dtype=np.int64)
+        self.offsets = np.zeros(0, dtype=np.int64)
+        self.events = np.zeros(1024 * 1024, dtype=np.int64)
+        self.events_used = 0
+
+        # Running statistics for each subject
+        self.quantiles = quantiles
+        self.stats = {
+            k: SubjectMoments(
+                bins=HISTOGRAM_BINS[k] if quantiles else None
+            )
+            for k in ["pctid", "alen", "bitscore"]
+        }
+
+    def _slots(self, ix):
+        """Return the slot for each vocabulary index (-1 if not seen)."""
+        ix = np.asarray(ix, dtype=np.int64)
+        if self.n_subjects == 0:
+            return np.zeros(ix.shape[0], dtype=np.int64) - 1
+        pos = np.minimum(
+            np.searchsorted(self.sorted_subjects, ix), self.n_subjects - 1
+        )
+        return np.where(
+            self.sorted_subjects[pos] == ix, self.sorted_slots[pos], -1
+        )
+
+    def __contains__(self, subject):
+        return self._slots(self.vocabulary.lookup([subject]))[0] >= 0
+
+    def __len__(self):
+        return self.n_subjects
+
+    def names(self, slots):
+        """Return the name of the subject in each slot, as a bytes array."""
+        return self.vocabulary.names(self.slot_subject[slots])
+
+    def index_subjects(self, subjects, slen):
+        """
+        Return the slot for each subject, allocating space for any which
+        have not been seen before.
+        """
+        ix = self.vocabulary.lookup(subjects)
+        slots = self._slots(ix)
+
+        # Allocate slots for the new subjects (in the order given)
+        new_ix, first = np.unique(ix[slots < 0], return_index=True)
+        if new_ix.shape[0] > 0:
+            order = np.argsort(first)
+            new_ix, first = new_ix[order], np.flatnonzero(slots < 0)[first[order]]
+            new_len = np.asarray(slen, dtype=np.int64)[first]
+            n_new = new_ix.shape[0]
+            old_n, n = self.n_subjects, self.n_subjects + n_new
+            new_slots = np.arange(old_n, n)
+
+            self.slot_subject = _grow(self.slot_subject, n)
+            self.slot_subject[old_n:n] = new_ix
+            self.subject_len = _grow(self.subject_len, n)
+            self.subject_len[old_n:n] = new_len
+            self.offsets = _grow(self.offsets, n)
+            self.offsets[old_n:n] = self.events_used + np.concatenate([
+                [0], np.cumsum(new_len + 1)[:-1]
+            ])
+            self.events_used += int((new_len + 1).sum())
+            self.events = _grow(self.events, self.events_used)
+            for k in self.stats:
+                self.stats[k].grow(n)
+
+            # Keep the lookup from vocabulary index to slot sorted
+            sorted_subjects = np.concatenate([self.sorted_subjects, new_ix])
+            sorted_slots = np.concatenate([self.sorted_slots, new_slots])
+            order = np.argsort(sorted_subjects, kind="mergesort")
+            self.sorted_subjects = sorted_subjects[order]
+            self.sorted_slots = sorted_slots[order]
+            self.n_subjects = n
+
+            slots = self._slots(ix)
+        return slots
+
+    def add_subject(self, subject, slen):
+        """Allocate space for a new subject, returning its slot."""
+        return self.index_subjects([subject], [slen])[0]
+
+    def add(self, subject, sstart, send):
+        """Add a single alignment (1-based, inclusive coordinates)."""
+        slot = self._slots(self.vocabulary.lookup([subject]))
+        assert slot[0] >= 0, "Unknown subject: {}".format(subject)
+        self.add_many(slot, np.array([sstart]), np.array([send]))
+
+    def add_many(self, ix, sstart, send):
+        """Add the coverage events for a set of alignments (by slot)."""
+        # Hits on the reverse strand are reported with sstart > send.
+        # Both ends are kept within the subject, so that a hit past its end
+        # (e.g. from a mismatched database) can't reach the next subject.
+        subject_len = self.subject_len[ix]
+        start = np.clip(np.minimum(sstart, send) - 1, 0, subject_len)
+        end = np.clip(np.maximum(sstart, send), start, subject_len)
+
+        for pos, val in [(start, 1), (end, -1)]:
+            pos, n = np.unique(self.offsets[ix] + pos, return_counts=True)
+            self.events[pos] += val * n
+
+    def add_chunk(self, chunk):
+        """
+        Add a DataFrame of alignments from read_alignment_chunks,
+        returning the slot of the subject for each alignment.
+        """
+        if chunk.shape[0] == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        # Map the subjects in this chunk to their index, giving any new
+        # subjects slots in the order they first appear
+        codes = chunk["sseqid"].cat.codes.values
+        cats, first = np.unique(codes, return_index=True)
+        order = np.argsort(first)
+        cats, first = cats[order], first[order]
+        cat_ix = np.zeros(len(chunk["sseqid"].cat.categories), dtype=np.int64)
+        cat_ix[cats] = self.index_subjects(
+            chunk["sseqid"].cat.categories[cats],
+            chunk["slen"].values[first]
+        )
+        ix = cat_ix[codes]
+
+        self.add_many(ix, chunk["sstart"].values, chunk["send"].values)
+
+        for k, col in [
+            ("pctid", "pident"), ("alen", "length"), ("bitscore", "bitscore")
+        ]:
+            self.stats[k].add(ix, chunk[col].values)
+
+        return ix
+
+    def to_arrays(self):
+        """
+        Return the state for every subject with alignments as a dict of
+        arrays, which can be merged into another accumulator.
+        """
+        detected = self.detected()
+        subject_len = self.subject_len[detected]
+        pos = _segment_positions(self.offsets[detected], subject_len + 1)
+        arrays = {
+            "subject": self.names(detected),
+            "subject_len": subject_len,
+            "events": self.events[pos],
+        }
+        for k, moments in self.stats.items():
+            arrays.update(moments.to_arrays(detected, k))
+        return arrays
+
+    def merge_arrays(self, arrays):
+        """
+        Add the state from to_arrays (e.g. for another part of the same
+        alignments), returning the slot of each of its subjects.
+        """
+        msg = "Cannot merge results with and without quantiles"
+        assert ("pctid_hist" in arrays) == self.quantiles, msg
+
+        subject_len = np.asarray(arrays["subject_len"], dtype=np.int64)
+        ix = self.index_subjects(arrays["subject"], subject_len)
+        msg = "Subject lengths do not match"
+        assert (self.subject_len[ix] == subject_len).all(), msg
+
+        pos = _segment_positions(self.offsets[ix], subject_len + 1)
+        self.events[pos] += arrays["events"]
+        for k, moments in self.stats.items():
+            moments.merge(
+                SubjectMoments.from_arrays(
+                    arrays, k, scale=moments.scale, bins=moments.bins
+                ),
+                ix
+            )
+        return ix
+
+    def depth(self, subject):
+        """Return the depth at every position of a subject."""
+        slot = self._slots(self.vocabulary.lookup([subject]))[0]
+        start = self.offsets[slot]
+        return np.cumsum(self.events[start:start + self.subject_len[slot]])
+
+    def detected(self):
+        """Slot of every subject with alignments (in the order first seen)."""
+        return np.arange(self.n_subjects)
+
+    def summarize(self):
+        """
+        Return the coverage, depth and mean statistics per subject, as a
+        list (in the order first seen) and the slot of each subject.
+        """
+        detected = self.detected()
+        if detected.shape[0] == 0:
+            return [], detected
+
+        # Every difference array sums to zero, so a single cumsum over the
+        # flat buffer gives the depth at each position of every subject
+        depth = np.cumsum(self.events[:self.events_used])
+        offsets = self.offsets[detected]
+        depth_sum = np.add.reduceat(depth, offsets)
+        covered = np.add.reduceat(depth > 0, offsets)
+        subject_len = self.subject_len[detected]
+        nreads = self.stats["pctid"].count[detected]
+
+        # Mean and variance (plus the median, if a histogram was kept)
+        stats = {}
+        for k, moments in self.stats.items():
+            stats[k] = moments.mean(detected)
+            stats[k + "_var"] = moments.var(detected)
+            if self.quantiles:
+                stats[k + "_median"] = moments.quantile(detected, 0.5)
+
+        output = []
+        names = self.names(detected)
+        for i, ix in enumerate(detected):
+            r = {
+                "protein": names[i].decode("utf-8"),
+                "coverage": float(covered[i]) / subject_len[i],
+                "depth": float(depth_sum[i]) / subject_len[i],
+                "nreads": int(nreads[i]),
+                "length": int(subject_len[i]),
+            }
+            for k, v in stats.items():
+                r[k] = float(v[i])
+            output.append(r)
+        return output, detected
+
+
+def _unique_rows(rows, counts):
+    """
+    Combine the counts for identical rows of a 2D array of subject
+    indices, returning the distinct rows in sorted order.
+    """
+    if rows.shape[0] == 0:
+        return rows, counts
+
+    # Sort by a single key for each row where the subjects fit in 63 bits
+    # (the same order as sorting by each column in turn)
+    base = int(rows.max()) + 1
+    if base ** rows.shape[1] < 2 ** 63:
+        key = np.zeros(rows.shape[0], dtype=np.int64)
+        for col in range(rows.shape[1]):
+            key = key * base + rows[:, col]
+        order = np.argsort(key)
+    else:
+        order = np.lexsort(rows.T[::-1])
+    rows, counts = rows[order], counts[order]
+    starts = np.flatnonzero(np.concatenate([
+        [True], (rows[1:] != rows[:-1]).any(axis=1)
+    ]))
+    return rows[starts], np.add.reduceat(counts, starts)
+
+
+def _csr_rows(indptr, indices):
+    """
+    Split a CSR matrix into a 2D array of column indices for the rows
+    of each length, yielding (length, row numbers, columns).
+    """
+    lengths = np.diff(indptr)
+    for length in np.unique(lengths):
+        rows = np.flatnonzero(lengths == length)
+        yield length, rows, indices[indptr[rows][:, None] + np.arange(length)]
+
+
+class ReadAssigner(object):
+    """
+    Assign reads which align to more than one subject. Reads are grouped by
+    the set of subjects they align to, so that memory scales with the number
+    of distinct sets rather than the number of reads. The sets with the
+    same number of subjects are kept as the rows of a 2D array, with the
+    number of reads for each.
+    """
+
+    def __init__(self, method="em", max_iter=1000, tol=1e-8):
+        assert method in ["em", "best"], "Unknown method: {}".format(method)
+        self.method = method
+        self.max_iter = max_iter
+        self.tol = tol
+
+        # Number of reads aligning to only a single subject
+        self.unique = np.zeros(1024, dtype=np.float64)
+        # Distinct sets of subjects (and the number of reads aligning to
+        # each) by the number of subjects in the set. Sets added since
+        # the last time they were combined are kept separately.
+        self.classes = {}
+        self.pending = defaultdict(list)
+        self.n_pending = defaultdict(int)
+        # Alignments for the last read in a chunk, which may continue
+        self.carry = None
+
+    def add(self, read, ix, bitscore, first_read, last_read):
+        """
+        Add alignments (grouped by read) with an integer code for each
+        read and the index of each subject. The names of the first and last
+        read are used to join reads which are split across chunks.
+        """
+        if read.shape[0] == 0:
+            return
+        read = read.astype(np.int64)
+        if self.carry is not None:
+            carry_read, carry_ix, carry_bitscore, carry_name = self.carry
+            # Codes are not shared between chunks, so give the carried read
+            # either the same code as the first read, or a distinct one
+            if carry_name == first_read:
+                carry_read = np.zeros_like(carry_read) + read[0]
+            else:
+                carry_read = np.zeros_like(carry_read) - 1
+            read = np.concatenate([carry_read, read])
+            ix = np.concatenate([carry_ix, ix])
+            bitscore = np.concatenate([carry_bitscore, bitscore])
+
+        # The last read may have more alignments in the next chunk
+        last = np.flatnonzero(read != read[-1])
+        last = 0 if last.shape[0] == 0 else last[-1] + 1
+        self.carry = (read[last:], ix[last:], bitscore[last:], last_read)
+        self._add_reads(read[:last], ix[:last], bitscore[:last])
+
+    def finish(self):
+        """Add the alignments for the final read."""
+        if self.carry is not None:
+            self._add_reads(*self.carry[:3])
+            self.carry = None
+
+    def _add_reads(self, read, ix, bitscore):
+        if read.shape[0] == 0:
+            return
+
+        # Number each read
+        read_start = np.concatenate([[True], read[1:] != read[:-1]])
+        read_ix = np.cumsum(read_start) - 1
+
+        # Only keep the alignments with the top score for each read
+        if self.method == "best":
+            best = np.maximum.reduceat(bitscore, np.flatnonzero(read_start))
+            keep = bitscore == best[read_ix]
+            read_ix, ix = read_ix[keep], ix[keep]
+
+        # Get the unique set of subjects for each read
+        order = np.lexsort((ix, read_ix))
+        read_ix, ix = read_ix[order], ix[order].astype(np.int64)
+        keep = np.concatenate([
+            [True], (read_ix[1:] != read_ix[:-1]) | (ix[1:] != ix[:-1])
+        ])
+        read_ix, ix = read_ix[keep], ix[keep]
+
+        nsubjects = np.bincount(read_ix)[read_ix]
+        n = ix.max() + 1
+        self.unique = _grow(self.unique, n)
+        self.unique[:n] += np.bincount(ix[nsubjects == 1], minlength=n)
+
+        # Reads aligning to several subjects, as a read x subject CSR matrix
+        multi = nsubjects > 1
+        if multi.any():
+            read_ix, ix = read_ix[multi], ix[multi]
+            indptr = np.flatnonzero(np.concatenate([
+                [True], read_ix[1:] != read_ix[:-1], [True]
+            ]))
+            for length, rows, members in _csr_rows(indptr, ix):
+                self._add_classes(
+                    members, np.ones(rows.shape[0], dtype=np.int64)
+                )
+
+    def _add_classes(self, members, counts):
+        """Add the number of reads for sets of subjects (sorted rows)."""
+        length = members.shape[1]
+        members, counts = _unique_rows(members, counts)
+        self.pending[length].append((members, counts))
+        self.n_pending[length] += members.shape[0]
+
+        # Combine the sets once there are as many new ones as old ones,
+        # so that each set is only combined a few times
+        if length not in self.classes or \
+                self.n_pending[length] >= self.classes[length][0].shape[0]:
+            self._combine(length)
+
+    def _combine(self, length):
+        """Combine the new sets of subjects with the existing ones."""
+        parts = self.pending.pop(length, [])
+        self.n_pending.pop(length, None)
+        if length in self.classes:
+            parts = [self.classes[length]] + parts
+        if len(parts) == 0:
+            return
+        self.classes[length] = _unique_rows(
+            np.concatenate([members for members, counts in parts]),
+            np.concatenate([counts for members, counts in parts]),
+        )
+
+    def class_matrix(self):
+        """
+        Return every set of subjects as a CSR matrix (indptr, indices),
+        and the number of reads for each, in a consistent order.
+        """
+        for length in list(self.pending.keys()):
+            self._combine(length)
+        lengths = sorted(self.classes.keys())
+        members = [self.classes[k][0] for k in lengths]
+        counts = [self.classes[k][1] for k in lengths]
+        row_lengths = np.repeat(
+            np.array(lengths, dtype=np.int64),
+            [m.shape[0] for m in members]
+        ).astype(np.int64)
+        return (
+            np.concatenate([[0], np.cumsum(row_lengths)]).astype(np.int64),
+            np.concatenate(
+                [m.reshape(-1) for m in members] + [np.zeros(0, dtype=np.int64)]
+            ),
+            np.concatenate(counts + [np.zeros(0, dtype=np.int64)]),
+        )
+
+    def to_arrays(self, subjects):
+        """
+        Return the reads for a set of subjects (every subject with
+        alignments) as a dict of arrays, which can be merged into another
+        ReadAssigner. Each set of subjects refers to positions in `subjects`.
+        """
+        assert self.carry is None, "Call finish() before saving the reads"
+        n = self.unique.shape[0]
+        if subjects.shape[0] > 0:
+            n = max(n, int(subjects.max()) + 1)
+        position = np.zeros(n, dtype=np.int64) - 1
+        position[subjects] = np.arange(subjects.shape[0])
+
+        indptr, indices, counts = self.class_matrix()
+        return {
+            "unique": _grow(self.unique, n)[subjects],
+            "class_indptr": indptr,
+            "class_subjects": position[indices],
+            "class_count": counts,
+        }
+
+    def merge_arrays(self, arrays, ix):
+        """Add the reads from to_arrays, with the index of each subject."""
+        if ix.shape[0] == 0:
+            return
+        self.unique = _grow(self.unique, ix.max() + 1)
+        self.unique[ix] += arrays["unique"]
+
+        indptr = np.asarray(arrays["class_indptr"], dtype=np.int64)
+        subjects = ix[arrays["class_subjects"]].astype(np.int64)
+        counts = np.asarray(arrays["class_count"], dtype=np.int64)
+        for length, rows, members in _csr_rows(indptr, subjects):
+            self._add_classes(np.sort(members, axis=1), counts[rows])
+
+    def assign(self, n_subjects):
+        """Return the number of reads assigned to each subject."""
+        unique = np.zeros(n_subjects, dtype=np.float64)
+        n = min(n_subjects, self.unique.shape[0])
+        unique[:n] = self.unique[:n]
+        indptr, indices, counts = self.class_matrix()
+        if counts.shape[0] == 0:
+            return unique
+
+        # Only the subjects in a set with other subjects can change, so
+        # number them from 0 for the iterations
+        subjects, indices = np.unique(indices, return_inverse=True)
+        n_used = subjects.shape[0]
+        counts = counts.astype(np.float64)
+        lengths = np.diff(indptr)
+        row = np.repeat(np.arange(counts.shape[0]), lengths)
+
+        # Start by splitting each read evenly across its subjects
+        expected = unique[subjects] + np.bincount(
+            indices, weights=(counts / lengths)[row], minlength=n_used
+        )
+        if self.method == "em":
+            expected = self._em(
+                unique[subjects], expected, indptr, indices, counts, row,
+                unique.sum() + counts.sum()
+            )
+
+        unique[subjects] = expected
+        return unique
+
+    def _em(self, unique, expected, indptr, indices, counts, row, total):
+        """Expectation-maximization of the abundance of each subject."""
+        n_used = expected.shape[0]
+        for iteration in range(self.max_iter):
+            theta = expected / total
+            weight = theta[indices]
+            norm = np.add.reduceat(weight, indptr[:-1])
+            new_expected = unique + np.bincount(
+                indices,
+                weights=weight / norm[row] * counts[row],
+                minlength=n_used
+            )
+            delta = np.abs(new_expected - expected).max()
+            expected = new_expected
+            if delta < self.tol * total:
+                break
+        logging.info("EM finished after {:,} iterations".format(iteration + 1))
+        return expected
+
+
+def partial_arrays(acc, assigner=None):
+    """
+    Return the results for part of the alignments (before they are
+    summarized) as a dict of arrays.
+    """
+    arrays = acc.to_arrays()
+    if assigner is not None:
+        for k, v in assigner.to_arrays(acc.detected()).items():
+            arrays["reads_" + k] = v
+    return arrays
+
+
+def merge_partial_arrays(arrays, acc, assigner=None):
+    """Add the results from partial_arrays to an accumulator."""
+    ix = acc.merge_arrays(arrays)
+    if assigner is not None:
+        assert "reads_unique" in arrays, "Partial results do not include reads"
+        assigner.merge_arrays({
+            k[len("reads_"):]: arrays[k]
+            for k in arrays.keys()
+            if k.startswith("reads_")
+        }, ix)
+
+
+class FileRange(io.RawIOBase):
+    """Read the bytes of a file between two offsets."""
+
+    def __init__(self, fp, start, end):
+        self.handle = open(fp, "rb")
+        self.handle.seek(start)
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.handle.read(min(len(b), self.remaining))
+        b[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.handle.close()
+        super(FileRange, self).close()
+
+
+def shard_offsets(align_fp, n_shards, group_reads=False):
+    """
+    Split a file into byte ranges of roughly equal size, each starting at
+    the beginning of a line. With group_reads=True, the alignments for each
+    read (on consecutive lines) are kept in the same range.
+    """
+    size = os.path.getsize(align_fp)
+    offsets = [0]
+    with open(align_fp, "rb") as f:
+        for i in range(1, n_shards):
+            start = max(size * i // n_shards, offsets[-1])
+            if start >= size:
+                break
+            # Move to the start of the next line
+            if start > 0:
+                f.seek(start - 1)
+                f.readline()
+                start = f.tell()
+
+            # Move past the end of the first read
+            if group_reads and start < size:
+                read = f.readline().split(b"\t", 1)[0]
+                while True:
+                    start = f.tell()
+                    line = f.readline()
+                    if len(line) == 0 or line.split(b"\t", 1)[0] != read:
+                        break
+            offsets.append(start)
+    offsets.append(size)
+    return [
+        (start, end)
+        for start, end in zip(offsets[:-1], offsets[1:])
+        if end > start
+    ]
+
+
+def _accumulate(align_fp, acc, assigner, chunksize):
+    """Add every alignment from a file (or handle) to the accumulators."""
+
+    # Only read the columns which are needed
+    usecols = ["sseqid", "pident", "length", "sstart", "send", "bitscore", "slen"]
+    if assigner is not None:
+        usecols.append("qseqid")
+
+    n_parsed = 0
+    for chunk in read_alignment_chunks(
+        align_fp, chunksize=chunksize, usecols=usecols
+    ):
+        ix = acc.add_chunk(chunk)
+        if assigner is not None:
+            reads = chunk["qseqid"]
+            assigner.add(
+                reads.cat.codes.values,
+                ix,
+                chunk["bitscore"].values,
+                reads.iloc[0],
+                reads.iloc[-1],
+            )
+        n_parsed += chunk.shape[0]
+        logging.info("Parsed {:,} alignments".format(n_parsed))
+
+    if assigner is not None:
+        assigner.finish()
+    return n_parsed
+
+
+def _parse_shard(shard):
+    """
+    Parse a byte range of an alignment file, returning partial results.
+    Subjects are returned by name, so each shard only indexes the subjects
+    it has alignments for, rather than holding the whole vocabulary.
+    """
+    align_fp, start, end, chunksize, multimapping, quantiles = shard
+    acc, assigner = make_accumulators(
+        multimapping=multimapping,
+        quantiles=quantiles,
+    )
+
+    handle = io.BufferedReader(FileRange(align_fp, start, end), 4 * 1024 * 1024)
+    try:
+        n_parsed = _accumulate(handle, acc, assigner, chunksize)
+    finally:
+        handle.close()
+    return n_parsed, partial_arrays(acc, assigner)
+
+
+def _can_shard(align_fp):
+    """Alignments can only be split if they are in an uncompressed file."""
+    if not isinstance(align_fp, str) or not os.path.isfile(align_fp):
+        return False
+    if align_fp.endswith(".gz"):
+        return False
+    # Worker processes (e.g. for a batch of samples) can't start a pool
+    if multiprocessing.current_process().daemon:
+        return False
+    return True
+
+
+def make_accumulators(multimapping="all", vocabulary=None, quantiles=False):
+    """
+    Return an AlignmentAccumulator, and a ReadAssigner for multimapping
+    methods other than "all".
+    """
+    acc = AlignmentAccumulator(vocabulary=vocabulary, quantiles=quantiles)
+    if multimapping == "all":
+        assigner = None
+    else:
+        assigner = ReadAssigner(method=multimapping)
+    return acc, assigner
+
+
+def accumulate_alignments(align_fp, acc, assigner=None, chunksize=1000000,
+                          workers=1):
+    """
+    Add the alignments in a file (or handle) to the accumulators, returning
+    the number of alignments.
+
+    With workers > 1, an uncompressed file is split into shards which are
+    parsed in parallel, and the partial results are merged in order, giving
+    exactly the same result as a single process. Each worker holds a chunk
+    of alignments at a time (see resource_helpers.parse_workers).
+    """
+    shards = []
+    if workers > 1 and _can_shard(align_fp):
+        shards = shard_offsets(
+            align_fp, workers, group_reads=assigner is not None
+        )
+
+    if len(shards) <= 1:
+        logging.info("Reading from {}".format(align_fp))
+        return _accumulate(align_fp, acc, assigner, chunksize)
+
+    logging.info("Reading from {} in {:,} shards".format(
+        align_fp, len(shards)
+    ))
+    multimapping = "all" if assigner is None else assigner.method
+    pool = multiprocessing.Pool(min(workers, len(shards)))
+    try:
+        n_parsed = 0
+        # Merge the shards in order, so that subjects are indexed in the
+        # order they appear in the file
+        for n, arrays in pool.imap(_parse_shard, [
+            (align_fp, start, end, chunksize, multimapping, acc.quantiles)
+            for start, end in shards
+        ]):
+            merge_partial_arrays(arrays, acc, assigner)
+            n_parsed += n
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return n_parsed
 
 
 def parse_alignment(align_fp,
-                    subject_ix=1,
-                    pctid_ix=2,
-                    alen_ix=3,
-                    sstart_ix=6,
-                    send_ix=7,
-                    bitscore_ix=9,
-                    slen_ix=11):
+                    chunksize=1000000,
+                    multimapping="all",
+                    vocabulary=None,
+                    quantiles=False,
+                    workers=1):
     """
     Parse an alignment in BLAST6 format and calculate coverage per subject.
+
+    With multimapping="all", every alignment counts fully towards each
+    subject. With "best" or "em", each read is split across the subjects
+    it aligns to (either evenly across its top hits, or by EM), and
+    nreads and depth are scaled to the fraction assigned to each subject.
+
+    Subjects are indexed by a SubjectVocabulary (e.g. from the metadata),
+    and names are only needed again when writing the output.
+
+    The mean and variance of pctid, alen and bitscore are reported for
+    each subject, as well as the median if quantiles=True.
+
+    With workers > 1, the file is parsed in parallel shards.
     """
+    acc, assigner = make_accumulators(
+        multimapping=multimapping,
+        vocabulary=vocabulary,
+        quantiles=quantiles,
+    )
+    n_parsed = accumulate_alignments(
+        align_fp, acc, assigner, chunksize=chunksize, workers=workers
+    )
+    logging.info("Parsed {:,} alignments".format(n_parsed))
+
+    return summarize_alignments(acc, assigner)
+
+
+def summarize_alignments(acc, assigner=None):
+    """Calculate the per-subject stats from a set of accumulators."""
+    output, detected = acc.summarize()
+
+    # Scale the number of reads and depth by the fraction of each read
+    # which was assigned to each subject
+    if assigner is not None:
+        assigned = assigner.assign(acc.n_subjects)[detected]
+        for i, r in enumerate(output):
+            r["nalignments"] = r["nreads"]
+            r["depth"] = r["depth"] * assigned[i] / r["nreads"]
+            r["nreads"] = float(assigned[i])
 
-    # Keep track of a number of different metrics for each subject
-    coverage = {}
-    subject_len = {}
-    pctid = defaultdict(list)
-    alen = defaultdict(list)
-    bitscore = defaultdict(list)
-
-    logging.info("Reading from {}".format(align_fp))
-    with open(align_fp, "rt") as f:
-        for ix, line in enumerate(f):
-            if len(line) == 1:
-                continue
-            line = line.rstrip("\n").split("\t")
-            s = line[subject_ix]
-            if s not in coverage:
-                slen = int(line[slen_ix])
-                subject_len[s] = slen
-                coverage[s] = np.zeros(slen, dtype=int)
-
-            pctid[s].append(float(line[pctid_ix]))
-            alen[s].append(int(line[alen_ix]))
-            bitscore[s].append(float(line[bitscore_ix]))
-
-            coverage[s][
-                (int(line[sstart_ix]) - 1): int(line[send_ix])
-            ] += 1
-
-            if ix > 0 and ix % 1e6 == 0:
-                logging.info("Parsed {:,} alignments".format(ix))
-
-    logging.info("Parsed {:,} alignments".format(ix))
-
-    # Calculate the per-subject stats
-    output = []
-    for ix, s in enumerate(coverage):
-        output.append({
-            "protein": s,
-            "coverage": (coverage[s] > 0).mean(),
-            "depth": coverage[s].mean(),
-            "pctid": np.mean(pctid[s]),
-            "alen": np.mean(alen[s]),
-            "bitscore": np.mean(bitscore[s]),
-            "nreads": len(pctid[s]),
-            "length": subject_len[s],
-        })
-        if ix > 0 and ix % 1e3 == 0:
-            logging.info("Summarized coverage for {:,} subjects".format(ix))
-
-    logging.info("Summarized coverage for {:,} subjects".format(ix))
+    logging.info("Summarized coverage for {:,} subjects".format(len(output)))
 
     return output
@@ -0,0 +1,341 @@
+#!/usr/bin/python
+"""Functions to generate synthetic inputs for benchmarking."""
+
+import os
+import gzip
+import time
+import logging
+import resource
+import threading
+import numpy as np
+import pandas as pd
+from Bio.Data import CodonTable
+
+# Interval between measurements of memory use while a function runs
+RSS_POLL_SECONDS = 0.01
+
+# Background frequency of each amino acid in proteins
+AMINO_ACID_FREQUENCIES = {
+    "A": 0.074, "R": 0.052, "N": 0.045, "D": 0.054, "C": 0.025,
+    "Q": 0.034, "E": 0.054, "G": 0.074, "H": 0.026, "I": 0.068,
+    "L": 0.099, "K": 0.058, "M": 0.025, "F": 0.047, "P": 0.039,
+    "S": 0.057, "T": 0.051, "W": 0.013, "Y": 0.032, "V": 0.073,
+}
+
+
+def write_synthetic_alignment(fp,
+                              n_hits,
+                              n_subjects=1000,
+                              subject_len=300,
+                              alen=30,
+                              skew=0,
+                              chunk_size=1000000,
+                              seed=0):
+    """
+    Write a BLAST6 file with the columns produced by align_reads. With
+    skew > 0, the number of hits per subject falls off with its rank
+    (following a power law), as for a few abundant viruses in a sample.
+    """
+    rng = np.random.RandomState(seed)
+    subjects = np.array([
+        "protein_{}".format(ix) for ix in range(n_subjects)
+    ])
+    weights = 1. / np.arange(1, n_subjects + 1) ** skew
+    weights /= weights.sum()
+
+    logging.info("Writing {:,} synthetic alignments to {}".format(n_hits, fp))
+    with open(fp, "wt") as fo:
+        n_written = 0
+        while n_written < n_hits:
+            n = min(chunk_size, n_hits - n_written)
+            if skew > 0:
+                subject = rng.choice(n_subjects, size=n, p=weights)
+            else:
+                subject = rng.randint(0, n_subjects, size=n)
+            sstart = rng.randint(1, subject_len - alen + 2, size=n)
+            send = sstart + alen - 1
+            # Put a fraction of the hits on the reverse strand
+            reverse = rng.rand(n) < 0.5
+            sstart[reverse], send[reverse] = send[reverse], sstart[reverse]
+            pctid = np.round(rng.uniform(70, 100, size=n), 1)
+            bitscore = np.round(rng.uniform(30, 70, size=n), 1)
+            lines = [
+                "read_{}\t{}\t{}\t{}\t1\t{}\t{}\t{}\t1e-10\t{}\t{}\t{}\n".format(
+                    n_written + ix, subjects[s], p, alen, 3 * alen,
+                    a, b, bs, 3 * alen, subject_len
+                )
+                for ix, (s, p, a, b, bs) in enumerate(zip(
+                    subject, pctid, sstart, send, bitscore
+                ))
+            ]
+            fo.write("".join(lines))
+            n_written += n
+    return fp
+
+
+def write_synthetic_fastq(fp,
+                          n_reads,
+                          read_len=150,
+                          chunk_size=100000,
+                          seed=0):
+    """Write a FASTQ file with random reads, with headers like Illumina."""
+    rng = np.random.RandomState(seed)
+    bases = np.array(list("ACGT"))
+    quals = np.array(list("#,:FF"))
+
+    logging.info("Writing {:,} synthetic reads to {}".format(n_reads, fp))
+    with open(fp, "wt") as fo:
+        n_written = 0
+        while n_written < n_reads:
+            n = min(chunk_size, n_reads - n_written)
+            seqs = bases[rng.randint(0, 4, size=(n, read_len))]
+            qual = quals[rng.randint(0, 5, size=(n, read_len))]
+            fo.write("".join([
+                "@SYNTH:1:FC:1:1:{}:1 1:N:0:ACGT\n{}\n+\n{}\n".format(
+                    n_written + ix, "".join(s), "".join(q)
+                )
+                for ix, (s, q) in enumerate(zip(seqs, qual))
+            ]))
+            n_written += n
+    return fp
+
+
+def synthetic_proteins(rng, n_proteins, protein_len=300):
+    """Random proteins with the background amino acid frequencies."""
+    aminos = np.array(sorted(AMINO_ACID_FREQUENCIES))
+    freqs = np.array([AMINO_ACID_FREQUENCIES[aa] for aa in aminos])
+    lengths = rng.randint(protein_len // 2, 2 * protein_len, size=n_proteins)
+    residues = aminos[
+        rng.choice(len(aminos), size=lengths.sum(), p=freqs / freqs.sum())
+    ]
+    ends = np.cumsum(lengths)
+    return ["".join(residues[end - length:end]) for length, end in zip(lengths, ends)]
+
+
+def write_synthetic_prefilter_data(fasta_fp,
+                                   fastq_fp,
+                                   n_proteins,
+                                   n_reads,
+                                   viral_fraction=0.1,
+                                   divergence=0.2,
+                                   read_len=150,
+                                   seed=0):
+    """
+    Write a set of reference proteins (FASTA) and reads (FASTQ) to test a
+    prefilter. A fraction of the reads (named viral-<n>) are translated
+    back from a window of a reference protein, with a fraction of its
+    amino acids (divergence) replaced at random. The rest (named
+    other-<n>) come from random proteins which are not in the reference.
+    Each read starts in a random frame, on a random strand.
+    """
+    rng = np.random.RandomState(seed)
+    codons = {}
+    for codon, aa in CodonTable.unambiguous_dna_by_id[11].forward_table.items():
+        codons.setdefault(aa, []).append(codon)
+    aminos = sorted(AMINO_ACID_FREQUENCIES)
+    complement = {"A": "T", "C": "G", "G": "C", "T": "A"}
+
+    logging.info("Writing {:,} synthetic reference proteins to {}".format(
+        n_proteins, fasta_fp
+    ))
+    proteins = synthetic_proteins(rng, n_proteins)
+    with open(fasta_fp, "wt") as fo:
+        for ix, seq in enumerate(proteins):
+            fo.write(">ref_{}\n{}\n".format(ix, seq))
+
+    n_viral = int(n_reads * viral_fraction)
+    others = synthetic_proteins(rng, max(1, (n_reads - n_viral) // 50))
+    window = read_len // 3 + 2
+    logging.info("Writing {:,} synthetic reads ({:,} viral) to {}".format(
+        n_reads, n_viral, fastq_fp
+    ))
+    with open(fastq_fp, "wt") as fo:
+        for ix in range(n_reads):
+            if ix < n_viral:
+                name = "viral-{}".format(ix)
+                source = proteins[rng.randint(len(proteins))]
+            else:
+                name = "other-{}".format(ix)
+                source = others[rng.randint(len(others))]
+            start = rng.randint(len(source) - window)
+            peptide = list(source[start:start + window])
+            if ix < n_viral:
+                for pos in np.flatnonzero(rng.uniform(size=window) < divergence):
+                    peptide[pos] = aminos[rng.randint(len(aminos))]
+            dna = "".join(
+                codons[aa][rng.randint(len(codons[aa]))] for aa in peptide
+            )
+            offset = rng.randint(3)
+            dna = dna[offset:offset + read_len]
+            if rng.uniform() < 0.5:
+                dna = "".join(complement[b] for b in reversed(dna))
+            fo.write("@{}\n{}\n+\n{}\n".format(name, dna, "F" * len(dna)))
+    return fasta_fp, fastq_fp
+
+
+def make_synthetic_metadata(n_proteins,
+                            proteins_per_genome=20,
+                            protein_len=300,
+                            seed=0):
+    """Make a metadata table shaped like the IMG/VR index."""
+    rng = np.random.RandomState(seed)
+    genome = np.arange(n_proteins) // proteins_per_genome
+    return pd.DataFrame({
+        "protein": ["protein_{}".format(ix) for ix in range(n_proteins)],
+        "genome": ["genome_{}".format(ix) for ix in genome],
+        "length": rng.randint(protein_len // 2, 2 * protein_len, size=n_proteins),
+        "taxonomy": "Viruses; Caudovirales",
+    }, columns=["protein", "genome", "length", "taxonomy"])
+
+
+def write_synthetic_img_vr(metadata_fp,
+                           faa_fp,
+                           n_proteins,
+                           proteins_per_genome=20,
+                           protein_len=300,
+                           chunk_size=100000,
+                           seed=0):
+    """
+    Write the genome metadata (TSV) and gzip compressed proteins (FASTA)
+    in the layout of IMG/VR, with headers like <genome>_____<protein>.
+    """
+    rng = np.random.RandomState(seed)
+    n_genomes = (n_proteins + proteins_per_genome - 1) // proteins_per_genome
+    genomes = np.array([
+        "IMGVR_UViG_{}_____genome_{}".format(ix % 1000, ix)
+        for ix in range(n_genomes)
+    ])
+
+    logging.info("Writing metadata for {:,} synthetic genomes to {}".format(
+        n_genomes, metadata_fp
+    ))
+    metadata = pd.DataFrame({
+        "mVCs": genomes,
+        "Taxon_oid": rng.randint(2000000000, 3000000000, size=n_genomes),
+        "Scaffold_oid": ["Ga{}_{}".format(ix % 1000, ix) for ix in range(n_genomes)],
+        "Ecosystem classification": "Environmental;Aquatic;Marine",
+        "vOTU": ["vOTU_{}".format(ix // 3) for ix in range(n_genomes)],
+        "Length": rng.randint(5000, 100000, size=n_genomes),
+        "Topology": np.where(rng.uniform(size=n_genomes) < 0.1, "Circular", "Linear"),
+        "Completeness": rng.uniform(0, 100, size=n_genomes).round(2),
+        "Taxonomic classification": "r__Duplodnaviria;k__Heunggongvirae",
+        "Host taxonomy prediction": np.where(
+            rng.uniform(size=n_genomes) < 0.5, "d__Bacteria;p__Firmicutes", None
+        ),
+        "GC %": rng.uniform(30, 70, size=n_genomes).round(2),
+    })
+    metadata[["mVCs"] + sorted(c for c in metadata.columns if c != "mVCs")].to_csv(
+        metadata_fp, sep="\t", index=False
+    )
+
+    logging.info("Writing {:,} synthetic proteins to {}".format(
+        n_proteins, faa_fp
+    ))
+    aminos = np.array(list("ACDEFGHIKLMNPQRSTVWY"))
+    with gzip.open(faa_fp, "wt") as fo:
+        n_written = 0
+        while n_written < n_proteins:
+            n = min(chunk_size, n_proteins - n_written)
+            lengths = rng.randint(protein_len // 2, 2 * protein_len, size=n)
+            seqs = aminos[rng.randint(0, 20, size=lengths.sum())]
+            ends = np.cumsum(lengths)
+            fo.write("".join([
+                ">{}_____protein_{}\n{}\n".format(
+                    genomes[(n_written + ix) // proteins_per_genome],
+                    n_written + ix,
+                    "".join(seqs[end - length:end]),
+                )
+                for ix, (length, end) in enumerate(zip(lengths, ends))
+            ]))
+            n_written += n
+    return metadata_fp, faa_fp
+
+
+def make_synthetic_abundances(metadata, n_detected, seed=0):
+    """Make the output of parse_alignment for a random set of proteins."""
+    rng = np.random.RandomState(seed)
+    detected = rng.choice(metadata.shape[0], size=n_detected, replace=False)
+    return [
+        {
+            "protein": metadata["protein"].values[ix],
+            "coverage": rng.uniform(0.1, 1),
+            "depth": rng.uniform(0.1, 100),
+            "pctid": rng.uniform(70, 100),
+            "alen": rng.uniform(20, 40),
+            "bitscore": rng.uniform(30, 70),
+            "nreads": int(rng.randint(1, 1000)),
+            "length": int(metadata["length"].values[ix]),
+        }
+        for ix in detected
+    ]
+
+
+def time_function(f, *args, **kwargs):
+    """Run a function and return its output and the elapsed seconds."""
+    start = time.time()
+    output = f(*args, **kwargs)
+    return output, time.time() - start
+
+
+def current_rss():
+    """Return the resident memory of this process, in bytes."""
+    try:
+        with open("/proc/self/statm", "rt") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError):
+        # Fall back to the peak for the whole process
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure_function(f, *args, **kwargs):
+    """
+    Run a function, returning its output, the elapsed seconds, and the
+    peak resident memory (in bytes) while it ran, which is sampled from
+    a background thread.
+    """
+    baseline = current_rss()
+    peak = [baseline]
+    done = threading.Event()
+
+    def poll():
+        while not done.is_set():
+            peak[0] = max(peak[0], current_rss())
+            done.wait(RSS_POLL_SECONDS)
+
+    thread = threading.Thread(target=poll)
+    thread.daemon = True
+    thread.start()
+    try:
+        output, elapsed = time_function(f, *args, **kwargs)
+    finally:
+        done.set()
+        thread.join()
+    peak = max(peak[0], current_rss())
+
+    return output, elapsed, {
+        "peak_rss_mb": round(peak / 1e6, 1),
+        "peak_rss_increase_mb": round((peak - baseline) / 1e6, 1),
+    }
+
+
+def throughput(stage, n_records, n_bytes, elapsed, memory, **params):
+    """Summarize the time taken to process a number of records and bytes."""
+    result = {
+        "stage": stage,
+        "records": n_records,
+        "bytes": n_bytes,
+        "seconds": round(elapsed, 3),
+        "records_per_second": round(n_records / elapsed, 1),
+        "mb_per_second": round(n_bytes / 1e6 / elapsed, 2),
+    }
+    result.update(memory)
+    result.update(params)
+    logging.info(
+        "{}: {:,} records ({:,.1f} MB) in {:.2f}s "
+        "({:,.0f} records/s, {:,.1f} MB/s, peak {:,.1f} MB)".format(
+            stage, n_records, n_bytes / 1e6, elapsed,
+            result["records_per_second"], result["mb_per_second"],
+            result["peak_rss_mb"]
+        )
+    )
+    return result
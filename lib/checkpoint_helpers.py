@@ -0,0 +1,163 @@
+#!/usr/bin/python
+"""Functions to record the stages finished for a sample, so that a failed run can be resumed."""
+
+import os
+import json
+import time
+import hashlib
+import logging
+from lib.manifest_helpers import file_hash
+
+
+def settings_key(previous_key, stage, settings):
+    """Hash of the settings for a stage and every stage before it."""
+    return hashlib.md5(json.dumps(
+        [previous_key, stage, settings], sort_keys=True
+    ).encode("utf-8")).hexdigest()
+
+
+def local_file_settings(path):
+    """
+    Describe an input which may change between runs: a local file by its
+    path, size and modification time, and a remote file by its URL.
+    """
+    if path is None or path.startswith(("s3://", "sra://", "ftp://")):
+        return path
+    if not os.path.exists(path):
+        return path
+    return [path, os.path.getsize(path), int(os.path.getmtime(path))]
+
+
+class Checkpoints(object):
+    """
+    Completion markers for a fixed sequence of stages, written to a work
+    directory. Each marker records a hash of the settings used for the
+    stage (and every stage before it), the files written by the stage
+    before it, the values returned by the stage, and the size and
+    modification time of every file it wrote. With hash_files, the content
+    hash of each file is recorded (and checked) instead of its
+    modification time, which is slower for large files.
+
+    When the work directory already has markers from a run with the same
+    settings, every stage is skipped up to the last one for which the
+    markers and files of it and every stage before it are intact.
+    """
+
+    def __init__(self, work_dir, stages, enabled=True, hash_files=False):
+        self.work_dir = work_dir
+        self.enabled = enabled
+        self.hash_files = hash_files
+        self.names = [name for name, settings in stages]
+        self.keys = {}
+        key = None
+        for name, settings in stages:
+            key = settings_key(key, name, settings)
+            self.keys[name] = key
+
+        self.markers = {}
+        self.resume_after = -1
+        if enabled:
+            self._find_resume_point()
+
+    def marker_fp(self, name):
+        return os.path.join(self.work_dir, "{}.checkpoint".format(name))
+
+    def _read_marker(self, name):
+        fp = self.marker_fp(name)
+        if not os.path.exists(fp):
+            return None
+        with open(fp, "rt") as f:
+            return json.load(f)
+
+    def _intact(self, marker):
+        """Check that every file written by a stage is unchanged."""
+        for fp, info in marker["files"].items():
+            if not os.path.exists(fp) or os.path.getsize(fp) != info["size"]:
+                logging.info("Checkpoint file is missing or incomplete: {}".format(fp))
+                return False
+            if "md5" in info:
+                changed = file_hash(fp) != info["md5"]
+            else:
+                changed = os.stat(fp).st_mtime_ns != info["mtime_ns"]
+            if changed:
+                logging.info("Checkpoint file has changed: {}".format(fp))
+                return False
+        return True
+
+    def _file_info(self, fp):
+        """Size and modification time (or content hash) of a file."""
+        if self.hash_files:
+            return {"size": os.path.getsize(fp), "md5": file_hash(fp)}
+        stat = os.stat(fp)
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def _find_resume_point(self):
+        # Only an unbroken chain of markers from the first stage can be used
+        chain = []
+        upstream = None
+        for name in self.names:
+            marker = self._read_marker(name)
+            if marker is None:
+                break
+            if marker["key"] != self.keys[name] or marker["upstream"] != upstream:
+                logging.info("Settings have changed since stage {}".format(name))
+                break
+            chain.append(marker)
+            upstream = marker["files"]
+
+        # Later stages may read the files from any stage before them, so
+        # resume after the last stage where every file so far is intact
+        for ix, marker in enumerate(chain):
+            if not self._intact(marker):
+                break
+            self.resume_after = ix
+        for ix, name in enumerate(self.names):
+            if ix <= self.resume_after:
+                self.markers[name] = chain[ix]
+            elif os.path.exists(self.marker_fp(name)):
+                os.unlink(self.marker_fp(name))
+
+        if self.resume_after >= 0:
+            logging.info("Resuming from {}, skipping stages: {}".format(
+                self.work_dir, ", ".join(self.names[:self.resume_after + 1])
+            ))
+        else:
+            logging.info("No stages finished in {}".format(self.work_dir))
+
+    def skip(self, name):
+        """Whether a stage was finished in a previous run."""
+        return self.enabled and self.names.index(name) <= self.resume_after
+
+    def values(self, name):
+        """The values recorded when a stage was finished."""
+        return self.markers[name]["values"]
+
+    def complete(self, name, values=None, files=None):
+        """
+        Record that a stage has finished, with the values it returned and
+        the files it wrote (which must be intact for the stage to be
+        skipped in a later run).
+        """
+        if not self.enabled:
+            return
+        ix = self.names.index(name)
+        previous = [
+            self.markers[n] for n in self.names[:ix] if n in self.markers
+        ]
+        marker = {
+            "stage": name,
+            "key": self.keys[name],
+            "upstream": previous[-1]["files"] if len(previous) > 0 else None,
+            "values": {} if values is None else values,
+            "files": {
+                fp: self._file_info(fp)
+                for fp in ([] if files is None else files)
+            },
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        fp = self.marker_fp(name)
+        with open(fp + ".temp", "wt") as fo:
+            json.dump(marker, fo, indent=4)
+        os.rename(fp + ".temp", fp)
+        self.markers[name] = marker
+        logging.info("Finished stage {} (checkpoint in {})".format(name, fp))
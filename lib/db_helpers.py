@@ -0,0 +1,335 @@
+#!/usr/bin/python
+"""Functions to build a reference database from GenBank protein (gpff) files."""
+
+import io
+import os
+import gzip
+import logging
+import multiprocessing
+import numpy as np
+import pandas as pd
+from Bio import GenBank
+from lib.manifest_helpers import file_hash
+from lib.manifest_helpers import write_diff
+from lib.manifest_helpers import content_hash
+from lib.manifest_helpers import read_manifest
+from lib.manifest_helpers import write_manifest
+from lib.manifest_helpers import diff_manifests
+from lib.manifest_helpers import unchanged_diff
+from lib.metadata_helpers import decode_strings
+from lib.metadata_helpers import write_metadata_index
+
+# Columns of the metadata table, in the order they are written
+METADATA_COLUMNS = [
+    "definition", "genome", "length", "locus_tag", "organism", "product",
+    "protein", "region", "taxid", "taxonomy",
+]
+
+
+def parse_record(record):
+    """Return the sequence and metadata for a single GenBank record."""
+    taxid = None
+    product = None
+    locus_tag = None
+    coded_by = None
+    genome = None
+    genome_range = None
+
+    for feature in record.features:
+        for qualifier in feature.qualifiers:
+            if feature.key == "source":
+                if qualifier.key == "/db_xref=":
+                    taxid = qualifier.value.strip('"')
+                    taxid = taxid.replace("taxon:", "")
+            elif feature.key == "Protein":
+                if qualifier.key == "/product=":
+                    product = qualifier.value.strip('"')
+            elif feature.key == "CDS":
+                if qualifier.key == "/locus_tag=":
+                    locus_tag = qualifier.value.strip('"')
+                elif qualifier.key == "/coded_by=":
+                    coded_by = qualifier.value.strip('"')
+                    genome, genome_range = coded_by.split(":", 1)
+                    genome = genome.replace("complement(", "")
+                    genome = genome.replace("join(", "")
+    return {
+        "protein": record.locus,
+        "sequence": record.sequence,
+        "organism": record.organism,
+        "taxonomy": '; '.join(record.taxonomy),
+        "definition": record.definition,
+        "taxid": taxid,
+        "product": product,
+        "locus_tag": locus_tag,
+        "genome": genome,
+        "region": genome_range,
+        "length": len(record.sequence),
+    }
+
+
+def parse_gpff_records(texts):
+    """Parse a batch of complete GenBank records, each given as text."""
+    records = [
+        parse_record(record)
+        for record in GenBank.parse(io.StringIO("".join(texts)))
+    ]
+    assert len(records) == len(texts), "Could not parse every record"
+    for r, text in zip(records, texts):
+        r["record_hash"] = content_hash(text)
+    return records
+
+
+def open_gpff(fp):
+    """Open a GenBank file (which may be gzip compressed) as text."""
+    if fp.endswith(".gz"):
+        return gzip.open(fp, "rt")
+    return open(fp, "rt")
+
+
+def iter_records(fp):
+    """Yield the text of each record in a GenBank file (ending with //)."""
+    lines = []
+    with open_gpff(fp) as handle:
+        for line in handle:
+            lines.append(line)
+            if line.startswith("//"):
+                yield "".join(lines)
+                lines = []
+    if any(line.strip() for line in lines):
+        yield "".join(lines)
+
+
+def iter_record_batches(fps, batch_size=1000):
+    """Yield the text of the records in a set of GenBank files, in batches."""
+    batch = []
+    for fp in fps:
+        for text in iter_records(fp):
+            batch.append(text)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+class ExistingDatabase(object):
+    """
+    The records in a database built by build_database, which can be reused
+    if they are unchanged. Sequences are read from the FASTA as needed.
+    """
+
+    def __init__(self, prefix):
+        manifest, self.attrs = read_manifest("{}.manifest".format(prefix))
+        metadata = read_database_metadata("{}.tsv".format(prefix))
+        msg = "Manifest does not match the metadata for {}".format(prefix)
+        assert list(metadata["protein"]) == \
+            decode_strings(manifest["protein"]), msg
+        assert os.path.getsize("{}.fastp".format(prefix)) == \
+            self.attrs["fastp_size"], msg
+
+        self.rows = metadata.to_dict("records")
+        self.index = {
+            h: ix for ix, h in enumerate(decode_strings(manifest["record_hash"]))
+        }
+        self.offsets = manifest["fastp_offset"]
+        self.manifest = manifest
+        self.fastp = open("{}.fastp".format(prefix), "rb")
+
+    def __contains__(self, record_hash):
+        return record_hash in self.index
+
+    def record(self, record_hash):
+        """Return the sequence and metadata for a record."""
+        ix = self.index[record_hash]
+        r = dict(self.rows[ix])
+        self.fastp.seek(self.offsets[ix])
+        header = self.fastp.readline().decode("utf-8")
+        assert header == ">{}\n".format(r["protein"]), header
+        r["sequence"] = self.fastp.readline().decode("utf-8").rstrip("\n")
+        r["record_hash"] = record_hash
+        return r
+
+    def close(self):
+        self.fastp.close()
+
+
+def parse_gpff(fps, threads=1, batch_size=1000, existing=None):
+    """
+    Yield the sequence and metadata for every record in a set of GenBank
+    files, in order, with batches of records parsed by a pool of worker
+    processes. Only a few batches are held in memory at a time. Records
+    which are unchanged in an ExistingDatabase are not parsed again.
+    """
+    pool = multiprocessing.Pool(threads) if threads > 1 else None
+
+    def submit(texts):
+        if pool is None:
+            parsed = parse_gpff_records(texts)
+            return lambda: parsed
+        return pool.apply_async(parse_gpff_records, (texts,)).get
+
+    def finish(hashes, get_parsed):
+        parsed = iter(get_parsed())
+        for h in hashes:
+            if existing is not None and h in existing:
+                yield existing.record(h)
+            else:
+                yield next(parsed)
+
+    try:
+        # Keep the workers busy, without reading the whole file ahead
+        pending = []
+        for texts in iter_record_batches(fps, batch_size=batch_size):
+            if len(pending) >= 2 * threads:
+                for r in finish(*pending.pop(0)):
+                    yield r
+            hashes = [content_hash(text) for text in texts]
+            pending.append((hashes, submit([
+                text for text, h in zip(texts, hashes)
+                if existing is None or h not in existing
+            ])))
+        while len(pending) > 0:
+            for r in finish(*pending.pop(0)):
+                yield r
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def write_database(records, prefix, chunk_size=10000):
+    """
+    Write the protein sequences (prefix.fastp) and metadata (prefix.tsv)
+    for a stream of records, a chunk of records at a time. Returns the
+    manifest for the records written (with the position of each sequence
+    in the FASTA).
+    """
+    fastp_fp = "{}.fastp".format(prefix)
+    tsv_fp = "{}.tsv".format(prefix)
+    logging.info("Writing protein sequences to {}".format(fastp_fp))
+    logging.info("Writing mappings to {}".format(tsv_fp))
+
+    proteins = set()
+    fastp_size = [0]
+    manifest = {
+        "protein": [],
+        "record_hash": [],
+        "sequence_hash": [],
+        "fastp_offset": [],
+    }
+
+    def write_chunk(chunk):
+        # Make sure all of the protein names are unique
+        for r in chunk:
+            msg = "Protein name is not unique: {}".format(r["protein"])
+            assert r["protein"] not in proteins, msg
+            proteins.add(r["protein"])
+
+        fastp_chunk = []
+        offset = fastp_size[0]
+        for r in chunk:
+            entry = ">{}\n{}\n".format(r["protein"], r["sequence"])
+            manifest["protein"].append(r["protein"])
+            manifest["record_hash"].append(r["record_hash"])
+            manifest["sequence_hash"].append(content_hash(r["sequence"]))
+            manifest["fastp_offset"].append(offset)
+            fastp_chunk.append(entry)
+            offset += len(entry)
+        fastp.write("".join(fastp_chunk))
+        fastp_size[0] = offset
+        pd.DataFrame(chunk, columns=METADATA_COLUMNS).to_csv(
+            tsv, sep="\t", index=None, header=len(manifest["protein"]) == len(chunk)
+        )
+
+    # Write to temporary files, so that an existing database can be read
+    # while it is being updated
+    with open(fastp_fp + ".temp", "wt") as fastp, \
+            open(tsv_fp + ".temp", "wt") as tsv:
+        chunk = []
+        for r in records:
+            chunk.append(r)
+            if len(chunk) == chunk_size:
+                write_chunk(chunk)
+                chunk = []
+                logging.info("Parsed {:,} sequence records".format(
+                    len(manifest["protein"])
+                ))
+        if len(chunk) > 0 or len(manifest["protein"]) == 0:
+            write_chunk(chunk)
+
+    os.rename(fastp_fp + ".temp", fastp_fp)
+    os.rename(tsv_fp + ".temp", tsv_fp)
+    logging.info("Wrote {:,} sequence records".format(len(manifest["protein"])))
+    manifest["fastp_offset"] = np.array(manifest["fastp_offset"], dtype=np.int64)
+    return manifest
+
+
+def read_database_metadata(tsv_fp):
+    """Read the metadata written by write_database, keeping text as text."""
+    return pd.read_csv(
+        tsv_fp,
+        sep="\t",
+        dtype={k: object for k in METADATA_COLUMNS if k != "length"}
+    )
+
+
+def build_database(gpff_fps, prefix, threads=1, batch_size=1000,
+                   rebuild=False):
+    """
+    Parse a set of GenBank protein files, writing the sequences, the
+    metadata, the metadata index (prefix.idx) and a manifest of every
+    record (prefix.manifest).
+
+    If the database has been built before (and rebuild is False), only
+    the records which are new or have changed are parsed, and nothing is
+    done if the input files are the same. Returns the changes made to the
+    database, which are also written to prefix.diff.json.
+    """
+    manifest_fp = "{}.manifest".format(prefix)
+    inputs = [[os.path.basename(fp), file_hash(fp)] for fp in gpff_fps]
+
+    existing = None
+    old_manifest = None
+    outputs = [
+        "{}.{}".format(prefix, ending)
+        for ending in ["fastp", "tsv", "idx", "manifest"]
+    ]
+    if not rebuild and all(os.path.exists(fp) for fp in outputs):
+        existing = ExistingDatabase(prefix)
+        old_manifest = existing.manifest
+        if existing.attrs["inputs"] == inputs:
+            existing.close()
+            logging.info("Input files are unchanged, database is up to date")
+            return unchanged_diff()
+        logging.info("Updating the existing database ({:,} proteins)".format(
+            len(old_manifest["protein"])
+        ))
+
+    try:
+        manifest = write_database(
+            parse_gpff(
+                gpff_fps,
+                threads=threads,
+                batch_size=batch_size,
+                existing=existing
+            ),
+            prefix
+        )
+    finally:
+        if existing is not None:
+            existing.close()
+
+    write_metadata_index(
+        read_database_metadata("{}.tsv".format(prefix)),
+        "{}.idx".format(prefix)
+    )
+
+    diff = diff_manifests(old_manifest, manifest)
+    write_diff("{}.diff.json".format(prefix), diff)
+    write_manifest(manifest_fp, manifest, attrs={
+        "inputs": inputs,
+        "fastp_size": os.path.getsize("{}.fastp".format(prefix)),
+    })
+    return diff
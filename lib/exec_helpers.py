@@ -4,10 +4,27 @@
 import os
 import sys
 import json
+import time
+import uuid
+import fcntl
 import shutil
+import hashlib
 import logging
 import traceback
 import subprocess
+from lib.output_helpers import write_json
+from lib.output_helpers import OutputStream
+from lib.output_helpers import copy_to_output
+from lib.resource_helpers import available_cpus
+from lib.resource_helpers import plan_alignment
+
+
+def command_exists(command):
+    """Check whether a command can be found in the PATH."""
+    return any(
+        os.access(os.path.join(folder, command), os.X_OK)
+        for folder in os.environ.get("PATH", "").split(os.pathsep)
+    )
 
 
 def run_cmds(commands, retry=0, catchExcept=False, stdout=None):
@@ -48,62 +65,379 @@ def run_cmds(commands, retry=0, catchExcept=False, stdout=None):
         assert exitcode == 0, "Exit code {}".format(exitcode)
 
 
+class AlignmentStream(object):
+    """Read the tabular output of a running DIAMOND process."""
+
+    def __init__(self, commands, stderr_fp, sidecar_fp=None):
+        logging.info("Commands:")
+        logging.info(' '.join(commands))
+
+        # DIAMOND writes its log to STDERR, which is captured in a file
+        # so that it can't block the process while we read from STDOUT
+        self.stderr_fp = stderr_fp
+        self.stderr = open(stderr_fp, "wt")
+        self.proc = subprocess.Popen(commands,
+                                     stdout=subprocess.PIPE,
+                                     stderr=self.stderr,
+                                     universal_newlines=True)
+
+        # Optionally compress a copy of the output as it is read
+        self.sidecar_fp = sidecar_fp
+        self.sidecar_out = None
+        self.sidecar = None
+        if sidecar_fp is not None:
+            logging.info("Saving a compressed copy to {}".format(sidecar_fp))
+            self.sidecar_out = open(sidecar_fp, "wb")
+            self.sidecar = subprocess.Popen(["pigz", "-c"],
+                                            stdin=subprocess.PIPE,
+                                            stdout=self.sidecar_out,
+                                            universal_newlines=True)
+
+    def __str__(self):
+        return "output of {}".format(self.proc.pid)
+
+    def read(self, size=-1):
+        data = self.proc.stdout.read(size)
+        if self.sidecar is not None and len(data) > 0:
+            self.sidecar.stdin.write(data)
+        return data
+
+    def __iter__(self):
+        for line in iter(self.proc.stdout.readline, ""):
+            if self.sidecar is not None:
+                self.sidecar.stdin.write(line)
+            yield line
+
+    def close(self):
+        """Wait for the process to finish and return the sidecar path."""
+        # Drain anything that was not consumed by the reader
+        while len(self.read(1024 * 1024)) > 0:
+            pass
+        self.proc.stdout.close()
+        exitcode = self.proc.wait()
+        self.stderr.close()
+
+        logging.info("Standard error of subprocess:")
+        with open(self.stderr_fp, "rt") as f:
+            for line in f:
+                logging.info(line.rstrip("\n"))
+        os.unlink(self.stderr_fp)
+
+        if self.sidecar is not None:
+            self.sidecar.stdin.close()
+            assert self.sidecar.wait() == 0, "Could not compress alignments"
+            self.sidecar_out.close()
+
+        assert exitcode == 0, "Exit code {}".format(exitcode)
+
+        return self.sidecar_fp
+
+    def kill(self):
+        """
+        Stop DIAMOND and the sidecar if they are still running (e.g. if
+        the reader failed), and wait for them. Does nothing after close().
+        """
+        for proc in [self.proc, self.sidecar]:
+            if proc is not None and proc.poll() is None:
+                logging.info("Stopping process {}".format(proc.pid))
+                proc.kill()
+                proc.wait()
+        for handle in [self.proc.stdout, self.stderr, self.sidecar_out]:
+            if handle is not None:
+                handle.close()
+        if self.sidecar is not None:
+            try:
+                self.sidecar.stdin.close()
+            except (IOError, OSError):
+                pass
+
+
 def align_reads(read_fp,               # FASTQ file path
                 db_fp,                 # Local path to DB
                 temp_folder,           # Folder for results
                 query_gencode=11,      # Genetic code
                 threads=1,             # Threads
-                blocks=4):             # Memory block size
+                blocks=4,              # Memory block size (or "auto")
+                stream=False,          # Read the output while aligning
+                keep_alignments=False,  # Keep a copy of streamed output
+                index_chunks=None):    # Chunks for the seed index
 
-    """Align a set of reads with DIAMOND."""
+    """
+    Align a set of reads with DIAMOND. With blocks="auto", the block size,
+    index chunks and threads are picked from the memory and CPUs available.
+    """
+
+    if blocks == "auto":
+        plan = plan_alignment(os.path.getsize(db_fp))
+        blocks = plan["block_size"]
+        index_chunks = plan["index_chunks"]
+        threads = plan["threads"]
 
     align_fp = "{}.sam".format(read_fp)
     logging.info("Input reads: {}".format(read_fp))
     logging.info("Reference database: {}".format(db_fp))
     logging.info("Genetic code: {}".format(query_gencode))
     logging.info("Threads: {}".format(threads))
-    logging.info("Output: {}".format(align_fp))
 
-    run_cmds([
-            "diamond",
-            "blastx",
-            "--query", read_fp,             # Input FASTQ
-            "--out", align_fp,              # Alignment file
-            "--threads", str(threads),      # Threads
-            "--db", db_fp,                  # Reference database
-            "--outfmt", "6",                # Output format
-            "qseqid", "sseqid",
-            "pident", "length",
-            "qstart", "qend",
-            "sstart", "send",
-            "evalue", "bitscore",
-            "qlen", "slen",
-            "--top", "10",                  # Alignments within 10% of the best
-            "--block-size", str(blocks),    # Memory block size
-            "--query-gencode",              # Genetic code
-            str(query_gencode),
-            "--unal", "0",                  # Don't report unaligned reads
-            ])
+    commands = [
+        "diamond",
+        "blastx",
+        "--query", read_fp,             # Input FASTQ
+        "--threads", str(threads),      # Threads
+        "--db", db_fp,                  # Reference database
+        "--outfmt", "6",                # Output format
+        "qseqid", "sseqid",
+        "pident", "length",
+        "qstart", "qend",
+        "sstart", "send",
+        "evalue", "bitscore",
+        "qlen", "slen",
+        "--top", "10",                  # Alignments within 10% of the best
+        "--block-size", str(blocks),    # Memory block size
+        "--query-gencode",              # Genetic code
+        str(query_gencode),
+        "--unal", "0",                  # Don't report unaligned reads
+    ]
+    if index_chunks is not None:
+        commands += ["--index-chunks", str(index_chunks)]
+
+    if stream:
+        # Without --out, DIAMOND writes the alignments to STDOUT
+        logging.info("Output: streaming")
+        return AlignmentStream(
+            commands,
+            os.path.join(temp_folder, "diamond.log"),
+            sidecar_fp=align_fp + ".gz" if keep_alignments else None
+        )
+
+    logging.info("Output: {}".format(align_fp))
+    run_cmds(commands + ["--out", align_fp])
 
     return align_fp
 
 
-def get_reference_database(ref_db, temp_folder, ending=None):
-    """Get a reference database folder."""
+def s3_object_info(url):
+    """Return the ETag and size of an object in S3."""
+    bucket, key = url[5:].split("/", 1)
+    info = json.loads(subprocess.check_output([
+        "aws", "s3api", "head-object", "--bucket", bucket, "--key", key
+    ]).decode("utf-8"))
+    return info["ETag"].strip('"'), int(info["ContentLength"])
+
+
+def cache_entries(cache_folder):
+    """Return the (path, size, last used) of every file in the cache."""
+    entries = []
+    for fn in os.listdir(cache_folder):
+        if fn.startswith(".") or fn.endswith((".lock", ".json", ".tmp")):
+            continue
+        fp = os.path.join(cache_folder, fn)
+        if os.path.isfile(fp):
+            entries.append((fp, os.path.getsize(fp), os.path.getmtime(fp)))
+    return entries
+
+
+# Shared locks on the cached files used by this process, which stop them
+# from being evicted by another process until they are released
+_CACHE_IN_USE = {}
+
+
+def lock_file(lock_fp, operation):
+    """
+    Open and lock a lock file, returning the handle. Lock files are removed
+    along with the entries they protect (while locked), so the lock is
+    retried if the file was removed while waiting for it.
+    """
+    while True:
+        handle = open(lock_fp, "a")
+        fcntl.flock(handle, operation)
+        try:
+            if os.stat(lock_fp).st_ino == os.fstat(handle.fileno()).st_ino:
+                return handle
+        except OSError:
+            pass
+        handle.close()
+
+
+def use_cached(local_fp):
+    """Hold a shared lock on a cached file while it is in use."""
+    if local_fp in _CACHE_IN_USE:
+        return
+    _CACHE_IN_USE[local_fp] = lock_file(local_fp + ".use.lock", fcntl.LOCK_SH)
+
+
+def release_cached(local_fp):
+    """Release the shared lock on a cached file (also released on exit)."""
+    handle = _CACHE_IN_USE.pop(local_fp, None)
+    if handle is not None:
+        handle.close()
+
+
+def evict_from_cache(cache_folder, cache_size, keep=None):
+    """
+    Remove the least recently used files until the cache fits, skipping
+    any file which is being written, or is in use by any process.
+    """
+    with open(os.path.join(cache_folder, ".evict.lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        entries = sorted(cache_entries(cache_folder), key=lambda e: e[2])
+        total = sum([e[1] for e in entries])
+        for fp, size, last_used in entries:
+            if total <= cache_size:
+                break
+            if fp == keep:
+                continue
+
+            # Skip any file which is currently being written or used
+            with open(fp + ".lock", "a") as entry_lock, \
+                    open(fp + ".use.lock", "a") as use_lock:
+                try:
+                    fcntl.flock(entry_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    fcntl.flock(use_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    logging.info(
+                        "Not removing {} from the cache (in use)".format(fp)
+                    )
+                    continue
+                logging.info("Removing {} from the cache ({:,} bytes)".format(
+                    fp, size
+                ))
+                os.unlink(fp)
+                if os.path.exists(fp + ".json"):
+                    os.unlink(fp + ".json")
+
+                # Remove the lock files while they are still held, so that
+                # any process waiting on them will retry with new ones
+                os.unlink(fp + ".use.lock")
+                os.unlink(fp + ".lock")
+            total -= size
+
+
+def fetch_cached(name, cache_folder, download, cache_size=None):
+    """
+    Return the path to a file in the cache, calling download(path) to add
+    it if it is missing. Only one process downloads any given file, and
+    files are moved into place only once they are complete. The file is
+    kept in the cache while this process uses it (until release_cached).
+    """
+    if not os.path.exists(cache_folder):
+        try:
+            os.makedirs(cache_folder)
+        except OSError:
+            assert os.path.isdir(cache_folder)
+
+    local_fp = os.path.join(cache_folder, name)
+
+    start_time = time.time()
+    with lock_file(local_fp + ".lock", fcntl.LOCK_EX):
+        # Time the lookup (or download) separately from waiting for the
+        # lock, which may be held by another process downloading the file
+        lock_wait = time.time() - start_time
+        start_time = time.time()
+
+        if os.path.exists(local_fp):
+            # Mark the file as recently used
+            os.utime(local_fp, None)
+            download_time = None
+            if os.path.exists(local_fp + ".json"):
+                with open(local_fp + ".json", "rt") as f:
+                    download_time = json.load(f)["download_time"]
+            logging.info(
+                "Cache hit for {} in {:.2f}s after waiting {:.2f}s for the "
+                "lock (download took {})".format(
+                    name,
+                    time.time() - start_time,
+                    lock_wait,
+                    "unknown" if download_time is None
+                    else "{:.2f}s".format(download_time)
+                )
+            )
+        else:
+            logging.info(
+                "Cache miss for {} after waiting {:.2f}s for the lock, "
+                "downloading".format(name, lock_wait)
+            )
+            temp_fp = "{}.{}.tmp".format(local_fp, str(uuid.uuid4())[:8])
+            try:
+                download(temp_fp)
+                os.rename(temp_fp, local_fp)
+            finally:
+                if os.path.exists(temp_fp):
+                    os.unlink(temp_fp)
+            download_time = time.time() - start_time
+            with open(local_fp + ".json", "wt") as fo:
+                json.dump({
+                    "name": name,
+                    "bytes": os.path.getsize(local_fp),
+                    "download_time": download_time,
+                }, fo)
+            logging.info("Downloaded {} ({:,} bytes) in {:.2f}s".format(
+                name, os.path.getsize(local_fp), download_time
+            ))
+
+        # Mark the file as in use before another process can evict it
+        use_cached(local_fp)
+
+    if cache_size is not None:
+        evict_from_cache(cache_folder, cache_size, keep=local_fp)
+
+    return local_fp
+
+
+def get_reference_database(ref_db,
+                           temp_folder,
+                           ending=None,
+                           cache_folder=None,
+                           cache_size=None,
+                           local_name=None):
+    """
+    Get a reference database folder. Files downloaded from S3 are saved in
+    the temp folder with the same name, or local_name if given (e.g. to
+    fetch several files with the same name from different prefixes).
+    """
     assert ref_db is not None, "Must provide reference database path"
     assert temp_folder is not None, "Must provide temp folder"
     if ending is not None:
         msg = "Ref DB must end with {} ({})"
         assert ref_db.endswith(ending), msg.format(ending, ref_db)
 
+    # Get files from AWS S3, reusing a copy from the cache if possible
+    if ref_db.startswith('s3://') and cache_folder is not None:
+        logging.info("Getting reference database from S3 via the cache: " + ref_db)
+
+        # Files are cached by their URL, ETag and size
+        etag, size = s3_object_info(ref_db)
+        name = "{}-{}".format(
+            hashlib.sha1(
+                "{}\t{}\t{}".format(ref_db, etag, size).encode("utf-8")
+            ).hexdigest()[:16],
+            ref_db.split('/')[-1]
+        )
+
+        def download(local_fp):
+            run_cmds([
+                'aws',
+                's3',
+                'cp',
+                '--quiet',
+                '--sse',
+                'AES256',
+                ref_db,
+                local_fp
+            ])
+            assert os.path.getsize(local_fp) == size
+
+        return fetch_cached(name, cache_folder, download, cache_size=cache_size)
+
     # Get files from AWS S3
-    if ref_db.startswith('s3://'):
+    elif ref_db.startswith('s3://'):
         logging.info("Getting reference database from S3: " + ref_db)
 
         # Save the database to the local temp folder
         local_fp = os.path.join(
             temp_folder,
-            ref_db.split('/')[-1]
+            ref_db.split('/')[-1] if local_name is None else local_name
         )
 
         assert os.path.exists(local_fp) is False
@@ -131,76 +465,78 @@ def get_reference_database(ref_db, temp_folder, ending=None):
         return ref_db
 
 
-def return_alignments(align_fp, output_path):
-    """Return the alignment file."""
-    logging.info("Compressing " + align_fp)
-    run_cmds([
-        "pigz", align_fp
-    ])
-    align_fp = align_fp + ".gz"
+def return_alignments(align_fp, output_path, threads=None, keep=False):
+    """
+    Return the alignment file, compressing it as it is copied. With keep,
+    the local file is left in place.
+    """
     assert os.path.exists(align_fp)
-    
+
     # Make sure that the file has a consistent ending
-    assert align_fp.endswith(".sam.gz")
+    assert align_fp.endswith(".sam") or align_fp.endswith(".sam.gz")
     assert output_path.endswith(".sam.gz")
-    
-    if output_path.startswith("s3:/"):
-        # Copy to S3
-        run_cmds([
-            'aws',
-            's3',
-            'cp',
-            '--quiet',
-            '--sse',
-            'AES256',
-            align_fp,
-            output_path
-        ])
+
+    # Alignments that were streamed have already been compressed
+    if align_fp.endswith(".gz"):
+        return return_file(align_fp, output_path, threads=threads, keep=keep)
+
+    logging.info("Compressing {} to {}".format(align_fp, output_path))
+    copy_to_output(
+        align_fp, output_path, threads=_output_threads(threads), compress=True
+    )
+    if not keep:
         os.unlink(align_fp)
-    else:
-        # Copy to local folder
-        run_cmds(['mv', align_fp, output_path])
 
 
-def return_results(out, output_path, temp_folder):
-    """Write out the final results as a JSON object."""
-    # Make a temporary file
-    temp_fp = os.path.join(temp_folder, 'temp.json')
-    with open(temp_fp, 'wt') as fo:
-        json.dump(out, fo)
+def return_results(out, output_path, threads=None):
+    """
+    Write out the final results as a JSON object, which is compressed and
+    uploaded as it is serialized.
+    """
+    logging.info("Writing results to " + output_path)
+    with OutputStream(output_path, threads=_output_threads(threads)) as fo:
+        write_json(out, fo)
 
-    # Compress the output
-    run_cmds(['gzip', temp_fp])
-    temp_fp = temp_fp + '.gz'
 
-    if output_path.startswith('s3://'):
-        # Copy to S3
-        run_cmds([
-            'aws',
-            's3',
-            'cp',
-            '--quiet',
-            '--sse',
-            'AES256',
-            temp_fp,
-            output_path])
-        os.unlink(temp_fp)
+def return_file(local_fp, output_path, threads=None, keep=False):
+    """
+    Move a file to its output path (local, or in S3). With keep, the file
+    is copied instead.
+    """
+    if output_path.startswith("s3://"):
+        logging.info("Uploading {} to {}".format(local_fp, output_path))
+        copy_to_output(local_fp, output_path, threads=_output_threads(threads))
+        if not keep:
+            os.unlink(local_fp)
     else:
-        # Copy to local folder
-        run_cmds(['mv', temp_fp, output_path])
+        run_cmds(['cp' if keep else 'mv', local_fp, output_path])
+
 
+def _output_threads(threads):
+    """Number of threads used to compress and upload outputs."""
+    if threads is None:
+        threads = available_cpus()
+    return max(1, int(threads))
 
-def exit_and_clean_up(temp_folder):
-    """Log the error messages and delete the temporary folder."""
+
+def exit_and_clean_up(temp_folder, keep=False):
+    """
+    Log the error messages and delete the temporary folder (unless keep
+    is True, so that the run can be resumed from its checkpoints).
+    """
     # Capture the traceback
     logging.info("There was an unexpected failure")
     exc_type, exc_value, exc_traceback = sys.exc_info()
     for line in traceback.format_tb(exc_traceback):
         logging.info(line)
 
-    # Delete any files that were created for this sample
-    logging.info("Removing temporary folder: " + temp_folder)
-    shutil.rmtree(temp_folder)
+    if keep:
+        # Keep the files to resume from (with --work-dir)
+        logging.info("Keeping temporary folder: " + temp_folder)
+    else:
+        # Delete any files that were created for this sample
+        logging.info("Removing temporary folder: " + temp_folder)
+        shutil.rmtree(temp_folder)
 
     # Exit
     logging.info("Exit type: {}".format(exc_type))
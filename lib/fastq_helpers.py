@@ -2,22 +2,48 @@
 """Functions to help working with FASTQ files."""
 
 import os
+import glob
 import gzip
 import uuid
+import shutil
 import logging
+import itertools
 import subprocess
 from Bio.SeqIO.QualityIO import FastqGeneralIterator
 from Bio.SeqIO.FastaIO import SimpleFastaParser
 from lib.exec_helpers import run_cmds
+from lib.exec_helpers import command_exists
+from lib.stream_helpers import open_remote_stream
+from lib.timing_helpers import StageTimer
+
+# Size of the buffer used when reading and writing FASTQ files
+BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def cleaned_path(local_path, random_string):
+    """Path for the cleaned reads, with a random string added to the name."""
+    local_path = local_path.split('/')
+    if local_path[-1].endswith(".gz"):
+        local_path[-1] = local_path[-1].replace(".gz", "")
+    local_path[-1] = "{}-{}".format(random_string, local_path[-1])
+    return '/'.join(local_path)
 
 
 def get_reads_from_url(
     input_str,
     temp_folder,
-    random_string=str(uuid.uuid4())[:8]
+    random_string=str(uuid.uuid4())[:8],
+    threads=1,
+    timer=None
 ):
-    """Get a set of reads from a URL -- return the downloaded filepath."""
+    """
+    Get a set of reads from a URL -- return the downloaded filepath and
+    the number of reads and bases. The time taken to fetch the reads and
+    clean up the headers is recorded with a StageTimer.
+    """
     logging.info("Getting reads from {}".format(input_str))
+    if timer is None:
+        timer = StageTimer()
 
     filename = input_str.split('/')[-1]
     local_path = os.path.join(temp_folder, filename)
@@ -32,86 +58,118 @@ def get_reads_from_url(
         logging.info("Copying to temporary folder, cleaning up headers")
 
         # Add a random string to the filename
-        local_path = local_path.split('/')
-        if local_path[-1].endswith(".gz"):
-            local_path[-1] = local_path[-1].replace(".gz", "")
-        local_path[-1] = "{}-{}".format(random_string, local_path[-1])
-        local_path = '/'.join(local_path)
+        local_path = cleaned_path(local_path, random_string)
 
         # Make the FASTQ headers unique
-        clean_fastq_headers(input_str, local_path)
+        with timer.stage("header_cleanup"):
+            read_stats = clean_fastq_headers(input_str, local_path)
 
-        return local_path
+        return local_path, read_stats
 
-    # Get files from AWS S3
-    if input_str.startswith('s3://'):
-        logging.info("Getting reads from S3")
-        run_cmds([
-            'aws', 's3', 'cp', '--quiet', '--sse',
-            'AES256', input_str, temp_folder
-            ])
+    new_path = cleaned_path(local_path, random_string)
 
-    # Get files from an FTP server
-    elif input_str.startswith('ftp://'):
-        logging.info("Getting reads from FTP")
-        run_cmds(['wget', '-P', temp_folder, input_str])
+    # Stream files from AWS S3 or an FTP server straight into the cleanup
+    # (so the header cleanup is timed as part of fetching the reads)
+    if input_str.startswith(('s3://', 'ftp://')):
+        logging.info(
+            "Streaming {} to {}, cleaning up FASTQ headers".format(
+                input_str, new_path
+                )
+            )
+        with timer.stage("read_fetch"):
+            f_in = open_remote_stream(input_str, buffer_size=BUFFER_SIZE)
+            with open(new_path, "wb", BUFFER_SIZE) as f_out:
+                read_stats = clean_fastq_stream(f_in, f_out)
+            f_in.close()
 
     # Get files from SRA
     elif input_str.startswith('sra://'):
         accession = filename
         logging.info("Getting reads from SRA: " + accession)
-        local_path = get_sra(accession, temp_folder)
+        new_path = cleaned_path(local_path + ".fastq", random_string)
+        read_stats = get_sra(
+            accession, temp_folder, new_path, threads=threads, timer=timer
+        )
 
     else:
         raise Exception("Did not recognize prefix for input: " + input_str)
 
-    # Add a random string to the filename
-    new_path = local_path.split('/')
-    if new_path[-1].endswith(".gz"):
-        new_path[-1] = new_path[-1].replace(".gz", "")
-    new_path[-1] = "{}-{}".format(random_string, new_path[-1])
-    new_path = '/'.join(new_path)
-    logging.info(
-        "Copying {} to {}, cleaning up FASTQ headers".format(
-            local_path, new_path
-            )
-        )
-    clean_fastq_headers(local_path, new_path)
-    logging.info("Deleting old file: {}".format(local_path))
-    os.unlink(local_path)
-    return new_path
+    logging.info("Cleaned {:,} reads ({:,} bases)".format(
+        read_stats["reads"], read_stats["bases"]
+    ))
+    return new_path, read_stats
 
 
-def get_sra(accession, temp_folder):
-    """Get the FASTQ for an SRA accession."""
-    local_path = os.path.join(temp_folder, accession + ".fastq")
+def get_sra(accession, temp_folder, fp_out, threads=1, timer=None):
+    """
+    Get the FASTQ for an SRA accession, writing the reads from all of the
+    mate files to a single file with clean headers.
+    """
+    if timer is None:
+        timer = StageTimer()
 
+    # Download the SRA archive
     logging.info("Downloading {} from SRA".format(accession))
-    run_cmds([
-        "fastq-dump",
-        "--split-files",
-        "--outdir",
-        temp_folder, accession
-    ])
-
-    # Combine any multiple files that were found
-    logging.info("Concatenating output files")
-    with open(local_path + ".temp", "wt") as fo:
-        cmd = "cat {}/{}*fastq".format(temp_folder, accession)
-        cat = subprocess.Popen(cmd, shell=True, stdout=fo)
-        cat.wait()
-
-    # Clean up the FASTQ headers for the downloaded file
-    if os.path.exists(local_path + ".temp"):
-        run_cmds(["mv", local_path + ".temp", local_path])
-
-    # Check to see if the file was downloaded
+    with timer.stage("read_fetch"):
+        run_cmds([
+            "prefetch",
+            "--output-directory", temp_folder,
+            accession
+        ])
+    sra_fp = glob.glob(os.path.join(temp_folder, accession + "*.sra"))
+    sra_fp += glob.glob(os.path.join(temp_folder, accession, accession + "*.sra"))
     msg = "File could not be downloaded from SRA: {}".format(accession)
-    assert os.path.exists(local_path), msg
+    assert len(sra_fp) == 1, msg
+    sra_fp = sra_fp[0]
+
+    # Extract the reads with multiple threads, writing every read from
+    # each spot to STDOUT
+    if command_exists("fasterq-dump"):
+        commands = [
+            "fasterq-dump",
+            "--stdout",
+            "--split-spot",
+            "--threads", str(threads),
+            "--temp", temp_folder,
+            sra_fp
+        ]
+    else:
+        commands = [
+            "fastq-dump",
+            "--stdout",
+            "--split-spot",
+            sra_fp
+        ]
+    logging.info("Commands:")
+    logging.info(' '.join(commands))
+
+    # Clean up the headers as the reads are extracted
+    stderr_fp = os.path.join(temp_folder, accession + ".log")
+    with timer.stage("header_cleanup"), open(stderr_fp, "wt") as stderr:
+        proc = subprocess.Popen(commands,
+                                stdout=subprocess.PIPE,
+                                stderr=stderr,
+                                bufsize=BUFFER_SIZE)
+        with open(fp_out, "wb", BUFFER_SIZE) as f_out:
+            read_stats = clean_fastq_stream(proc.stdout, f_out)
+        proc.stdout.close()
+        exitcode = proc.wait()
+
+    logging.info("Standard error of subprocess:")
+    with open(stderr_fp, "rt") as f:
+        for line in f:
+            logging.info(line.rstrip("\n"))
+    os.unlink(stderr_fp)
+    assert exitcode == 0, "Exit code {}".format(exitcode)
+    assert read_stats["reads"] > 0, msg
+
+    # Remove the SRA archive
+    os.unlink(sra_fp)
+    if os.path.isdir(os.path.join(temp_folder, accession)):
+        shutil.rmtree(os.path.join(temp_folder, accession))
 
-    # Return the path to the file
     logging.info("Done fetching " + accession)
-    return local_path
+    return read_stats
 
 
 def count_fasta_reads(fp):
@@ -147,8 +205,26 @@ def count_fastq_reads(fp):
     return n
 
 
-def clean_fastq_headers(fp_in, fp_out):
-    """Read in a FASTQ file and write out a copy with unique headers."""
+def open_fastq(fp_in, buffer_size=BUFFER_SIZE):
+    """Open a FASTQ file for reading in binary, decompressing if needed."""
+    if not fp_in.endswith(".gz"):
+        return open(fp_in, "rb", buffer_size), None
+
+    # Decompress in a separate process with pigz, if it is available
+    if command_exists("pigz"):
+        proc = subprocess.Popen(["pigz", "-dc", fp_in],
+                                stdout=subprocess.PIPE,
+                                bufsize=buffer_size)
+        return proc.stdout, proc
+
+    return gzip.open(fp_in, "rb"), None
+
+
+def clean_fastq_stream(f_in, f_out):
+    """
+    Copy FASTQ records from one handle to another with unique headers,
+    returning the number of reads and bases.
+    """
 
     # Constraints
     # 1. Headers start with '@'
@@ -158,53 +234,112 @@ def clean_fastq_headers(fp_in, fp_out):
     # 5. Spacer lines match the header line
     # 6. Quality lines are not empty
 
-    if fp_in.endswith(".gz"):
-        f_in = gzip.open(fp_in, "rt")
-    else:
-        f_in = open(fp_in, "rt")
+    n_reads = 0
+    n_bases = 0
+    buffer = []
 
-    if fp_out.endswith(".gz"):
-        f_out = gzip.open(fp_out, "wt")
-    else:
-        f_out = open(fp_out, "wt")
+    lines = iter(f_in)
+    for header in lines:
+        # Line endings may be LF or CRLF, and are written out as LF
+        header = header.rstrip(b"\r\n")
 
-    # Keep track of the line number
-    for ix, line in enumerate(f_in):
-        # Get the line position 0-3
-        mod = ix % 4
+        # Skip lines that are blank (at the end of the file)
+        if len(header) == 0:
+            continue
 
-        if mod == 0:
-            # Skip lines that are blank (at the end of the file)
-            if len(line) == 1:
-                continue
-            # 1. Headers start with '@'
-            assert line[0] == '@', "Header lacks '@' ({})".format(line)
+        try:
+            seq = next(lines).rstrip(b"\r\n")
+            spacer = next(lines).rstrip(b"\r\n")
+            qual = next(lines).rstrip(b"\r\n")
+        except StopIteration:
+            raise AssertionError("Incomplete FASTQ record ({})".format(header))
+
+        # 1. Headers start with '@'
+        assert header[:1] == b'@', "Header lacks '@' ({})".format(header)
+
+        # 2. Strip to the first whitespace
+        header = header.split(b" ")[0].split(b"\t")[0]
+
+        # 3. Add a unique read number and the newline
+        n_reads += 1
+        header = header + "-r{}\n".format(n_reads).encode()
+
+        # 4. Sequence lines are not empty
+        assert len(seq) > 0
+        n_bases += len(seq)
+
+        # 5. Spacer lines start with '+' and match the header
+        assert spacer[:1] == b"+"
+
+        # 6. Quality lines are not empty
+        assert len(qual) > 0
 
-            # 2. Strip to the first whitespace
-            line = line.rstrip("\n").split(" ")[0].split("\t")[0]
+        buffer.extend([header, seq, b"\n+", header[1:], qual, b"\n"])
 
-            # 3. Add a unique line number and the newline
-            line = "{}-r{}\n".format(line, 1 + (ix / 4))
+        # Write out the records in batches
+        if len(buffer) >= 50000:
+            f_out.write(b"".join(buffer))
+            buffer = []
 
-            # Save the header to use for the spacer line
-            header = line[1:]
+    f_out.write(b"".join(buffer))
 
-        elif mod == 1:
-            # 4. Sequence lines are not empty
-            assert len(line) > 1
+    return {"reads": n_reads, "bases": n_bases}
 
-        elif mod == 2:
-            # 5. Spacer lines start with '+' and match the header
-            assert line[0] == "+"
-            line = "+" + header
 
-        elif mod == 3:
-            # 6. Quality lines are not empty
-            assert len(line) > 1
+def clean_fastq_headers(fp_in, fp_out):
+    """
+    Read in a FASTQ file and write out a copy with unique headers,
+    returning the number of reads and bases.
+    """
+
+    f_in, proc = open_fastq(fp_in)
+
+    if fp_out.endswith(".gz"):
+        f_out = gzip.open(fp_out, "wb")
+    else:
+        f_out = open(fp_out, "wb", BUFFER_SIZE)
 
-        # Write out the line
-        f_out.write(line)
+    read_stats = clean_fastq_stream(f_in, f_out)
 
     # Close the input and output file handles
     f_in.close()
     f_out.close()
+    if proc is not None:
+        assert proc.wait() == 0, "Could not decompress {}".format(fp_in)
+
+    logging.info("Cleaned {:,} reads ({:,} bases)".format(
+        read_stats["reads"], read_stats["bases"]
+    ))
+
+    return read_stats
+
+
+def split_fastq(fp_in, n_chunks, n_reads, chunks=None):
+    """
+    Split a cleaned FASTQ file (four lines per read) into chunks with a
+    similar number of reads, writing out only the chunks listed (default:
+    all of them). Returns the path and number of reads for each chunk
+    which was written.
+    """
+    if chunks is None:
+        chunks = list(range(n_chunks))
+    bounds = [n_reads * ix // n_chunks for ix in range(n_chunks + 1)]
+    prefix = fp_in[:-len(".fastq")] if fp_in.endswith(".fastq") else fp_in
+
+    chunk_fps = []
+    with open(fp_in, "rb", BUFFER_SIZE) as f:
+        for ix in range(max(chunks) + 1):
+            lines = itertools.islice(f, 4 * (bounds[ix + 1] - bounds[ix]))
+            if ix not in chunks:
+                for line in lines:
+                    pass
+                continue
+
+            fp_out = "{}.{}.fastq".format(prefix, ix)
+            with open(fp_out, "wb", BUFFER_SIZE) as fo:
+                fo.writelines(lines)
+            n = bounds[ix + 1] - bounds[ix]
+            logging.info("Wrote {:,} reads to {}".format(n, fp_out))
+            chunk_fps.append((fp_out, n))
+
+    return chunk_fps
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+"""Functions to format the IMG/VR reference data for use with map_viruses."""
+
+import gzip
+import logging
+import numpy as np
+import pandas as pd
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from lib.manifest_helpers import content_hash
+from lib.metadata_helpers import encode_strings
+from lib.metadata_helpers import write_metadata_columns
+
+
+def read_img_vr_metadata(fp):
+    """Read the metadata for each genome (mVCs) from IMG/VR."""
+    metadata = pd.read_table(fp)
+    assert metadata.shape[0] == metadata["mVCs"].unique().shape[0]
+    return metadata
+
+
+def genome_ids(headers):
+    """The genome for each protein, from the first two fields of the header."""
+    return pd.Series(headers, dtype=object).str.split(
+        "_____"
+    ).str[:2].str.join("_____").values
+
+
+def scan_faa(fp, chunk_size=1000000):
+    """
+    Yield the name, length and hashes of the proteins in a FASTA file (which
+    may be gzip compressed), a chunk of proteins at a time. Sequences are
+    not kept.
+    """
+    handle = gzip.open(fp, "rt") if fp.endswith(".gz") else open(fp, "rt")
+    chunk = {"protein": [], "length": [], "record_hash": [], "sequence_hash": []}
+    n_proteins = 0
+    with handle:
+        for header, seq in SimpleFastaParser(handle):
+            chunk["protein"].append(header)
+            chunk["length"].append(len(seq))
+            chunk["sequence_hash"].append(content_hash(seq))
+            chunk["record_hash"].append(content_hash(header + "\n" + seq))
+            if len(chunk["protein"]) == chunk_size:
+                n_proteins += chunk_size
+                logging.info("Read in {:,} proteins".format(n_proteins))
+                yield chunk
+                chunk = {k: [] for k in chunk}
+    if len(chunk["protein"]) > 0:
+        yield chunk
+
+
+def index_img_vr(metadata_fp, faa_fp, prefix, chunk_size=1000000):
+    """
+    Write the metadata for every protein in IMG/VR (prefix.tsv) and the
+    metadata index (prefix.idx), returning the manifest of every protein.
+
+    The proteins are read a chunk at a time, keeping only their name,
+    length, hashes and the row of their genome in the metadata. The genome
+    metadata is joined to each chunk by index as it is written to the TSV,
+    and is stored once per genome in the index, so that memory does not
+    grow with the number of proteins times the width of the metadata.
+    """
+    logging.info("Reading in " + metadata_fp)
+    metadata = read_img_vr_metadata(metadata_fp)
+    genome_index = pd.Index(metadata["mVCs"].values)
+    metadata = metadata.drop("mVCs", axis=1)
+
+    tsv_fp = prefix + ".tsv"
+    logging.info("Reading in {} and writing to {}".format(faa_fp, tsv_fp))
+    proteins, lengths, genome_rows = [], [], []
+    hashes = {"record_hash": [], "sequence_hash": []}
+    with open(tsv_fp, "wt") as fo:
+        for chunk in scan_faa(faa_fp, chunk_size=chunk_size):
+            genome = genome_ids(chunk["protein"])
+            genome_row = genome_index.get_indexer(genome)
+
+            # Make sure we have metadata for every genome
+            missing = genome_row < 0
+            assert not missing.any(), "No metadata for " + genome[missing][0]
+
+            length = np.array(chunk["length"], dtype=np.int64)
+            dat = metadata.iloc[genome_row].reset_index(drop=True)
+            dat.insert(0, "genome", genome)
+            dat.insert(0, "length", length)
+            dat.insert(0, "protein", chunk["protein"])
+            dat.to_csv(fo, sep="\t", index=False, header=len(proteins) == 0)
+
+            proteins.append(encode_strings(chunk["protein"]))
+            lengths.append(length)
+            genome_rows.append(genome_row)
+            for k in hashes:
+                hashes[k].append(encode_strings(chunk[k]))
+
+    # Combine the chunks
+    empty = encode_strings([])
+    protein = np.concatenate(proteins + [empty])
+    length = np.concatenate(lengths + [np.zeros(0, dtype=np.int64)])
+    genome_row = np.concatenate(genome_rows + [np.zeros(0, dtype=np.int64)])
+    manifest = {"protein": protein}
+    for k in hashes:
+        manifest[k] = np.concatenate(hashes[k] + [empty])
+
+    # The genome of each protein is kept as its row in the metadata, which
+    # is stored as typed arrays with one value per genome
+    columns = [
+        ("protein", protein, np.zeros(protein.shape[0], dtype=bool)),
+        ("length", length, None),
+        ("genome", genome_row, None),
+    ]
+    genome_columns = []
+    for k in metadata.columns:
+        col = metadata[k]
+        if col.dtype.kind in "biuf":
+            genome_columns.append((k, col.values, None))
+        else:
+            isnull = col.isnull().values
+            genome_columns.append((k, encode_strings([
+                "" if n else v for v, n in zip(col.values, isnull)
+            ]), isnull))
+
+    write_metadata_columns(
+        columns,
+        prefix + ".idx",
+        genomes=encode_strings(genome_index.values),
+        genome_columns=genome_columns,
+    )
+    return manifest
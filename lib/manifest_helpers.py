@@ -0,0 +1,132 @@
+#!/usr/bin/python
+"""Functions to record the contents of a reference database, so that it can be updated in place."""
+
+import json
+import hashlib
+import logging
+import numpy as np
+from lib.metadata_helpers import encode_strings
+from lib.metadata_helpers import decode_strings
+from lib.store_helpers import ArrayStore
+from lib.store_helpers import write_arrays
+
+# Names and hashes stored for every protein in a manifest
+MANIFEST_STRINGS = ["protein", "record_hash", "sequence_hash"]
+
+
+def content_hash(text):
+    """Hash of a string (e.g. a single record or sequence)."""
+    if not isinstance(text, bytes):
+        text = text.encode("utf-8")
+    return hashlib.md5(text).hexdigest()
+
+
+def file_hash(fp, chunk_size=4 * 1024 * 1024):
+    """Hash of the contents of a file."""
+    h = hashlib.md5()
+    with open(fp, "rb") as f:
+        while True:
+            data = f.read(chunk_size)
+            if len(data) == 0:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def _as_strings(values):
+    """Encode a list of strings, unless it is already a bytes array."""
+    if isinstance(values, np.ndarray) and values.dtype.kind == "S":
+        return values
+    return encode_strings(values)
+
+
+def write_manifest(fp, manifest, attrs=None):
+    """
+    Write a manifest with the name, record hash and sequence hash of every
+    protein in a database (plus any other per-protein arrays).
+    """
+    for k in MANIFEST_STRINGS:
+        assert k in manifest, "Manifest must include {}".format(k)
+    logging.info("Writing manifest for {:,} proteins to {}".format(
+        len(manifest["protein"]), fp
+    ))
+    return write_arrays(fp, {
+        k: _as_strings(v) if k in MANIFEST_STRINGS else np.asarray(v)
+        for k, v in manifest.items()
+    }, attrs=attrs)
+
+
+def read_manifest(fp):
+    """
+    Read a manifest from write_manifest, returning (manifest, attrs), with
+    names and hashes as bytes arrays.
+    """
+    store = ArrayStore(fp)
+    manifest = {k: np.array(store[k]) for k in store.keys()}
+    return manifest, store.attrs
+
+
+def _lookup(names, query):
+    """Position of each query in names (-1 if missing)."""
+    if names.shape[0] == 0:
+        return np.zeros(query.shape[0], dtype=np.int64) - 1
+    order = np.argsort(names, kind="mergesort")
+    pos = np.minimum(np.searchsorted(names[order], query), names.shape[0] - 1)
+    return np.where(names[order][pos] == query, order[pos], -1)
+
+
+def diff_manifests(old, new):
+    """
+    Compare the proteins in two manifests, returning the proteins which
+    were added, removed or changed, and whether the set of protein
+    sequences (which is all that DIAMOND indexes) has changed.
+    """
+    if old is None:
+        old = {k: [] for k in MANIFEST_STRINGS}
+    old = {k: _as_strings(old[k]) for k in MANIFEST_STRINGS}
+    new = {k: _as_strings(new[k]) for k in MANIFEST_STRINGS}
+
+    # Match up the proteins in each manifest by name
+    old_ix = _lookup(old["protein"], new["protein"])
+    new_ix = _lookup(new["protein"], old["protein"])
+    found = old_ix >= 0
+    changed = found.copy()
+    changed[found] = old["record_hash"][old_ix[found]] != new["record_hash"][found]
+    sequence_changed = (
+        old["sequence_hash"][old_ix[found]] != new["sequence_hash"][found]
+    )
+
+    diff = {
+        "added": decode_strings(new["protein"][~found]),
+        "removed": decode_strings(old["protein"][new_ix < 0]),
+        "changed": decode_strings(new["protein"][changed]),
+        "sequences_changed": bool(
+            (~found).any() or (new_ix < 0).any() or sequence_changed.any()
+        ),
+    }
+    logging.info(
+        "Database changes: {:,} proteins added, {:,} removed, {:,} changed "
+        "({:,} unchanged), sequences {}".format(
+            len(diff["added"]), len(diff["removed"]), len(diff["changed"]),
+            int(found.sum()) - len(diff["changed"]),
+            "changed" if diff["sequences_changed"] else "unchanged",
+        )
+    )
+    return diff
+
+
+def unchanged_diff():
+    """The diff for a database whose inputs have not changed."""
+    return {
+        "added": [],
+        "removed": [],
+        "changed": [],
+        "sequences_changed": False,
+    }
+
+
+def write_diff(fp, diff):
+    """Write the changes made to a database as JSON."""
+    logging.info("Writing database changes to {}".format(fp))
+    with open(fp, "wt") as fo:
+        json.dump(diff, fo, indent=4)
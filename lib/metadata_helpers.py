@@ -0,0 +1,226 @@
+#!/usr/bin/python
+"""Functions to build and query a binary index of the protein metadata."""
+
+import logging
+import numpy as np
+import pandas as pd
+from lib.aln_helpers import encode_strings
+from lib.aln_helpers import SubjectVocabulary
+from lib.store_helpers import ArrayStore
+from lib.store_helpers import write_arrays
+
+
+def decode_strings(values):
+    """Decode a fixed-width bytes array into a list of strings."""
+    return [v.decode("utf-8") for v in values]
+
+
+def write_metadata_index(metadata, fp):
+    """Write a metadata table to a memory-mappable index."""
+    columns = []
+    for k in metadata.columns:
+        col = metadata[k]
+        if col.dtype.kind in "biuf":
+            columns.append((k, col.values, None))
+        else:
+            isnull = col.isnull().values
+            columns.append((k, encode_strings([
+                "" if n else v for v, n in zip(col.values, isnull)
+            ]), isnull))
+    return write_metadata_columns(columns, fp)
+
+
+def write_metadata_columns(columns, fp, genomes=None, genome_columns=None):
+    """
+    Write a metadata table to a memory-mappable index, given as a list of
+    (name, values, isnull) for each column. Text columns are encoded with
+    encode_strings (with isnull marking missing values), and isnull is None
+    for numeric columns.
+
+    If genomes (a bytes array of genome names) is given, the genome column
+    holds the position of each protein's genome in genomes, and the columns
+    in genome_columns (in the same format) hold the values for each genome
+    in that order. Those columns are stored once per genome, rather than
+    once per protein.
+    """
+    genome_columns = [] if genome_columns is None else genome_columns
+    names = [k for k, values, isnull in columns]
+    for k in ["protein", "genome", "length"]:
+        assert k in names, "Metadata must have a {} column".format(k)
+    values = dict([(k, v) for k, v, isnull in columns])
+    isnulls = dict([(k, isnull) for k, v, isnull in columns])
+    nrows = values["protein"].shape[0]
+    msg = "Protein names must be unique"
+    assert np.unique(values["protein"]).shape[0] == nrows, msg
+
+    logging.info("Writing metadata index to {}".format(fp))
+
+    arrays = {}
+    column_info = []
+
+    # Rows are grouped by genome, keeping the original order within each
+    if genomes is None:
+        genome = values["genome"]
+        if genome.dtype.kind != "S":
+            genome = encode_strings(genome)
+        if isnulls["genome"] is not None and isnulls["genome"].any():
+            # Proteins without a genome are grouped together (as "nan")
+            genome = np.where(
+                isnulls["genome"], encode_strings(["nan"]), genome
+            )
+        genome_names, genome_code = np.unique(genome, return_inverse=True)
+    else:
+        # Only keep the genomes with proteins, sorted by name
+        assert all(
+            v.shape[0] == genomes.shape[0] for k, v, isnull in genome_columns
+        ), "Expected one value per genome"
+        used = np.unique(values["genome"])
+        used = used[np.argsort(genomes[used], kind="mergesort")]
+        code = np.zeros(genomes.shape[0], dtype=np.int64)
+        code[used] = np.arange(used.shape[0])
+        genome_names, genome_code = genomes[used], code[values["genome"]]
+
+    # Each column is stored in its own array, with one value per protein,
+    # or one per genome for the genome columns (if genomes were given)
+    stored = [(k, col, isnull, False) for k, col, isnull in columns]
+    if genomes is not None:
+        stored = [
+            (k, genome_names, np.zeros(genome_names.shape[0], dtype=bool), True)
+            if k == "genome" else (k, col, isnull, per_genome)
+            for k, col, isnull, per_genome in stored
+        ] + [
+            (k, col[used], None if isnull is None else isnull[used], True)
+            for k, col, isnull in genome_columns
+        ]
+    for ix, (k, col, isnull, per_genome) in enumerate(stored):
+        arrays["column_{}".format(ix)] = col
+        if isnull is None:
+            info = {"name": k, "strings": False, "nullable": False}
+        else:
+            info = {"name": k, "strings": True, "nullable": bool(isnull.any())}
+            if isnull.any():
+                arrays["column_{}_isnull".format(ix)] = isnull
+        if per_genome:
+            info["per_genome"] = True
+        column_info.append(info)
+
+    # Sorted protein names are used to look up the row for each protein
+    proteins = values["protein"]
+    if proteins.dtype.kind != "S":
+        proteins = encode_strings(proteins)
+    order = np.argsort(proteins, kind="mergesort")
+    arrays["protein_sorted"] = proteins[order]
+    arrays["protein_sorted_row"] = order.astype(np.int64)
+
+    n_genomes = genome_names.shape[0]
+    arrays["genome"] = genome_names
+    arrays["protein_genome"] = genome_code.astype(np.int32)
+    arrays["genome_row"] = np.argsort(
+        genome_code, kind="mergesort"
+    ).astype(np.int64)
+    nproteins = np.bincount(genome_code, minlength=n_genomes)
+    arrays["genome_offset"] = np.concatenate([[0], np.cumsum(nproteins)])
+    arrays["genome_nproteins"] = nproteins.astype(np.int64)
+    arrays["genome_length"] = np.bincount(
+        genome_code,
+        weights=values["length"],
+        minlength=n_genomes
+    ).astype(np.int64)
+
+    write_arrays(fp, arrays, attrs={
+        "columns": column_info,
+        "nrows": int(nrows),
+    })
+    logging.info("Indexed {:,} proteins from {:,} genomes".format(
+        nrows, n_genomes
+    ))
+    return fp
+
+
+class MetadataIndex(object):
+    """Memory-mapped lookups against an index from write_metadata_index."""
+
+    def __init__(self, fp):
+        self.store = ArrayStore(fp)
+        self.columns = self.store.attrs["columns"]
+        self.nrows = self.store.attrs["nrows"]
+
+    def __len__(self):
+        return self.nrows
+
+    def protein_rows(self, proteins):
+        """Return the row for each protein (-1 if it is not indexed)."""
+        proteins = encode_strings(proteins)
+        if proteins.shape[0] == 0 or self.nrows == 0:
+            return np.zeros(proteins.shape[0], dtype=np.int64) - 1
+        sorted_names = self.store["protein_sorted"]
+        pos = np.searchsorted(sorted_names, proteins)
+        pos = np.minimum(pos, self.nrows - 1)
+        found = sorted_names[pos] == proteins
+        return np.where(found, self.store["protein_sorted_row"][pos], -1)
+
+    def protein_genomes(self, proteins):
+        """Return the genome for each protein."""
+        rows = self.protein_rows(proteins)
+        assert (rows >= 0).all(), "Protein not found in metadata index"
+        return decode_strings(
+            self.store["genome"][self.store["protein_genome"][rows]]
+        )
+
+    def genome_rows(self, genome_codes):
+        """Return all of the rows for a set of genomes, in table order."""
+        offsets = self.store["genome_offset"]
+        genome_row = self.store["genome_row"]
+        rows = [
+            genome_row[offsets[g]:offsets[g + 1]]
+            for g in genome_codes
+        ]
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.sort(np.concatenate(rows))
+
+    def rows(self, rows):
+        """Return a DataFrame with a subset of rows from the table."""
+        rows = np.asarray(rows, dtype=np.int64)
+        dat = {}
+        for ix, col in enumerate(self.columns):
+            # Some columns may be stored once for each genome
+            col_rows = rows
+            if col.get("per_genome"):
+                col_rows = self.store["protein_genome"][rows]
+            values = self.store["column_{}".format(ix)][col_rows]
+            if col["strings"]:
+                values = pd.Series(decode_strings(values), dtype=object)
+                if col["nullable"]:
+                    isnull = self.store["column_{}_isnull".format(ix)][col_rows]
+                    values[isnull] = np.nan
+            else:
+                values = pd.Series(np.array(values))
+            dat[col["name"]] = values
+        return pd.DataFrame(dat, columns=[col["name"] for col in self.columns])
+
+    def vocabulary(self):
+        """Index of every protein, for use by the alignment parser."""
+        return SubjectVocabulary(self.store["protein_sorted"])
+
+    def detected_metadata(self, proteins):
+        """Return the rows for every genome with any of these proteins."""
+        rows = self.protein_rows(proteins)
+        rows = rows[rows >= 0]
+        genome_codes = np.unique(self.store["protein_genome"][rows])
+        return self.rows(self.genome_rows(genome_codes))
+
+
+def metadata_vocabulary(metadata):
+    """Index of every protein in a metadata table or index."""
+    if isinstance(metadata, MetadataIndex):
+        return metadata.vocabulary()
+    return SubjectVocabulary(np.sort(encode_strings(metadata["protein"].values)))
+
+
+def load_metadata(fp):
+    """Open a metadata index (.idx), or read in a metadata TSV."""
+    if fp.endswith(".idx"):
+        logging.info("Opening metadata index")
+        return MetadataIndex(fp)
+    return pd.read_table(fp, sep='\t')
@@ -0,0 +1,305 @@
+#!/usr/bin/python
+"""Functions to write outputs as streams, compressed and uploaded as they are written."""
+
+import os
+import json
+import zlib
+import logging
+from multiprocessing.pool import ThreadPool
+
+# S3 parts must be at least 5MB (except for the last part)
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# Number of list elements serialized at once by write_json
+JSON_LIST_CHUNK = 1000
+
+
+class LocalFileWriter(object):
+    """
+    Write to a local file, which is only moved into place once it has
+    been written completely.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.temp_fp = fp + ".temp"
+        self.handle = open(self.temp_fp, "wb")
+
+    def write(self, data):
+        self.handle.write(data)
+
+    def close(self):
+        self.handle.close()
+        os.rename(self.temp_fp, self.fp)
+
+    def abort(self):
+        self.handle.close()
+        os.unlink(self.temp_fp)
+
+
+class S3MultipartWriter(object):
+    """
+    Upload to S3 as the data is written, sending parts of the object
+    concurrently with a multipart upload. Objects smaller than a single
+    part are uploaded in one request.
+    """
+
+    def __init__(self, url, client=None, part_size=8 * 1024 * 1024,
+                 threads=4, extra_args=None):
+        assert url.startswith("s3://"), "Not an S3 URL: {}".format(url)
+        assert part_size >= MIN_PART_SIZE, "Parts must be at least 5MB"
+        if client is None:
+            import boto3
+            client = boto3.client("s3")
+        self.client = client
+        self.bucket, self.key = url[5:].split("/", 1)
+        self.url = url
+        self.part_size = part_size
+        self.threads = threads
+        if extra_args is None:
+            extra_args = {"ServerSideEncryption": "AES256"}
+        self.extra_args = extra_args
+
+        self.buffer = []
+        self.buffered = 0
+        self.upload_id = None
+        self.pool = None
+        self.pending = []
+        self.parts = []
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        while self.buffered >= self.part_size:
+            data = b"".join(self.buffer)
+            self.buffer = [data[self.part_size:]]
+            self.buffered = len(self.buffer[0])
+            self._upload_part(data[:self.part_size])
+
+    def _upload_part(self, data):
+        """Start uploading a part, waiting if too many are in progress."""
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **self.extra_args
+            )["UploadId"]
+            self.pool = ThreadPool(self.threads)
+
+        # Limit the memory used by parts waiting to be uploaded
+        while len(self.pending) >= 2 * self.threads:
+            self._finish_part()
+
+        part_number = len(self.parts) + len(self.pending) + 1
+        self.pending.append((part_number, self.pool.apply_async(
+            self.client.upload_part,
+            (),
+            dict(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                PartNumber=part_number,
+                Body=data,
+            )
+        )))
+
+    def _finish_part(self):
+        """Wait for the oldest part in progress to be uploaded."""
+        part_number, result = self.pending.pop(0)
+        self.parts.append({
+            "PartNumber": part_number,
+            "ETag": result.get()["ETag"],
+        })
+
+    def close(self):
+        data = b"".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+
+        if self.upload_id is None:
+            self.client.put_object(
+                Bucket=self.bucket, Key=self.key, Body=data, **self.extra_args
+            )
+            logging.info("Uploaded {:,} bytes to {}".format(len(data), self.url))
+            return
+
+        try:
+            if len(data) > 0:
+                self._upload_part(data)
+            while len(self.pending) > 0:
+                self._finish_part()
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts},
+            )
+        except Exception:
+            self.abort()
+            raise
+        self._close_pool()
+        logging.info("Uploaded {:,} parts to {}".format(
+            len(self.parts), self.url
+        ))
+
+    def abort(self):
+        """Stop the upload, so that no partial object is left in S3."""
+        self.buffer = []
+        if self.upload_id is not None:
+            self._close_pool()
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+            )
+            self.upload_id = None
+
+    def _close_pool(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.pending = []
+
+
+class ParallelGzipWriter(object):
+    """
+    Compress data in blocks with a pool of threads (zlib releases the GIL),
+    writing each block to the output in order as a separate gzip member.
+    Files with multiple members can be read by gzip and GzipStreamReader.
+    """
+
+    def __init__(self, sink, threads=4, block_size=4 * 1024 * 1024, level=6):
+        self.sink = sink
+        self.threads = threads
+        self.block_size = block_size
+        self.level = level
+        self.pool = ThreadPool(threads)
+        self.pending = []
+        self.n_blocks = 0
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        while self.buffered >= self.block_size:
+            data = b"".join(self.buffer)
+            self.buffer = [data[self.block_size:]]
+            self.buffered = len(self.buffer[0])
+            self._compress_block(data[:self.block_size])
+
+    def _compress_block(self, data):
+        self.n_blocks += 1
+        # Limit the memory used by blocks waiting to be written
+        while len(self.pending) >= 2 * self.threads:
+            self.sink.write(self.pending.pop(0).get())
+        self.pending.append(
+            self.pool.apply_async(_gzip_member, (data, self.level))
+        )
+
+    def close(self):
+        try:
+            data = b"".join(self.buffer)
+            self.buffer = []
+            self.buffered = 0
+            # Empty outputs still need a single (empty) gzip member
+            if len(data) > 0 or self.n_blocks == 0:
+                self._compress_block(data)
+            while len(self.pending) > 0:
+                self.sink.write(self.pending.pop(0).get())
+        except Exception:
+            self.abort()
+            raise
+        self._close_pool()
+        self.sink.close()
+
+    def abort(self):
+        self._close_pool()
+        self.sink.abort()
+
+    def _close_pool(self):
+        self.pool.close()
+        self.pool.join()
+        self.pending = []
+
+
+def _gzip_member(data, level):
+    """Compress a block of data as a complete gzip member."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class OutputStream(object):
+    """
+    Write a file to a local path or S3, compressing it (if the path ends
+    with .gz) as it is written. Used as a context manager, the output is
+    only completed if no exception is raised.
+    """
+
+    def __init__(self, output_path, threads=4, client=None, compress=None):
+        if output_path.startswith("s3://"):
+            self.writer = S3MultipartWriter(
+                output_path, client=client, threads=threads
+            )
+        else:
+            self.writer = LocalFileWriter(output_path)
+        if compress is None:
+            compress = output_path.endswith(".gz")
+        if compress:
+            self.writer = ParallelGzipWriter(self.writer, threads=threads)
+
+    def write(self, data):
+        self.writer.write(data)
+
+    def close(self):
+        self.writer.close()
+
+    def abort(self):
+        self.writer.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_json(obj, fo, chunk_size=JSON_LIST_CHUNK):
+    """
+    Serialize an object as JSON (matching json.dumps, for dicts with string
+    keys) to a binary handle in pieces, so that the whole document is never
+    held in memory. Lists are serialized a chunk of elements at a time.
+    """
+    if isinstance(obj, dict):
+        fo.write(b"{")
+        for i, (k, v) in enumerate(obj.items()):
+            if i > 0:
+                fo.write(b", ")
+            fo.write(json.dumps(k).encode("utf-8") + b": ")
+            write_json(v, fo, chunk_size=chunk_size)
+        fo.write(b"}")
+    elif isinstance(obj, list) and len(obj) > chunk_size:
+        fo.write(b"[")
+        for start in range(0, len(obj), chunk_size):
+            if start > 0:
+                fo.write(b", ")
+            fo.write(
+                json.dumps(obj[start:start + chunk_size])[1:-1].encode("utf-8")
+            )
+        fo.write(b"]")
+    else:
+        fo.write(json.dumps(obj).encode("utf-8"))
+
+
+def copy_to_output(local_fp, output_path, threads=4, client=None,
+                   compress=False, chunk_size=4 * 1024 * 1024):
+    """Copy a local file to an output path, optionally compressing it."""
+    with OutputStream(
+        output_path, threads=threads, client=client, compress=compress
+    ) as fo:
+        with open(local_fp, "rb") as f:
+            while True:
+                data = f.read(chunk_size)
+                if len(data) == 0:
+                    break
+                fo.write(data)
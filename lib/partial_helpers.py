@@ -0,0 +1,74 @@
+#!/usr/bin/python
+"""Functions to save and combine the partial results for shards of a sample."""
+
+import logging
+from lib.aln_helpers import partial_arrays
+from lib.aln_helpers import make_accumulators
+from lib.aln_helpers import merge_partial_arrays
+from lib.store_helpers import ArrayStore
+from lib.store_helpers import write_arrays
+
+# Attributes which must be the same for every shard of a sample
+SHARED_ATTRS = [
+    "input", "n_shards", "multimapping", "quantiles", "ref_db_url",
+    "total_reads", "total_bases",
+]
+
+
+def parse_shard(shard):
+    """Parse a shard given as "i/N" (counting from 0)."""
+    fields = shard.split("/")
+    msg = "Shard must be formatted as i/N, e.g. 0/4 ({})".format(shard)
+    assert len(fields) == 2 and all(f.isdigit() for f in fields), msg
+    ix, n_shards = int(fields[0]), int(fields[1])
+    msg = "Shard must be between 0 and N-1 ({})".format(shard)
+    assert 0 <= ix < n_shards, msg
+    return ix, n_shards
+
+
+def write_partial(fp, acc, assigner, attrs):
+    """
+    Write the alignments accumulated for one shard of a sample (before
+    they are summarized), with attributes describing the shard.
+    """
+    for k in SHARED_ATTRS + ["shard", "nalignments"]:
+        assert k in attrs, "Partial results must include {}".format(k)
+    logging.info("Writing partial results for shard {} of {} to {}".format(
+        attrs["shard"], attrs["n_shards"], fp
+    ))
+    return write_arrays(fp, partial_arrays(acc, assigner), attrs=attrs)
+
+
+def merge_partials(fps, vocabulary=None):
+    """
+    Combine the partial results for every shard of a sample, returning the
+    accumulators and the attributes of each shard (in order).
+    """
+    assert len(fps) > 0, "No partial results to merge"
+    stores = [ArrayStore(fp) for fp in fps]
+    stores.sort(key=lambda store: store.attrs["shard"])
+    attrs = [store.attrs for store in stores]
+
+    # Make sure that the shards come from the same sample and settings
+    for k in SHARED_ATTRS:
+        values = set([str(a[k]) for a in attrs])
+        msg = "Partial results have different values for {}: {}"
+        assert len(values) == 1, msg.format(k, ", ".join(sorted(values)))
+    shards = [a["shard"] for a in attrs]
+    n_shards = attrs[0]["n_shards"]
+    msg = "Expected one partial result for each of {} shards, found {}"
+    assert shards == list(range(n_shards)), msg.format(n_shards, shards)
+
+    acc, assigner = make_accumulators(
+        multimapping=attrs[0]["multimapping"],
+        vocabulary=vocabulary,
+        quantiles=attrs[0]["quantiles"],
+    )
+    # Merge in order, so that the result is the same as a single process
+    for store in stores:
+        logging.info("Merging shard {} of {} from {}".format(
+            store.attrs["shard"], n_shards, store.fp
+        ))
+        merge_partial_arrays(store, acc, assigner)
+
+    return acc, assigner, attrs
@@ -0,0 +1,344 @@
+#!/usr/bin/python
+"""Functions to drop the reads which share no seeds with the reference before aligning them."""
+
+import gzip
+import logging
+import itertools
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from Bio.Data import CodonTable
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from lib.store_helpers import ArrayStore
+from lib.store_helpers import write_arrays
+
+# Groups of amino acids which are treated as the same letter in a seed,
+# either every amino acid on its own or the 11-letter reduced alphabet
+# used by DIAMOND
+ALPHABETS = {
+    "full": list("ACDEFGHIKLMNPQRSTVWY"),
+    "reduced": ["KREDQN", "C", "G", "H", "ILV", "M", "F", "Y", "W", "P", "STA"],
+}
+
+# Positions of a seed which must match (1) or are ignored (0)
+SEED_SHAPE = "1110110111"
+
+# Code for anything which can't be part of a seed (stop codons, unknown
+# residues or bases, and the gaps between sequences)
+INVALID = 255
+
+# Largest number of hash functions used by a filter
+MAX_HASHES = 16
+
+
+def amino_acid_codes(alphabet):
+    """The code for each amino acid (by ASCII value) in an alphabet."""
+    codes = np.full(256, INVALID, dtype=np.uint8)
+    for ix, group in enumerate(alphabet):
+        for aa in group:
+            codes[ord(aa)] = ix
+            codes[ord(aa.lower())] = ix
+    return codes
+
+
+def _nucleotide_codes():
+    codes = np.full(256, 4, dtype=np.uint8)
+    for ix, bases in enumerate(["Aa", "Cc", "Gg", "TtUu"]):
+        for b in bases:
+            codes[ord(b)] = ix
+    return codes
+
+
+NUCLEOTIDE_CODES = _nucleotide_codes()
+
+
+def codon_table(alphabet, gencode=11):
+    """The amino acid code for each codon (16*a + 4*b + c)."""
+    aa_codes = amino_acid_codes(alphabet)
+    table = np.full(64, INVALID, dtype=np.uint8)
+    bases = "ACGT"
+    for codon, aa in CodonTable.unambiguous_dna_by_id[gencode].forward_table.items():
+        if all(b in bases for b in codon):
+            ix = 16 * bases.index(codon[0]) + 4 * bases.index(codon[1]) + \
+                bases.index(codon[2])
+            table[ix] = aa_codes[ord(aa)]
+    return table
+
+
+def seed_codes(aa, alphabet, shape=SEED_SHAPE):
+    """
+    Return the code for the seed starting at every position of an array
+    of amino acid codes, and whether each seed is valid.
+    """
+    offsets = [ix for ix, c in enumerate(shape) if c == "1"]
+    n = aa.shape[0] - len(shape) + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool)
+
+    codes = np.zeros(n, dtype=np.uint64)
+    valid = np.ones(n, dtype=bool)
+    base = np.uint64(len(alphabet))
+    is_valid = aa != INVALID
+    aa = aa.astype(np.uint64)
+    for o in offsets:
+        valid &= is_valid[o:o + n]
+        codes *= base
+        codes += aa[o:o + n]
+    return codes, valid
+
+
+def translate_frames(bases, table):
+    """
+    Translate an array of nucleotide codes in all six frames, yielding
+    the amino acid codes for each frame and the position of the
+    first base of each codon (on the forward strand).
+    """
+    n = bases.shape[0]
+    if n < 3:
+        return
+    # Unknown bases (4) are the only codes with the third bit set
+    rev = np.where(bases < 4, 3 - bases, 4).astype(np.uint8)[::-1]
+    for strand, seq in [(1, bases), (-1, rev)]:
+        # The codon starting at every position, then split into frames
+        first, second, third = seq[:-2], seq[1:-1], seq[2:]
+        ix = (first << 4) | (second << 2) | third
+        valid = ((first | second | third) & 4) == 0
+        aa = np.where(valid, table[ix & 63], INVALID).astype(np.uint8)
+        for frame in range(3):
+            start = np.arange(frame, n - 2, 3)
+            if strand == -1:
+                start = n - 1 - start
+            yield aa[frame::3], start
+
+
+class BloomFilter(object):
+    """
+    A set of seeds kept as a Bloom filter in a NumPy bit array. Each seed
+    sets n_hashes bits, chosen by multiplicative hashing, so membership
+    can be tested for a whole array of seeds at once. Seeds which were
+    added are always found, and other seeds are found at a rate close to
+    the false positive rate the filter was sized for.
+    """
+
+    def __init__(self, bits, log2_bits, multipliers):
+        self.bits = bits
+        self.log2_bits = int(log2_bits)
+        self.multipliers = multipliers
+
+    @classmethod
+    def empty(cls, n_items, fpr=0.001, seed=0):
+        """An empty filter sized for n_items and a false positive rate."""
+        n_bits = -max(n_items, 1) * np.log(fpr) / np.log(2) ** 2
+        log2_bits = max(6, int(np.ceil(np.log2(n_bits))))
+        n_hashes = int(round(2 ** log2_bits / max(n_items, 1) * np.log(2)))
+        n_hashes = min(max(n_hashes, 1), MAX_HASHES)
+        rng = np.random.RandomState(seed)
+        multipliers = rng.randint(
+            0, 2 ** 62, size=n_hashes, dtype=np.int64
+        ).astype(np.uint64) * np.uint64(4) + np.uint64(1)
+        return cls(
+            np.zeros(2 ** log2_bits // 8, dtype=np.uint8), log2_bits, multipliers
+        )
+
+    def _positions(self, codes):
+        shift = np.uint64(64 - self.log2_bits)
+        for m in self.multipliers:
+            yield (codes * m) >> shift
+
+    def add(self, codes):
+        if codes.shape[0] == 0:
+            return
+        # Sort the positions set by each hash, so that the bits in the same
+        # byte can be combined before they are written
+        for pos in self._positions(codes):
+            pos.sort()
+            byte = pos >> np.uint64(3)
+            bit = np.left_shift(1, pos & np.uint64(7)).astype(np.uint8)
+            starts = np.flatnonzero(np.r_[True, byte[1:] != byte[:-1]])
+            self.bits[byte[starts]] |= np.bitwise_or.reduceat(bit, starts)
+
+    def contains(self, codes):
+        # Only the seeds which have passed every hash so far are checked
+        # against the next one, as most seeds fail on the first
+        candidates = np.arange(codes.shape[0])
+        shift = np.uint64(64 - self.log2_bits)
+        for m in self.multipliers:
+            pos = (codes[candidates] * m) >> shift
+            bit = (self.bits[pos >> np.uint64(3)] >> (pos & np.uint64(7))) & 1
+            candidates = candidates[bit.astype(bool)]
+        found = np.zeros(codes.shape[0], dtype=bool)
+        found[candidates] = True
+        return found
+
+    def fill(self):
+        """Fraction of the bits which are set."""
+        return float(np.unpackbits(self.bits).mean())
+
+
+def open_fasta(fp):
+    """Open a FASTA file (which may be gzip compressed) as text."""
+    if fp.endswith(".gz"):
+        return gzip.open(fp, "rt")
+    return open(fp, "rt")
+
+
+def iter_protein_chunks(fp, chunk_size=10000):
+    """Yield the sequences in a protein FASTA file, a chunk at a time."""
+    with open_fasta(fp) as handle:
+        seqs = (seq for header, seq in SimpleFastaParser(handle))
+        while True:
+            chunk = list(itertools.islice(seqs, chunk_size))
+            if len(chunk) == 0:
+                break
+            yield chunk
+
+
+def unique_codes(codes):
+    """The distinct seeds in an array (faster than np.unique for uint64)."""
+    codes = np.sort(codes)
+    if codes.shape[0] == 0:
+        return codes
+    return codes[np.r_[True, codes[1:] != codes[:-1]]]
+
+
+def protein_seeds(seqs, alphabet, shape=SEED_SHAPE):
+    """The valid seeds in a list of protein sequences."""
+    aa = amino_acid_codes(alphabet)[np.frombuffer(
+        "*".join(seqs).encode("utf-8"), dtype=np.uint8
+    )]
+    codes, valid = seed_codes(aa, alphabet, shape=shape)
+    return codes[valid]
+
+
+def build_prefilter(fasta_fp, prefilter_fp, alphabet="full", shape=SEED_SHAPE,
+                    fpr=0.001, chunk_size=10000):
+    """
+    Add every seed in a set of reference proteins (FASTA) to a Bloom
+    filter, and write it to prefilter_fp. Seeds are made of the letters
+    at the positions marked 1 in the shape, from the full or reduced
+    amino acid alphabet.
+    """
+    msg = "Alphabet must be one of: {}".format(", ".join(sorted(ALPHABETS)))
+    assert alphabet in ALPHABETS, msg
+    msg = "Seed shape must be made of 0 and 1, starting and ending with 1"
+    assert set(shape) <= set("01") and shape[0] == shape[-1] == "1", msg
+    msg = "Too many positions in the seed shape for 64-bit seeds"
+    assert len(ALPHABETS[alphabet]) ** shape.count("1") < 2 ** 64, msg
+    logging.info("Counting the residues in {}".format(fasta_fp))
+    n_residues = sum(
+        sum(len(seq) for seq in chunk)
+        for chunk in iter_protein_chunks(fasta_fp, chunk_size=chunk_size)
+    )
+
+    bloom = BloomFilter.empty(n_residues, fpr=fpr)
+    logging.info("Adding up to {:,} seeds to a filter of {:,} bits ({:,} hashes)".format(
+        n_residues, 2 ** bloom.log2_bits, len(bloom.multipliers)
+    ))
+    n_seeds = 0
+    for chunk in iter_protein_chunks(fasta_fp, chunk_size=chunk_size):
+        codes = unique_codes(
+            protein_seeds(chunk, ALPHABETS[alphabet], shape=shape)
+        )
+        bloom.add(codes)
+        n_seeds += codes.shape[0]
+
+    fill = bloom.fill()
+    logging.info("Added {:,} seeds, {:.1%} of bits are set".format(n_seeds, fill))
+    logging.info("Writing prefilter to {}".format(prefilter_fp))
+    return write_arrays(prefilter_fp, {
+        "bits": bloom.bits,
+        "multipliers": bloom.multipliers,
+    }, attrs={
+        "log2_bits": bloom.log2_bits,
+        "shape": shape,
+        "alphabet": ALPHABETS[alphabet],
+        "n_seeds": n_seeds,
+        "fpr": fpr,
+        "fill": fill,
+    })
+
+
+class Prefilter(object):
+    """
+    The seeds in a reference database (from build_prefilter), used to
+    find the reads which could align to it.
+    """
+
+    def __init__(self, fp, gencode=11):
+        self.store = ArrayStore(fp)
+        self.attrs = self.store.attrs
+        self.alphabet = self.attrs["alphabet"]
+        self.shape = self.attrs["shape"]
+        self.bloom = BloomFilter(
+            np.array(self.store["bits"]),
+            self.attrs["log2_bits"],
+            np.array(self.store["multipliers"]),
+        )
+        self.table = codon_table(self.alphabet, gencode=gencode)
+
+    def count_hits(self, seqs):
+        """
+        Count the seeds in any frame of each read (given as bytes, each
+        ending with a newline) which are found in the filter.
+        """
+        lengths = np.array([len(s) for s in seqs], dtype=np.int64)
+        read_ix = np.repeat(np.arange(len(seqs)), lengths)
+        bases = NUCLEOTIDE_CODES[np.frombuffer(b"".join(seqs), dtype=np.uint8)]
+
+        hits = np.zeros(len(seqs), dtype=np.int64)
+        for aa, start in translate_frames(bases, self.table):
+            codes, valid = seed_codes(aa, self.alphabet, shape=self.shape)
+            found = np.flatnonzero(valid)
+            found = found[self.bloom.contains(codes[found])]
+            hits += np.bincount(
+                read_ix[start[found]], minlength=len(seqs)
+            )
+        return hits
+
+
+def prefilter_fastq(fp_in, fp_out, prefilter, min_hits=1, threads=1,
+                    chunk_size=50000):
+    """
+    Write the reads from a FASTQ file (with one line per sequence, as
+    written by clean_fastq_headers) which have at least min_hits seeds
+    in the prefilter. Chunks of reads are checked by a pool of threads
+    (NumPy releases the GIL), keeping a few chunks in memory at a time.
+    Returns the number of reads and the number kept.
+    """
+    logging.info("Prefiltering {} to {} (at least {:,} seed hits)".format(
+        fp_in, fp_out, min_hits
+    ))
+
+    def check_chunk(lines):
+        assert len(lines) % 4 == 0, "Truncated FASTQ record in " + fp_in
+        keep = np.flatnonzero(prefilter.count_hits(lines[1::4]) >= min_hits)
+        return len(lines) // 4, keep.shape[0], b"".join(
+            b"".join(lines[4 * ix:4 * ix + 4]) for ix in keep
+        )
+
+    pool = ThreadPool(threads)
+    n_reads, n_kept = 0, 0
+    try:
+        with open(fp_in, "rb") as f, open(fp_out, "wb") as fo:
+            pending = []
+            while True:
+                lines = list(itertools.islice(f, 4 * chunk_size))
+                if len(lines) > 0:
+                    pending.append(pool.apply_async(check_chunk, (lines,)))
+                # Write the chunks in order, limiting those held in memory
+                while len(pending) > 0 and (
+                    len(lines) == 0 or len(pending) >= 2 * threads
+                ):
+                    n, kept, data = pending.pop(0).get()
+                    fo.write(data)
+                    n_reads += n
+                    n_kept += kept
+                if len(lines) == 0:
+                    break
+    finally:
+        pool.close()
+        pool.join()
+
+    logging.info("Kept {:,} of {:,} reads ({:.1%})".format(
+        n_kept, n_reads, n_kept / float(max(n_reads, 1))
+    ))
+    return {"reads": n_reads, "kept": n_kept}
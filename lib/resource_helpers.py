@@ -0,0 +1,197 @@
+#!/usr/bin/python
+"""Functions to size the alignment step to the memory and CPUs available."""
+
+import os
+import math
+import logging
+import multiprocessing
+
+# Fraction of the available memory which DIAMOND is planned to use
+MEMORY_FRACTION = 0.8
+
+# Options for the number of chunks used for the seed index (DIAMOND's
+# default is 4), from fastest to most economical with memory
+INDEX_CHUNKS = [1, 2, 4, 8, 16]
+
+# Smallest block size (billions of letters) which will be used
+MIN_BLOCK_SIZE = 0.1
+
+# Approximate memory used by a process parsing alignments: a fixed
+# overhead, plus the parsed columns, read names and temporary arrays for
+# each alignment in a chunk
+PARSE_BASE_BYTES = 100e6
+PARSE_BYTES_PER_ALIGNMENT = 400
+
+
+def _read_first_line(fp):
+    """Return the first line of a file, or None if it can't be read."""
+    try:
+        with open(fp, "rt") as f:
+            return f.readline().strip()
+    except (IOError, OSError):
+        return None
+
+
+def cgroup_memory_limit(cgroup_root="/sys/fs/cgroup"):
+    """Return the cgroup memory limit in bytes (None if unlimited)."""
+    # cgroup v2
+    limit = _read_first_line(os.path.join(cgroup_root, "memory.max"))
+    if limit is None:
+        # cgroup v1
+        limit = _read_first_line(
+            os.path.join(cgroup_root, "memory", "memory.limit_in_bytes")
+        )
+    if limit is None or not limit.isdigit():
+        return None
+    limit = int(limit)
+    # cgroup v1 reports a very large number when there is no limit
+    if limit >= 2 ** 60:
+        return None
+    return limit
+
+
+def host_memory(proc_root="/proc"):
+    """Return the memory available on the host in bytes (None if unknown)."""
+    values = {}
+    try:
+        with open(os.path.join(proc_root, "meminfo"), "rt") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[1].isdigit():
+                    values[fields[0].rstrip(":")] = int(fields[1]) * 1024
+    except (IOError, OSError):
+        return None
+    return values.get("MemAvailable", values.get("MemTotal"))
+
+
+def available_memory(cgroup_root="/sys/fs/cgroup", proc_root="/proc"):
+    """Return the memory available to this process, in bytes."""
+    limits = [
+        limit
+        for limit in [
+            cgroup_memory_limit(cgroup_root=cgroup_root),
+            host_memory(proc_root=proc_root),
+        ]
+        if limit is not None
+    ]
+    assert len(limits) > 0, "Could not determine the available memory"
+    return min(limits)
+
+
+def cgroup_cpu_quota(cgroup_root="/sys/fs/cgroup"):
+    """Return the cgroup CPU quota as a number of CPUs (None if unlimited)."""
+    # cgroup v2 gives the quota and period on a single line
+    line = _read_first_line(os.path.join(cgroup_root, "cpu.max"))
+    if line is not None:
+        fields = line.split()
+        if len(fields) == 2 and fields[0].isdigit():
+            return float(fields[0]) / float(fields[1])
+        return None
+
+    # cgroup v1
+    quota = _read_first_line(os.path.join(cgroup_root, "cpu", "cpu.cfs_quota_us"))
+    period = _read_first_line(
+        os.path.join(cgroup_root, "cpu", "cpu.cfs_period_us")
+    )
+    if quota is None or period is None or quota.startswith("-"):
+        return None
+    return float(quota) / float(period)
+
+
+def available_cpus(cgroup_root="/sys/fs/cgroup"):
+    """Return the number of CPUs available to this process."""
+    if hasattr(os, "sched_getaffinity"):
+        n_cpus = len(os.sched_getaffinity(0))
+    else:
+        n_cpus = multiprocessing.cpu_count()
+
+    quota = cgroup_cpu_quota(cgroup_root=cgroup_root)
+    if quota is not None:
+        n_cpus = min(n_cpus, int(quota))
+    return max(1, n_cpus)
+
+
+def diamond_memory(block_size, index_chunks):
+    """
+    Approximate memory (GB) used by DIAMOND. With the default of 4 index
+    chunks this is roughly six times the block size, and the seed index
+    grows as the number of chunks goes down.
+    """
+    return block_size * (2. + 16. / index_chunks)
+
+
+def parse_workers(workers, chunksize=1000000, memory=None):
+    """
+    Cap the number of processes parsing alignments at the same time, so
+    that the chunk held by each of them fits in the memory available (by
+    default, the chunk size used by accumulate_alignments).
+    """
+    if memory is None:
+        try:
+            memory = available_memory()
+        except AssertionError:
+            return workers
+    per_worker = PARSE_BASE_BYTES + chunksize * PARSE_BYTES_PER_ALIGNMENT
+    n = max(1, min(workers, int(MEMORY_FRACTION * memory // per_worker)))
+    if n < workers:
+        logging.info(
+            "Parsing with {:,} processes rather than {:,} (~{:.2f} GB each, "
+            "{:.2f} GB available)".format(
+                n, workers, per_worker / 1e9, memory / 1e9
+            )
+        )
+    return n
+
+
+def plan_alignment(db_size, memory=None, cpus=None, n_jobs=1):
+    """
+    Pick the block size, number of index chunks and threads for DIAMOND,
+    based on the memory and CPUs available (split between n_jobs aligning
+    at the same time) and the size of the reference database (in bytes).
+
+    The fewest index chunks are used which still allow the whole database
+    to be processed in a single block, and the block size is then as large
+    as the memory allows.
+    """
+    if memory is None:
+        memory = available_memory()
+    if cpus is None:
+        cpus = available_cpus()
+
+    budget = MEMORY_FRACTION * memory / 1e9 / n_jobs
+    # The database takes roughly one byte per letter
+    db_size = db_size / 1e9
+
+    # Fall back to DIAMOND's default if the database has to be split
+    index_chunks = 4
+    for n in INDEX_CHUNKS:
+        if diamond_memory(max(db_size, MIN_BLOCK_SIZE), n) <= budget:
+            index_chunks = n
+            break
+
+    block_size = budget / diamond_memory(1., index_chunks)
+    block_size = max(MIN_BLOCK_SIZE, math.floor(block_size * 10) / 10.)
+
+    plan = {
+        "block_size": block_size,
+        "index_chunks": index_chunks,
+        "threads": max(1, cpus // n_jobs),
+        "memory_gb": round(memory / 1e9, 2),
+        "cpus": cpus,
+        "db_gb": round(db_size, 3),
+        "db_blocks": int(math.ceil(db_size / block_size)),
+        "expected_memory_gb": round(diamond_memory(block_size, index_chunks), 2),
+    }
+
+    if plan["expected_memory_gb"] > budget:
+        logging.info("Warning: not enough memory for the smallest block size")
+    logging.info(
+        "Alignment plan: --block-size {} --index-chunks {} --threads {} "
+        "(~{} GB of {} GB available, {:,} CPUs, {} GB database in {:,} blocks, "
+        "{:,} jobs at once)".format(
+            plan["block_size"], plan["index_chunks"], plan["threads"],
+            plan["expected_memory_gb"], plan["memory_gb"], cpus,
+            plan["db_gb"], plan["db_blocks"], n_jobs,
+        )
+    )
+    return plan
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+"""Functions to store NumPy arrays in a single memory-mappable file."""
+
+import json
+import struct
+import numpy as np
+
+MAGIC = b"MVARRAY1"
+ALIGNMENT = 64
+
+
+def _aligned(n):
+    """Round up to the next multiple of ALIGNMENT."""
+    return ((n + ALIGNMENT - 1) // ALIGNMENT) * ALIGNMENT
+
+
+def write_arrays(fp, arrays, attrs=None):
+    """Write a dict of named arrays (and JSON attributes) to a file."""
+    arrays = {
+        name: np.ascontiguousarray(arr)
+        for name, arr in arrays.items()
+    }
+
+    # The header records the type, shape and position of every array
+    layout = {}
+    offset = 0
+    for name in sorted(arrays):
+        layout[name] = {
+            "dtype": arrays[name].dtype.str,
+            "shape": list(arrays[name].shape),
+            "offset": offset,
+        }
+        offset = _aligned(offset + arrays[name].nbytes)
+
+    header = json.dumps(
+        {"attrs": attrs or {}, "arrays": layout},
+        sort_keys=True
+    ).encode("utf-8")
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+
+    with open(fp, "wb") as fo:
+        fo.write(MAGIC)
+        fo.write(struct.pack("<Q", len(header)))
+        fo.write(header)
+        for name in sorted(arrays):
+            fo.seek(data_start + layout[name]["offset"])
+            fo.write(arrays[name].tobytes())
+        fo.truncate(data_start + offset)
+
+    return fp
+
+
+class ArrayStore(object):
+    """Read-only access to the arrays written by write_arrays."""
+
+    def __init__(self, fp):
+        self.fp = fp
+        with open(fp, "rb") as f:
+            magic = f.read(len(MAGIC))
+            assert magic == MAGIC, "Not an array file: {}".format(fp)
+            header_len = struct.unpack("<Q", f.read(8))[0]
+            header = json.loads(f.read(header_len).decode("utf-8"))
+        self.attrs = header["attrs"]
+        self.layout = header["arrays"]
+        self.data_start = _aligned(len(MAGIC) + 8 + header_len)
+        self._arrays = {}
+
+    def __contains__(self, name):
+        return name in self.layout
+
+    def keys(self):
+        return sorted(self.layout.keys())
+
+    def __getitem__(self, name):
+        """Return a memory-mapped view of an array, opened on first use."""
+        if name not in self._arrays:
+            dtype = np.dtype(self.layout[name]["dtype"])
+            shape = tuple(self.layout[name]["shape"])
+            if int(np.prod(shape)) == 0:
+                # Empty arrays can't be memory-mapped
+                self._arrays[name] = np.zeros(shape, dtype=dtype)
+            else:
+                self._arrays[name] = np.memmap(
+                    self.fp,
+                    dtype=dtype,
+                    mode="r",
+                    offset=self.data_start + self.layout[name]["offset"],
+                    shape=shape
+                )
+        return self._arrays[name]
@@ -0,0 +1,206 @@
+#!/usr/bin/python
+"""Functions to read remote files as streams, without saving them to disk."""
+
+import io
+import time
+import zlib
+import socket
+import ftplib
+import logging
+
+
+def retry_errors():
+    """
+    The errors raised when a connection fails, including those raised by
+    botocore for S3 (which are not IOErrors), if it is installed.
+    """
+    errors = [IOError, OSError, socket.error, EOFError, ftplib.error_temp]
+    try:
+        import botocore.exceptions
+    except ImportError:
+        return tuple(errors)
+    # Not every version of botocore has all of these
+    for name in ["IncompleteReadError", "HTTPClientError", "ConnectionError"]:
+        if hasattr(botocore.exceptions, name):
+            errors.append(getattr(botocore.exceptions, name))
+    return tuple(errors)
+
+
+class ResumableStream(io.RawIOBase):
+    """
+    Read a remote file from start to finish, reconnecting at the current
+    byte offset if the connection fails.
+    """
+
+    def __init__(self, open_at, size=None, name="stream", max_retries=5,
+                 retry_wait=2):
+        # open_at(offset) returns a handle reading from that byte offset
+        self.open_at = open_at
+        self.size = size
+        self.name = name
+        self.max_retries = max_retries
+        self.retry_wait = retry_wait
+        self.offset = 0
+        self.errors = retry_errors()
+        self.handle = open_at(0)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        for attempt in range(self.max_retries + 1):
+            try:
+                # Reconnect at the current offset after a failure
+                if self.handle is None:
+                    self.handle = self.open_at(self.offset)
+                data = self.handle.read(len(b))
+                # A connection which is closed early looks like the end
+                if len(data) == 0 and self.size is not None:
+                    if self.offset < self.size:
+                        raise IOError("Stream ended at byte {:,} of {:,}".format(
+                            self.offset, self.size
+                        ))
+                break
+            except self.errors as e:
+                if attempt == self.max_retries:
+                    raise
+                wait = self.retry_wait * (2 ** attempt)
+                logging.info("Error reading {} at byte {:,} ({}), retrying in {}s".format(
+                    self.name, self.offset, e, wait
+                ))
+                time.sleep(wait)
+                try:
+                    if self.handle is not None:
+                        self.handle.close()
+                except Exception:
+                    pass
+                self.handle = None
+
+        b[:len(data)] = data
+        self.offset += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed and self.handle is not None:
+            self.handle.close()
+        super(ResumableStream, self).close()
+
+
+class GzipStreamReader(io.RawIOBase):
+    """Decompress a gzip stream (including multiple members) as it is read."""
+
+    def __init__(self, stream, chunk_size=1024 * 1024):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.pending = b""
+        self.finished = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self.pending) == 0 and not self.finished:
+            data = self.stream.read(self.chunk_size)
+            if len(data) == 0:
+                self.pending = self.decompressor.flush()
+                self.finished = True
+                break
+            self.pending = self.decompressor.decompress(data)
+
+            # Start a new decompressor for any additional gzip members
+            while len(self.decompressor.unused_data) > 0:
+                unused = self.decompressor.unused_data
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                self.pending += self.decompressor.decompress(unused)
+
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.stream.close()
+        super(GzipStreamReader, self).close()
+
+
+def open_s3_stream(url, client=None, **kwargs):
+    """
+    Stream an object from S3 with ranged GET requests, optionally with a
+    boto3 client (e.g. for another endpoint).
+    """
+    bucket, key = url[5:].split("/", 1)
+    if client is None:
+        import boto3
+        client = boto3.client("s3")
+    size = client.head_object(Bucket=bucket, Key=key)["ContentLength"]
+
+    def open_at(offset):
+        return client.get_object(
+            Bucket=bucket,
+            Key=key,
+            Range="bytes={}-".format(offset)
+        )["Body"]
+
+    return ResumableStream(open_at, size=size, name=url, **kwargs)
+
+
+class FTPReader(object):
+    """Read a file from an FTP server, starting at a byte offset."""
+
+    def __init__(self, host, path, offset=0, port=21):
+        self.ftp = ftplib.FTP()
+        self.ftp.connect(host, port)
+        self.ftp.login()
+        self.ftp.voidcmd("TYPE I")
+        self.conn = self.ftp.transfercmd(
+            "RETR " + path, rest=offset if offset > 0 else None
+        )
+        self.handle = self.conn.makefile("rb")
+
+    def read(self, size=-1):
+        return self.handle.read(size)
+
+    def close(self):
+        self.handle.close()
+        self.conn.close()
+        try:
+            self.ftp.quit()
+        except Exception:
+            self.ftp.close()
+
+
+def open_ftp_stream(url, **kwargs):
+    """Stream a file from an FTP server, resuming with REST after errors."""
+    host, path = url[6:].split("/", 1)
+    path = "/" + path
+    host, _, port = host.partition(":")
+    port = int(port) if port else 21
+
+    ftp = ftplib.FTP()
+    ftp.connect(host, port)
+    ftp.login()
+    ftp.voidcmd("TYPE I")
+    size = ftp.size(path)
+    ftp.quit()
+
+    def open_at(offset):
+        return FTPReader(host, path, offset=offset, port=port)
+
+    return ResumableStream(open_at, size=size, name=url, **kwargs)
+
+
+def open_remote_stream(url, buffer_size=4 * 1024 * 1024, **kwargs):
+    """Open a buffered stream of the (decompressed) contents of a URL."""
+    if url.startswith("s3://"):
+        stream = open_s3_stream(url, **kwargs)
+    elif url.startswith("ftp://"):
+        stream = open_ftp_stream(url, **kwargs)
+    else:
+        raise Exception("Did not recognize prefix for stream: " + url)
+
+    if url.endswith(".gz"):
+        stream = GzipStreamReader(stream)
+
+    return io.BufferedReader(stream, buffer_size)
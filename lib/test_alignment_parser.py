@@ -18,4 +18,18 @@ for prot in protein_abund:
         assert isinstance(prot[k], int)
     assert isinstance(prot["protein"], str)
 
+# Proteins are listed in the order they first appear in the file, however
+# the file is read
+first_seen = []
+for line in open(fp, "rt"):
+    subject = line.split("\t")[1]
+    if subject not in first_seen:
+        first_seen.append(subject)
+assert [prot["protein"] for prot in protein_abund] == first_seen
+for chunksize, workers in [(1000, 1), (1000, 4)]:
+    assert [
+        prot["protein"]
+        for prot in parse_alignment(fp, chunksize=chunksize, workers=workers)
+    ] == first_seen
+
 print("Success")
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+from resource_helpers import available_cpus
+from resource_helpers import plan_alignment
+from resource_helpers import parse_workers
+from resource_helpers import available_memory
+from resource_helpers import cgroup_cpu_quota
+from resource_helpers import cgroup_memory_limit
+
+temp_folder = tempfile.mkdtemp()
+
+
+def write_files(files):
+    """Write a fake /sys/fs/cgroup (or /proc) folder."""
+    root = tempfile.mkdtemp(dir=temp_folder)
+    for path, contents in files.items():
+        fp = os.path.join(root, path)
+        if not os.path.exists(os.path.dirname(fp)):
+            os.makedirs(os.path.dirname(fp))
+        with open(fp, "wt") as fo:
+            fo.write(contents)
+    return root
+
+
+proc_root = write_files({
+    "meminfo": "MemTotal:       64000000 kB\nMemFree:        1000 kB\nMemAvailable:   32000000 kB\n"
+})
+
+# cgroup v2
+root = write_files({"memory.max": "8000000000\n", "cpu.max": "400000 100000\n"})
+assert cgroup_memory_limit(root) == 8000000000
+assert cgroup_cpu_quota(root) == 4
+assert available_memory(root, proc_root) == 8000000000
+assert available_cpus(root) <= 4
+
+root = write_files({"memory.max": "max\n", "cpu.max": "max 100000\n"})
+assert cgroup_memory_limit(root) is None
+assert cgroup_cpu_quota(root) is None
+assert available_memory(root, proc_root) == 32000000 * 1024
+
+# cgroup v1, without a limit
+root = write_files({
+    "memory/memory.limit_in_bytes": "9223372036854771712\n",
+    "cpu/cpu.cfs_quota_us": "-1\n",
+    "cpu/cpu.cfs_period_us": "100000\n",
+})
+assert cgroup_memory_limit(root) is None
+assert cgroup_cpu_quota(root) is None
+
+# cgroup v1, with a limit
+root = write_files({
+    "memory/memory.limit_in_bytes": "16000000000\n",
+    "cpu/cpu.cfs_quota_us": "200000\n",
+    "cpu/cpu.cfs_period_us": "100000\n",
+})
+assert cgroup_memory_limit(root) == 16000000000
+assert cgroup_cpu_quota(root) == 2
+
+# No cgroup
+root = write_files({})
+assert cgroup_memory_limit(root) is None
+assert available_memory(root, proc_root) == 32000000 * 1024
+
+# A small database fits in a single block with a single index chunk
+plan = plan_alignment(1e9, memory=64e9, cpus=16)
+assert plan["index_chunks"] == 1
+assert plan["block_size"] >= 1
+assert plan["db_blocks"] == 1
+assert plan["threads"] == 16
+assert plan["expected_memory_gb"] <= 0.8 * 64
+
+# A larger database needs more index chunks to fit in memory
+plan = plan_alignment(5e9, memory=64e9, cpus=16)
+assert plan["index_chunks"] == 2
+assert plan["db_blocks"] == 1
+assert plan["expected_memory_gb"] <= 0.8 * 64
+
+# A database too large for memory is split into blocks
+plan = plan_alignment(50e9, memory=16e9, cpus=16)
+assert plan["index_chunks"] == 4
+assert plan["db_blocks"] > 1
+assert plan["expected_memory_gb"] <= 0.8 * 16
+
+# Memory and CPUs are split between jobs running at the same time
+plan = plan_alignment(1e9, memory=64e9, cpus=16, n_jobs=4)
+assert plan["threads"] == 4
+assert plan["expected_memory_gb"] <= 0.8 * 64 / 4
+
+shutil.rmtree(temp_folder)
+
+# Processes parsing alignments are limited by the memory for each chunk
+assert parse_workers(16, 1000000, memory=64e9) == 16
+assert parse_workers(16, 1000000, memory=2e9) == 3
+assert parse_workers(16, 1000000, memory=0.1e9) == 1
+assert parse_workers(16, 10000, memory=4e9) == 16
+
+print("Success")
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+
+import os
+import gzip
+import shutil
+import tempfile
+from aln_helpers import parse_alignment
+from exec_helpers import AlignmentStream
+
+fp = "/usr/map_viruses/tests/example.aln"
+
+temp_folder = tempfile.mkdtemp()
+
+# Stream the alignments from a running process, keeping a compressed copy
+sidecar_fp = os.path.join(temp_folder, "example.sam.gz")
+stream = AlignmentStream(
+    ["cat", fp],
+    os.path.join(temp_folder, "stderr.txt"),
+    sidecar_fp=sidecar_fp
+)
+streamed = parse_alignment(stream)
+assert stream.close() == sidecar_fp
+
+# The results match parsing the file from disk
+from_disk = parse_alignment(fp)
+assert len(streamed) == 11
+for a, b in zip(streamed, from_disk):
+    assert a == b
+
+# The compressed copy matches the original file
+assert gzip.open(sidecar_fp, "rt").read() == open(fp, "rt").read()
+
+# A failed process raises an error when the stream is closed
+stream = AlignmentStream(["false"], os.path.join(temp_folder, "stderr.txt"))
+parse_alignment(stream)
+try:
+    stream.close()
+    failed = False
+except AssertionError:
+    failed = True
+assert failed
+
+# If the reader fails, both processes can be stopped
+stream = AlignmentStream(
+    ["yes", open(fp, "rt").readline().rstrip("\n")],
+    os.path.join(temp_folder, "stderr.txt"),
+    sidecar_fp=sidecar_fp
+)
+try:
+    for ix, line in enumerate(stream):
+        assert ix < 100
+    failed = False
+except AssertionError:
+    failed = True
+finally:
+    stream.kill()
+assert failed
+assert stream.proc.poll() is not None
+assert stream.sidecar.poll() is not None
+
+# Stopping a stream which has already been closed does nothing
+stream = AlignmentStream(["cat", fp], os.path.join(temp_folder, "stderr.txt"))
+stream.close()
+stream.kill()
+assert stream.proc.returncode == 0
+
+shutil.rmtree(temp_folder)
+
+print("Success")
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+from lib.checkpoint_helpers import Checkpoints
+
+work_dir = tempfile.mkdtemp()
+
+STAGES = [
+    ("fetch_reads", {"input": "reads.fastq"}),
+    ("align", {"blocks": 5}),
+    ("parse", {"multimapping": "all"}),
+    ("upload", {"output_path": "out.json.gz"}),
+]
+
+
+def write(name, text, mtime=None):
+    fp = os.path.join(work_dir, name)
+    with open(fp, "wt") as fo:
+        fo.write(text)
+    if mtime is not None:
+        os.utime(fp, (mtime, mtime))
+    return fp
+
+
+# A new work directory has no stages finished
+checkpoints = Checkpoints(work_dir, STAGES)
+assert not any(checkpoints.skip(name) for name, settings in STAGES)
+
+reads_fp = write("reads.fastq", "@r\nACGT\n+\nFFFF\n")
+checkpoints.complete("fetch_reads", {"reads": 1}, files=[reads_fp])
+align_fp = write("reads.sam", "r\tp\t100\n")
+checkpoints.complete("align", {"align_fp": align_fp}, files=[align_fp])
+
+# Resume after the last stage finished, with the values it returned
+checkpoints = Checkpoints(work_dir, STAGES)
+assert checkpoints.skip("fetch_reads") and checkpoints.skip("align")
+assert not checkpoints.skip("parse") and not checkpoints.skip("upload")
+assert checkpoints.values("fetch_reads") == {"reads": 1}
+assert checkpoints.values("align") == {"align_fp": align_fp}
+
+# Changing a setting runs that stage (and every stage after it) again
+changed = [STAGES[0], ("align", {"blocks": 2})] + STAGES[2:]
+checkpoints = Checkpoints(work_dir, changed)
+assert checkpoints.skip("fetch_reads") and not checkpoints.skip("align")
+assert not os.path.exists(os.path.join(work_dir, "align.checkpoint"))
+checkpoints.complete("align", {"align_fp": align_fp}, files=[align_fp])
+
+# A file which has changed since its stage was finished is made again
+write("reads.sam", "r\tp\t99\n")
+checkpoints = Checkpoints(work_dir, changed)
+assert checkpoints.skip("fetch_reads") and not checkpoints.skip("align")
+
+# Every stage after a file that has changed is run again
+checkpoints.complete("align", {"align_fp": align_fp}, files=[align_fp])
+partial_fp = write("parsed.partial", "partial")
+checkpoints.complete("parse", files=[partial_fp])
+assert Checkpoints(work_dir, changed).skip("parse")
+reads_fp = write("reads.fastq", "@r\nACGA\n+\nFFFF\n", mtime=1000)
+checkpoints = Checkpoints(work_dir, changed)
+assert not any(checkpoints.skip(name) for name, settings in changed)
+assert sorted(
+    fn for fn in os.listdir(work_dir) if fn.endswith(".checkpoint")
+) == []
+checkpoints.complete("fetch_reads", {"reads": 1}, files=[reads_fp])
+checkpoints.complete("align", {"align_fp": align_fp}, files=[align_fp])
+checkpoints.complete("parse", files=[partial_fp])
+
+# Once every stage is finished, all of them are skipped
+checkpoints.complete("upload")
+checkpoints = Checkpoints(work_dir, changed)
+assert all(checkpoints.skip(name) for name, settings in changed)
+
+# Files are compared by size and modification time, unless their
+# content hashes are recorded
+os.utime(partial_fp, (2000, 2000))
+assert not Checkpoints(work_dir, changed).skip("parse")
+checkpoints = Checkpoints(work_dir, changed, hash_files=True)
+checkpoints.complete("parse", files=[partial_fp])
+checkpoints.complete("upload")
+os.utime(partial_fp, (3000, 3000))
+assert Checkpoints(work_dir, changed).skip("upload")
+write("parsed.partial", "PARTIAL")
+assert not Checkpoints(work_dir, changed).skip("parse")
+
+# Nothing is recorded or skipped when checkpoints are disabled
+shutil.rmtree(work_dir)
+os.mkdir(work_dir)
+checkpoints = Checkpoints(work_dir, STAGES, enabled=False)
+checkpoints.complete("fetch_reads", files=[write("reads.fastq", "")])
+assert not checkpoints.skip("fetch_reads")
+assert os.listdir(work_dir) == ["reads.fastq"]
+
+shutil.rmtree(work_dir)
+
+print("Success")
@@ -0,0 +1,59 @@
+#!/usr/bin/python
+
+import numpy as np
+from aln_helpers import parse_alignment
+from aln_helpers import AlignmentAccumulator
+from aln_helpers import SubjectVocabulary
+
+fp = "/usr/map_viruses/tests/example.aln"
+
+# Calculate the coverage by incrementing a slice for every alignment
+coverage = {}
+with open(fp, "rt") as f:
+    for line in f:
+        line = line.rstrip("\n").split("\t")
+        if line[1] not in coverage:
+            coverage[line[1]] = np.zeros(int(line[11]), dtype=int)
+        coverage[line[1]][(int(line[6]) - 1): int(line[7])] += 1
+
+protein_abund = parse_alignment(fp)
+
+assert len(protein_abund) == len(coverage)
+
+for prot in protein_abund:
+    depth = coverage[prot["protein"]]
+    assert prot["coverage"] == (depth > 0).mean()
+    assert prot["depth"] == depth.mean()
+    assert prot["length"] == depth.shape[0]
+
+# Reverse-strand alignments cover the same positions as forward alignments
+acc = AlignmentAccumulator()
+acc.add_subject("fwd", 10)
+acc.add_subject("rev", 10)
+acc.add("fwd", 3, 7)
+acc.add("rev", 7, 3)
+assert (acc.depth("fwd") == acc.depth("rev")).all()
+assert acc.depth("rev").tolist() == [0, 0, 1, 1, 1, 1, 1, 0, 0, 0]
+
+# Hits past the end of a subject don't change the depth of the next one
+acc = AlignmentAccumulator()
+acc.add_subject("short", 5)
+acc.add_subject("next", 5)
+acc.add("short", 8, 12)
+acc.add("short", 12, 3)
+acc.add("next", 0, 2)
+assert acc.depth("short").tolist() == [0, 0, 1, 1, 1]
+assert acc.depth("next").tolist() == [1, 1, 0, 0, 0]
+
+# Space is only allocated for the subjects with alignments, however large
+# the vocabulary
+names = np.sort(np.char.add(b"protein_", np.arange(100000).astype("S")))
+acc = AlignmentAccumulator(vocabulary=SubjectVocabulary(names))
+assert acc.index_subjects([b"protein_5", b"protein_7", b"protein_5"], [10, 20, 10]).tolist() == [0, 1, 0]
+acc.add("protein_7", 1, 5)
+assert len(acc) == 2 and acc.offsets.shape[0] < 100
+assert "protein_7" in acc and "protein_8" not in acc
+assert acc.names(acc.detected()).tolist() == [b"protein_5", b"protein_7"]
+assert acc.depth("protein_7").tolist() == [1] * 5 + [0] * 15
+
+print("Success")
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import numpy as np
+from lib.aln_helpers import make_accumulators
+from lib.aln_helpers import AlignmentAccumulator
+from lib.aln_helpers import accumulate_alignments
+from lib.track_helpers import CoverageTracks
+from lib.track_helpers import coverage_tracks
+from lib.track_helpers import write_coverage_tracks
+
+fp = "/usr/map_viruses/tests/example.aln"
+
+temp_folder = tempfile.mkdtemp()
+
+# Run-length encode a small set of alignments
+acc = AlignmentAccumulator()
+acc.add_subject("a", 10)
+acc.add_subject("b", 5)
+acc.add("a", 1, 4)
+acc.add("a", 3, 6)
+acc.add("b", 5, 1)
+tracks = coverage_tracks(acc)
+assert list(tracks["run_indptr"]) == [0, 4, 5]
+assert list(tracks["run_start"]) == [0, 2, 4, 6, 0]
+assert list(tracks["run_depth"]) == [1, 2, 1, 0, 1]
+
+track_fp = os.path.join(temp_folder, "small.tracks")
+write_coverage_tracks(track_fp, acc, attrs={"input": "small"})
+reader = CoverageTracks(track_fp)
+assert reader.attrs["input"] == "small"
+assert len(reader) == 2 and "a" in reader and "c" not in reader
+assert reader.length("a") == 10
+assert list(reader.depth("a")) == [1, 1, 2, 2, 1, 1, 0, 0, 0, 0]
+assert list(reader.depth("a", 3, 7)) == [2, 1, 1, 0]
+assert list(reader.depth("b")) == [1, 1, 1, 1, 1]
+
+# Every protein in a real set of alignments matches the full depth
+acc, assigner = make_accumulators()
+accumulate_alignments(fp, acc, assigner)
+track_fp = os.path.join(temp_folder, "example.tracks")
+write_coverage_tracks(track_fp, acc)
+reader = CoverageTracks(track_fp)
+assert len(reader) == len(acc)
+output, detected = acc.summarize()
+for r in output:
+    depth = reader.depth(r["protein"])
+    assert (depth == acc.depth(r["protein"])).all(), r["protein"]
+    assert depth.shape[0] == r["length"]
+    assert np.isclose(depth.mean(), r["depth"])
+    assert np.isclose((depth > 0).mean(), r["coverage"])
+
+# No alignments
+write_coverage_tracks(track_fp, AlignmentAccumulator())
+assert len(CoverageTracks(track_fp)) == 0
+
+shutil.rmtree(temp_folder)
+
+print("Success")
@@ -0,0 +1,65 @@
+#!/usr/bin/python
+
+import os
+import gzip
+import shutil
+import tempfile
+from lib.fastq_helpers import count_fastq_reads
+from lib.fastq_helpers import clean_fastq_headers
+
+temp_folder = tempfile.mkdtemp()
+
+# Headers with whitespace, followed by a blank line at the end of the file
+fastq = "".join([
+    "@read{} description\tmore\nACGTACGT\n+read{}\nIIIIIIII\n".format(ix, ix)
+    for ix in range(1000)
+]) + "@read_no_newline\nACGT\n+\nIIII\n\n"
+
+for fn, opener in [("input.fastq", open), ("input.fastq.gz", gzip.open)]:
+    fp_in = os.path.join(temp_folder, fn)
+    fp_out = os.path.join(temp_folder, "cleaned.fastq")
+    with opener(fp_in, "wb") as fo:
+        fo.write(fastq.encode())
+
+    read_stats = clean_fastq_headers(fp_in, fp_out)
+
+    # Reads and bases are counted while the headers are cleaned up
+    assert read_stats == {"reads": 1001, "bases": 8004}
+    assert count_fastq_reads(fp_out) == 1001
+
+    lines = open(fp_out, "rt").readlines()
+    assert len(lines) == 4 * 1001
+    assert lines[0] == "@read0-r1\n"
+    assert lines[2] == "+read0-r1\n"
+    assert lines[-4] == "@read_no_newline-r1001\n"
+    assert lines[-1] == "IIII\n"
+
+    # Headers are unique
+    assert len(set(lines[0::4])) == 1001
+
+# Windows line endings are replaced on every line of the record
+fp_in = os.path.join(temp_folder, "crlf.fastq")
+fp_out = os.path.join(temp_folder, "cleaned.fastq")
+with open(fp_in, "wb") as fo:
+    fo.write(b"@read1 description\r\nACGT\r\n+read1\r\nIIII\r\n" * 2)
+read_stats = clean_fastq_headers(fp_in, fp_out)
+assert read_stats == {"reads": 2, "bases": 8}
+assert open(fp_out, "rb").read() == (
+    b"@read1-r1\nACGT\n+read1-r1\nIIII\n"
+    b"@read1-r2\nACGT\n+read1-r2\nIIII\n"
+)
+
+# Truncated records are an error
+fp_in = os.path.join(temp_folder, "truncated.fastq")
+with open(fp_in, "wt") as fo:
+    fo.write("@read1\nACGT\n")
+try:
+    clean_fastq_headers(fp_in, os.path.join(temp_folder, "cleaned.fastq"))
+    failed = False
+except AssertionError:
+    failed = True
+assert failed
+
+shutil.rmtree(temp_folder)
+
+print("Success")
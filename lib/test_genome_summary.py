@@ -23,4 +23,13 @@ assert genome_dat[0]["total_proteins"] == 11
 assert genome_dat[0]["detected_proteins"] == 11
 assert genome_dat[0]["total_length"] == 2327
 
+# The genome metrics are length-weighted averages of the protein metrics
+proteins = pd.DataFrame(protein_abund)
+for k in ["coverage", "depth", "pctid", "bitscore", "alen"]:
+    weighted = (proteins[k] * proteins["length"]).sum() / 2327.
+    assert abs(genome_dat[0][k] - weighted) < 1e-9
+
+# The metadata table is not modified
+assert "coverage" not in metadata.columns
+
 print("Success")
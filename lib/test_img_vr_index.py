@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+import os
+import gzip
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from lib.img_vr_helpers import scan_faa
+from lib.img_vr_helpers import genome_ids
+from lib.img_vr_helpers import index_img_vr
+from lib.metadata_helpers import MetadataIndex
+from lib.metadata_helpers import write_metadata_index
+
+temp_folder = tempfile.mkdtemp()
+
+# Metadata for each genome, with text, numeric and missing values (and
+# one genome without any proteins)
+metadata_fp = os.path.join(temp_folder, "metadata.tsv")
+metadata = pd.DataFrame({
+    "mVCs": ["IMGVR_{}_____g{}".format(ix % 3, ix) for ix in range(21)],
+    "host": ["host {}".format(ix) if ix % 4 else None for ix in range(21)],
+    "n_contigs": list(range(21)),
+    "gc": [ix / 40. for ix in range(21)],
+})
+metadata.to_csv(metadata_fp, sep="\t", index=False)
+
+faa_fp = os.path.join(temp_folder, "proteins.faa.gz")
+with gzip.open(faa_fp, "wt") as fo:
+    for ix in range(97):
+        genome = metadata["mVCs"].values[(ix * 7) % 20]
+        fo.write(">{}_____p{}\n{}\n".format(genome, ix, "M" * (ix + 10)))
+
+assert list(genome_ids(["a_____b_____c", "a_____b", "a"])) == ["a_____b", "a_____b", "a"]
+
+chunks = list(scan_faa(faa_fp, chunk_size=40))
+assert [len(c["protein"]) for c in chunks] == [40, 40, 17]
+assert chunks[0]["length"][:3] == [10, 11, 12]
+
+# The same table as joining the metadata for each protein one at a time
+expected = []
+lookup = metadata.set_index("mVCs")
+for c in chunks:
+    for protein, length in zip(c["protein"], c["length"]):
+        genome = "_____".join(protein.split("_____")[:2])
+        r = {"protein": protein, "length": length, "genome": genome}
+        for k in lookup.columns:
+            r[k] = lookup.loc[genome, k]
+        expected.append(r)
+expected = pd.DataFrame(expected)[["protein", "length", "genome", "host", "n_contigs", "gc"]]
+
+for chunk_size in [1, 10, 1000]:
+    prefix = os.path.join(temp_folder, "img_vr_{}".format(chunk_size))
+    manifest = index_img_vr(metadata_fp, faa_fp, prefix, chunk_size=chunk_size)
+    assert manifest["protein"].shape[0] == 97
+    assert len(set(manifest["sequence_hash"])) == 97
+
+    tsv = pd.read_table(prefix + ".tsv", sep="\t")
+    pd.testing.assert_frame_equal(tsv, expected, check_dtype=False)
+
+    # The index has the same contents as one made from the whole table,
+    # with the genome metadata stored once per genome
+    index = MetadataIndex(prefix + ".idx")
+    write_metadata_index(expected, prefix + ".expected.idx")
+    expected_index = MetadataIndex(prefix + ".expected.idx")
+    pd.testing.assert_frame_equal(
+        index.rows(np.arange(len(index))),
+        expected_index.rows(np.arange(len(expected_index))),
+    )
+    for k in [
+        "protein_sorted", "protein_sorted_row", "genome", "protein_genome",
+        "genome_row", "genome_offset", "genome_nproteins", "genome_length",
+    ]:
+        assert (index.store[k] == expected_index.store[k]).all(), k
+    assert all(
+        bool(col.get("per_genome")) == (col["name"] not in ["protein", "length"])
+        for col in index.columns
+    )
+    assert index.store["column_3"].shape[0] == 20
+    pd.testing.assert_frame_equal(
+        index.detected_metadata(["IMGVR_1_____g1_____p3"]).reset_index(drop=True),
+        expected[expected["genome"] == "IMGVR_1_____g1"].reset_index(drop=True),
+        check_dtype=False,
+    )
+
+# Every protein must have metadata for its genome
+with gzip.open(faa_fp, "wt") as fo:
+    fo.write(">IMGVR_9_____g9_____p1\nMKV\n")
+try:
+    index_img_vr(metadata_fp, faa_fp, os.path.join(temp_folder, "missing"))
+    assert False
+except AssertionError as e:
+    assert "No metadata for IMGVR_9_____g9" in str(e)
+
+shutil.rmtree(temp_folder)
+
+print("Success")
@@ -0,0 +1,57 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from lib.aln_helpers import parse_alignment
+from lib.aln_helpers import summarize_genomes
+from lib.metadata_helpers import MetadataIndex
+from lib.metadata_helpers import load_metadata
+from lib.metadata_helpers import metadata_vocabulary
+from lib.metadata_helpers import write_metadata_index
+
+fp = "/usr/map_viruses/tests/example.aln"
+metadata_fp = "/usr/map_viruses/tests/example.tsv"
+
+temp_folder = tempfile.mkdtemp()
+index_fp = os.path.join(temp_folder, "example.idx")
+
+metadata = pd.read_table(metadata_fp, sep='\t')
+write_metadata_index(metadata, index_fp)
+
+index = load_metadata(index_fp)
+assert isinstance(index, MetadataIndex)
+assert len(index) == metadata.shape[0]
+
+# Look up proteins, including one that is missing
+rows = index.protein_rows(["NP_040705", "not_a_protein"])
+assert rows[0] == metadata["protein"].tolist().index("NP_040705")
+assert rows[1] == -1
+assert index.protein_genomes(["NP_040705"]) == ["NC_001422.1"]
+
+# Rows read from the index match the table
+subset = index.rows(np.arange(metadata.shape[0]))
+assert subset.columns.tolist() == metadata.columns.tolist()
+for k in metadata.columns:
+    assert (subset[k].isnull() == metadata[k].isnull()).all()
+    assert (subset[k].dropna() == metadata[k].dropna()).all()
+
+# Summarizing with the index gives the same result as with the table
+protein_abund = parse_alignment(fp)
+detected = index.detected_metadata([p["protein"] for p in protein_abund])
+assert detected.shape[0] == 11
+from_index = summarize_genomes(protein_abund, detected)
+from_table = summarize_genomes(protein_abund, metadata)
+assert from_index[1] == from_table[1]
+assert pd.DataFrame(from_index[0]).equals(pd.DataFrame(from_table[0]))
+
+# Parsing with the protein index from the metadata gives the same result
+for m in [metadata, index]:
+    with_vocabulary = parse_alignment(fp, vocabulary=metadata_vocabulary(m))
+    assert with_vocabulary == protein_abund
+
+shutil.rmtree(temp_folder)
+
+print("Success")
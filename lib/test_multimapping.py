@@ -0,0 +1,86 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import numpy as np
+from collections import Counter
+from aln_helpers import ReadAssigner
+from aln_helpers import parse_alignment
+
+fp = "/usr/map_viruses/tests/example.aln"
+
+temp_folder = tempfile.mkdtemp()
+align_fp = os.path.join(temp_folder, "multimapping.aln")
+
+# Ten reads align only to protA, and ten reads align equally well to
+# protA and protB
+with open(align_fp, "wt") as fo:
+    for ix in range(10):
+        fo.write("unique{}\tprotA\t100.0\t10\t1\t30\t1\t10\t1e-5\t50.0\t30\t100\n".format(ix))
+    for ix in range(10):
+        fo.write("shared{}\tprotA\t100.0\t10\t1\t30\t1\t10\t1e-5\t50.0\t30\t100\n".format(ix))
+        fo.write("shared{}\tprotB\t100.0\t10\t1\t30\t1\t10\t1e-5\t50.0\t30\t100\n".format(ix))
+
+for method, expected in [
+    ("all", {"protA": 20, "protB": 10}),
+    ("best", {"protA": 15, "protB": 5}),
+    ("em", {"protA": 20, "protB": 0}),
+]:
+    # Reads which are split across chunks give the same result
+    for chunksize in [1000, 3]:
+        output = parse_alignment(
+            align_fp, chunksize=chunksize, multimapping=method
+        )
+        output = {r["protein"]: r for r in output}
+        for k, n in expected.items():
+            assert abs(output[k]["nreads"] - n) < 1e-6, (method, k)
+
+        # Depth is scaled by the fraction of reads assigned
+        assert abs(output["protA"]["depth"] - expected["protA"] / 10.) < 1e-6
+
+# Every read is assigned exactly once
+n_reads = 0
+with open(fp, "rt") as f:
+    last = None
+    for line in f:
+        read = line.split("\t")[0]
+        if read != last:
+            n_reads += 1
+        last = read
+
+for method in ["best", "em"]:
+    output = parse_alignment(fp, chunksize=1000, multimapping=method)
+    assert abs(sum([r["nreads"] for r in output]) - n_reads) < 1e-6
+    assert sum([r["nalignments"] for r in output]) == 20833
+
+# The sets of subjects for each read are the same as counting them one
+# read at a time, however the reads are split into chunks
+np.random.seed(0)
+read = np.repeat(np.arange(500), np.random.randint(1, 6, size=500))
+ix = np.random.randint(0, 8, size=read.shape[0])
+bitscore = np.ones(read.shape[0])
+expected = Counter()
+for r in range(500):
+    subjects = tuple(sorted(set(ix[read == r])))
+    if len(subjects) > 1:
+        expected[subjects] += 1
+for chunks in [1, 7]:
+    assigner = ReadAssigner(method="best")
+    for part in np.array_split(np.arange(read.shape[0]), chunks):
+        assigner.add(read[part], ix[part], bitscore[part], read[part[0]], read[part[-1]])
+    assigner.finish()
+    indptr, indices, counts = assigner.class_matrix()
+    found = Counter()
+    for i, n in enumerate(counts):
+        found[tuple(indices[indptr[i]:indptr[i + 1]])] += n
+    assert found == expected
+
+    # Subjects outside of any set keep their unique reads
+    assigned = assigner.assign(1000)
+    assert assigned.shape[0] == 1000 and (assigned[8:] == 0).all()
+    assert abs(assigned.sum() - 500) < 1e-6
+
+shutil.rmtree(temp_folder)
+
+print("Success")
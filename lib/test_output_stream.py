@@ -0,0 +1,172 @@
+#!/usr/bin/python
+
+import io
+import os
+import gzip
+import json
+import time
+import shutil
+import tempfile
+import threading
+from lib.exec_helpers import return_file
+from lib.exec_helpers import return_results
+from lib.exec_helpers import return_alignments
+from lib.output_helpers import write_json
+from lib.output_helpers import OutputStream
+from lib.output_helpers import MIN_PART_SIZE
+from lib.stream_helpers import GzipStreamReader
+
+
+class FakeS3Client(object):
+    """Local stand-in for the boto3 S3 client, which keeps objects in memory."""
+
+    def __init__(self, fail_part=None, delay=0.01):
+        self.objects = {}
+        self.uploads = {}
+        self.aborted = []
+        self.fail_part = fail_part
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        assert kwargs == {"ServerSideEncryption": "AES256"}
+        self.objects[(Bucket, Key)] = Body
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        assert kwargs == {"ServerSideEncryption": "AES256"}
+        upload_id = "upload{}".format(len(self.uploads))
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+        if PartNumber == self.fail_part:
+            raise IOError("Upload failed")
+        self.uploads[UploadId][PartNumber] = Body
+        return {"ETag": "etag{}".format(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = MultipartUpload["Parts"]
+        assert [p["PartNumber"] for p in parts] == list(range(1, len(parts) + 1))
+        assert [p["ETag"] for p in parts] == [
+            "etag{}".format(p["PartNumber"]) for p in parts
+        ]
+        # Every part except the last must be at least 5MB
+        for p in parts[:-1]:
+            assert len(self.uploads[UploadId][p["PartNumber"]]) >= MIN_PART_SIZE
+        self.objects[(Bucket, Key)] = b"".join([
+            self.uploads[UploadId][p["PartNumber"]] for p in parts
+        ])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(UploadId)
+
+
+temp_folder = tempfile.mkdtemp()
+
+# Serializing in pieces gives the same JSON as json.dumps
+out = {
+    "input": "sample",
+    "logs": ["line {}\n".format(ix) for ix in range(2500)],
+    "results": {
+        "proteins": [{"protein": str(ix), "depth": ix / 3.} for ix in range(2345)],
+        "genomes": [],
+    },
+    "empty": {},
+    "total_reads": 10,
+}
+for chunk_size in [1, 7, 1000, 10000]:
+    fo = io.BytesIO()
+    write_json(out, fo, chunk_size=chunk_size)
+    assert fo.getvalue().decode("utf-8") == json.dumps(out), chunk_size
+
+# Small objects are uploaded in a single request
+client = FakeS3Client()
+with OutputStream("s3://bucket/small.txt", client=client) as fo:
+    fo.write(b"hello")
+assert client.objects[("bucket", "small.txt")] == b"hello"
+assert len(client.uploads) == 0
+
+# Large objects are uploaded in parts, several at a time
+data = os.urandom(1024 * 1024) * 23
+client = FakeS3Client()
+with OutputStream("s3://bucket/path/large.bin", client=client, threads=4) as fo:
+    for start in range(0, len(data), 100000):
+        fo.write(data[start:start + 100000])
+assert client.objects[("bucket", "path/large.bin")] == data
+assert len(client.uploads["upload0"]) == 3
+assert client.max_active > 1
+
+# Compressed output can be read by gzip, and by GzipStreamReader
+client = FakeS3Client()
+with OutputStream("s3://bucket/large.bin.gz", client=client, threads=3) as fo:
+    fo.writer.block_size = 1024 * 1024
+    fo.write(data)
+compressed = client.objects[("bucket", "large.bin.gz")]
+assert gzip.GzipFile(fileobj=io.BytesIO(compressed)).read() == data
+assert GzipStreamReader(io.BytesIO(compressed)).read() == data
+
+# Empty outputs are still valid gzip files
+client = FakeS3Client()
+with OutputStream("s3://bucket/empty.gz", client=client) as fo:
+    pass
+assert gzip.GzipFile(fileobj=io.BytesIO(client.objects[("bucket", "empty.gz")])).read() == b""
+
+# A failed part aborts the upload, and no object is written
+client = FakeS3Client(fail_part=2)
+try:
+    with OutputStream("s3://bucket/failed.bin", client=client) as fo:
+        fo.write(data)
+    assert False
+except IOError:
+    pass
+assert client.aborted == ["upload0"]
+assert ("bucket", "failed.bin") not in client.objects
+
+# An error while writing aborts the upload
+client = FakeS3Client()
+try:
+    with OutputStream("s3://bucket/error.bin.gz", client=client, threads=1) as fo:
+        fo.writer.block_size = 1024 * 1024
+        fo.write(data)
+        raise ValueError("Error while writing")
+except ValueError:
+    pass
+assert client.aborted == ["upload0"]
+assert ("bucket", "error.bin.gz") not in client.objects
+
+# Local files are only moved into place once they are complete
+local_fp = os.path.join(temp_folder, "output.json.gz")
+try:
+    with OutputStream(local_fp) as fo:
+        fo.write(b"partial")
+        raise ValueError("Error while writing")
+except ValueError:
+    pass
+assert os.listdir(temp_folder) == []
+
+return_results(out, local_fp, threads=2)
+assert json.load(gzip.open(local_fp, "rt")) == out
+
+# Alignments are compressed as they are returned
+sam_fp = os.path.join(temp_folder, "reads.sam")
+with open(sam_fp, "wb") as fo:
+    fo.write(data)
+return_alignments(sam_fp, os.path.join(temp_folder, "out.sam.gz"), threads=2)
+assert not os.path.exists(sam_fp)
+assert gzip.open(os.path.join(temp_folder, "out.sam.gz"), "rb").read() == data
+
+# Files are moved locally
+return_file(local_fp, os.path.join(temp_folder, "moved.json.gz"))
+assert sorted(os.listdir(temp_folder)) == ["moved.json.gz", "out.sam.gz"]
+
+shutil.rmtree(temp_folder)
+
+print("Success")
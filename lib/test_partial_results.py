@@ -0,0 +1,148 @@
+#!/usr/bin/python
+
+import os
+import sys
+import shutil
+import tempfile
+from lib.aln_helpers import FileRange
+from lib.aln_helpers import shard_offsets
+from lib.aln_helpers import parse_alignment
+from lib.aln_helpers import make_accumulators
+from lib.aln_helpers import summarize_alignments
+from lib.aln_helpers import accumulate_alignments
+from lib.fastq_helpers import split_fastq
+from lib.partial_helpers import parse_shard
+from lib.partial_helpers import write_partial
+from lib.partial_helpers import merge_partials
+from lib.exec_helpers import get_reference_database
+
+fp = "/usr/map_viruses/tests/example.aln"
+
+temp_folder = tempfile.mkdtemp()
+
+assert parse_shard("0/4") == (0, 4)
+assert parse_shard("3/4") == (3, 4)
+for shard in ["4/4", "1", "a/4", "-1/4"]:
+    try:
+        parse_shard(shard)
+        assert False, shard
+    except AssertionError as e:
+        assert "Shard" in str(e), shard
+
+# Split a FASTQ into chunks with a similar number of reads
+fastq_fp = os.path.join(temp_folder, "reads.fastq")
+with open(fastq_fp, "wt") as fo:
+    for ix in range(10):
+        fo.write("@read-r{}\nACGT\n+read-r{}\nIIII\n".format(ix + 1, ix + 1))
+chunks = split_fastq(fastq_fp, 3, 10)
+assert [n for chunk_fp, n in chunks] == [3, 3, 4]
+assert open(chunks[2][0], "rt").readlines()[0] == "@read-r7\n"
+assert "".join([open(chunk_fp, "rt").read() for chunk_fp, n in chunks]) == \
+    open(fastq_fp, "rt").read()
+(chunk_fp, n), = split_fastq(fastq_fp, 3, 10, chunks=[1])
+assert n == 3
+assert open(chunk_fp, "rt").readlines()[0] == "@read-r4\n"
+
+
+def write_shards(method, quantiles, n_shards, **attrs):
+    """Write the partial results for each shard of the alignments."""
+    partial_fps = []
+    for shard, (start, end) in enumerate(
+        shard_offsets(fp, n_shards, group_reads=True)
+    ):
+        acc, assigner = make_accumulators(
+            multimapping=method, quantiles=quantiles
+        )
+        n_parsed = accumulate_alignments(
+            FileRange(fp, start, end), acc, assigner
+        )
+        shard_attrs = {
+            "input": "example",
+            "shard": shard,
+            "n_shards": n_shards,
+            "multimapping": method,
+            "quantiles": quantiles,
+            "ref_db_url": "example.dmnd",
+            "total_reads": 1000,
+            "total_bases": 100000,
+            "nalignments": n_parsed,
+        }
+        shard_attrs.update(attrs)
+        partial_fp = os.path.join(temp_folder, "{}.{}.partial".format(
+            shard_attrs["input"], shard
+        ))
+        write_partial(partial_fp, acc, assigner, shard_attrs)
+        partial_fps.append(partial_fp)
+    return partial_fps
+
+
+# Merging the partial results (in any order) gives the same output as
+# parsing all of the alignments at once
+for method, quantiles in [("all", False), ("em", True), ("best", False)]:
+    partial_fps = write_shards(method, quantiles, 4)
+    acc, assigner, attrs = merge_partials(partial_fps[::-1])
+    assert [a["shard"] for a in attrs] == [0, 1, 2, 3]
+    assert sum([a["nalignments"] for a in attrs]) == 20833
+    merged = summarize_alignments(acc, assigner)
+    assert merged == parse_alignment(
+        fp, multimapping=method, quantiles=quantiles
+    ), method
+
+# Every shard must be present, from the same sample
+partial_fps = write_shards("all", False, 4)
+for fps, expected in [
+    (partial_fps[1:], "Expected one partial result"),
+    (partial_fps + partial_fps[:1], "Expected one partial result"),
+]:
+    try:
+        merge_partials(fps)
+        assert False
+    except AssertionError as e:
+        assert expected in str(e), str(e)
+
+other_fps = write_shards("all", False, 4, input="other")
+try:
+    merge_partials(partial_fps[:2] + other_fps[2:])
+    assert False
+except AssertionError as e:
+    assert "different values for input" in str(e), str(e)
+
+# Shards with the same file name in different folders of S3 can be fetched
+# side by side, and merged (using a stand-in for the AWS CLI which copies
+# from a local folder)
+bucket = os.path.join(temp_folder, "bucket")
+bin_folder = os.path.join(temp_folder, "bin")
+os.mkdir(bin_folder)
+with open(os.path.join(bin_folder, "aws"), "wt") as fo:
+    fo.write("""#!{}
+import sys
+import shutil
+src, dst = sys.argv[-2:]
+shutil.copy("{}/" + src[len("s3://"):], dst)
+""".format(sys.executable, bucket))
+os.chmod(os.path.join(bin_folder, "aws"), 0o755)
+os.environ["PATH"] = bin_folder + ":" + os.environ["PATH"]
+
+urls = []
+for shard, partial_fp in enumerate(write_shards("all", False, 2)):
+    os.makedirs(os.path.join(bucket, "shard{}".format(shard)))
+    shutil.copy(partial_fp, os.path.join(
+        bucket, "shard{}".format(shard), "sample.partial"
+    ))
+    urls.append("s3://shard{}/sample.partial".format(shard))
+fetch_folder = os.path.join(temp_folder, "fetched")
+os.mkdir(fetch_folder)
+fetched = [
+    get_reference_database(
+        url, fetch_folder, local_name="shard_{}.partial".format(ix)
+    )
+    for ix, url in enumerate(urls)
+]
+assert len(set(fetched)) == 2
+acc, assigner, attrs = merge_partials(fetched)
+assert [a["shard"] for a in attrs] == [0, 1]
+assert summarize_alignments(acc, assigner) == parse_alignment(fp)
+
+shutil.rmtree(temp_folder)
+
+print("Success")
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import numpy as np
+from Bio.Seq import Seq
+from Bio.Data import CodonTable
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from lib.prefilter_helpers import ALPHABETS
+from lib.prefilter_helpers import NUCLEOTIDE_CODES
+from lib.prefilter_helpers import Prefilter
+from lib.prefilter_helpers import BloomFilter
+from lib.prefilter_helpers import codon_table
+from lib.prefilter_helpers import seed_codes
+from lib.prefilter_helpers import build_prefilter
+from lib.prefilter_helpers import prefilter_fastq
+from lib.prefilter_helpers import translate_frames
+from lib.prefilter_helpers import amino_acid_codes
+
+fasta_fp = "/usr/map_viruses/tests/example.fastp"
+temp_folder = tempfile.mkdtemp()
+rng = np.random.RandomState(0)
+
+# Every frame is translated the same way as Biopython, except that stop
+# codons and codons with unknown bases can't be part of a seed
+dna = "".join(rng.choice(list("ACGT"), size=100)) + "N" + "ACGTTGCA"
+full = ALPHABETS["full"]
+bases = NUCLEOTIDE_CODES[np.frombuffer(dna.encode("utf-8"), dtype=np.uint8)]
+frames = list(translate_frames(bases, codon_table(full)))
+assert len(frames) == 6
+for strand, seq in [(0, Seq(dna)), (1, Seq(dna).reverse_complement())]:
+    for frame in range(3):
+        aa, start = frames[3 * strand + frame]
+        expected = "".join(
+            "X" if "N" in seq[ix:ix + 3]
+            else str(seq[ix:ix + 3].translate(table=11)).replace("*", "X")
+            for ix in range(frame, len(seq) - 2, 3)
+        )
+        assert aa.shape[0] == start.shape[0] == len(expected)
+        positions = np.arange(frame, len(dna) - 2, 3)
+        assert (start == (positions if strand == 0 else len(dna) - 1 - positions)).all()
+        assert (aa == amino_acid_codes(full)[
+            np.frombuffer(expected.encode("utf-8"), dtype=np.uint8)
+        ]).all()
+
+# Seeds skip the positions marked 0, and any seed with an invalid residue
+aa = amino_acid_codes(full)[np.frombuffer(b"ACDXEF", dtype=np.uint8)]
+codes, valid = seed_codes(aa, full, shape="101")
+assert list(valid) == [True, False, True, False]
+assert codes[0] == 0 * 20 + 2 and codes[2] == 2 * 20 + 3
+
+# A Bloom filter finds everything added to it, and little else
+bloom = BloomFilter.empty(10000, fpr=0.01)
+added = rng.randint(0, 2 ** 62, size=10000, dtype=np.int64).astype(np.uint64)
+bloom.add(added)
+assert bloom.contains(added).all()
+other = rng.randint(0, 2 ** 62, size=100000, dtype=np.int64).astype(np.uint64)
+assert bloom.contains(other).mean() < 0.03
+
+# Reads translated back from the reference proteins are kept
+prefilter_fp = os.path.join(temp_folder, "example.prefilter")
+build_prefilter(fasta_fp, prefilter_fp)
+prefilter = Prefilter(prefilter_fp)
+assert prefilter.attrs["n_seeds"] > 0
+
+codons = {}
+for codon, a in CodonTable.unambiguous_dna_by_id[11].forward_table.items():
+    codons.setdefault(a, []).append(codon)
+proteins = [seq for header, seq in SimpleFastaParser(open(fasta_fp))]
+fastq_fp = os.path.join(temp_folder, "reads.fastq")
+with open(fastq_fp, "wt") as fo:
+    for ix in range(2000):
+        if ix % 2 == 0:
+            protein = proteins[rng.randint(len(proteins))]
+            start = rng.randint(max(1, len(protein) - 50))
+            dna = "".join(
+                codons[a][0] for a in protein[start:start + 50] if a in codons
+            )
+            if ix % 4 == 0:
+                dna = str(Seq(dna).reverse_complement())
+        else:
+            dna = "".join(rng.choice(list("ACGT"), size=150))
+        fo.write("@read{}\n{}\n+\n{}\n".format(ix, dna, "I" * len(dna)))
+
+kept_fp = os.path.join(temp_folder, "kept.fastq")
+counts = prefilter_fastq(fastq_fp, kept_fp, prefilter, chunk_size=300)
+assert counts["reads"] == 2000
+lines = open(kept_fp, "rt").readlines()
+assert len(lines) == 4 * counts["kept"]
+names = [int(line[5:]) for line in lines[0::4]]
+assert names == sorted(names)
+assert all(ix in names for ix in range(0, 2000, 2))
+assert counts["kept"] < 1200
+
+# The same reads are kept with more threads, in the same order
+for threads in [2, 4]:
+    threaded_fp = os.path.join(temp_folder, "kept_{}.fastq".format(threads))
+    assert prefilter_fastq(
+        fastq_fp, threaded_fp, prefilter, threads=threads, chunk_size=300
+    ) == counts
+    assert open(threaded_fp, "rb").read() == open(kept_fp, "rb").read()
+
+# Requiring more seed hits keeps fewer reads
+strict = prefilter_fastq(
+    fastq_fp, kept_fp, prefilter, min_hits=1000, chunk_size=300
+)
+assert strict["kept"] == 0
+
+shutil.rmtree(temp_folder)
+
+print("Success")
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+import os
+import time
+import fcntl
+import shutil
+import tempfile
+from multiprocessing import Pool
+from exec_helpers import fetch_cached
+from exec_helpers import lock_file
+from exec_helpers import release_cached
+
+temp_folder = tempfile.mkdtemp()
+cache_folder = os.path.join(temp_folder, "cache")
+downloads_fp = os.path.join(temp_folder, "downloads.txt")
+
+
+def download(local_fp):
+    """Stand-in for a slow download, recording each call."""
+    with open(downloads_fp, "at") as fo:
+        fo.write(local_fp + "\n")
+    time.sleep(0.5)
+    with open(local_fp, "wt") as fo:
+        fo.write("x" * 1000)
+
+
+def fetch(name):
+    return fetch_cached(name, cache_folder, download)
+
+
+# Concurrent requests for the same file only download it once
+pool = Pool(4)
+paths = pool.map(fetch, ["db.dmnd"] * 4)
+pool.close()
+pool.join()
+assert len(set(paths)) == 1
+assert open(paths[0], "rt").read() == "x" * 1000
+assert len(open(downloads_fp, "rt").readlines()) == 1
+
+# No temporary files are left behind
+assert sorted(os.listdir(cache_folder)) == [
+    "db.dmnd", "db.dmnd.json", "db.dmnd.lock", "db.dmnd.use.lock"
+]
+
+# Files beyond the size budget are removed, least recently used first,
+# once they are no longer in use
+a_fp = fetch_cached("a.dmnd", cache_folder, download, cache_size=2500)
+release_cached(a_fp)
+time.sleep(0.1)
+fetch_cached("db.dmnd", cache_folder, download, cache_size=2500)
+time.sleep(0.1)
+fetch_cached("b.dmnd", cache_folder, download, cache_size=2500)
+assert os.path.exists(os.path.join(cache_folder, "db.dmnd"))
+assert os.path.exists(os.path.join(cache_folder, "b.dmnd"))
+assert not os.path.exists(os.path.join(cache_folder, "a.dmnd"))
+assert len(open(downloads_fp, "rt").readlines()) == 3
+
+# Files in use by another process are not removed
+def use_and_wait(name):
+    local_fp = fetch_cached(name, cache_folder, download)
+    time.sleep(2)
+    return local_fp
+
+
+release_cached(os.path.join(cache_folder, "db.dmnd"))
+release_cached(os.path.join(cache_folder, "b.dmnd"))
+pool = Pool(1)
+in_use = pool.apply_async(use_and_wait, ("c.dmnd",))
+time.sleep(1)
+fetch_cached("d.dmnd", cache_folder, download, cache_size=1500)
+assert os.path.exists(in_use.get())
+assert os.path.exists(os.path.join(cache_folder, "d.dmnd"))
+assert not os.path.exists(os.path.join(cache_folder, "db.dmnd"))
+assert not os.path.exists(os.path.join(cache_folder, "b.dmnd"))
+pool.close()
+pool.join()
+
+# Once it is released, it can be removed (along with its lock files)
+fetch_cached("e.dmnd", cache_folder, download, cache_size=1500)
+assert not os.path.exists(in_use.get())
+assert sorted(os.listdir(cache_folder)) == [".evict.lock"] + [
+    name + ext
+    for name in ["d.dmnd", "e.dmnd"]
+    for ext in ["", ".json", ".lock", ".use.lock"]
+]
+
+# Removing a lock file while another process waits on it doesn't let two
+# processes hold the lock at once (the pool is started first, so that it
+# doesn't inherit the lock)
+pool = Pool(1)
+lock = lock_file(os.path.join(cache_folder, "f.dmnd.lock"), fcntl.LOCK_EX)
+fetched = pool.apply_async(fetch, ("f.dmnd",))
+time.sleep(0.5)
+os.unlink(os.path.join(cache_folder, "f.dmnd.lock"))
+new_lock = lock_file(os.path.join(cache_folder, "f.dmnd.lock"), fcntl.LOCK_EX)
+lock.close()
+time.sleep(0.5)
+assert len(open(downloads_fp, "rt").readlines()) == 6
+new_lock.close()
+assert open(fetched.get(), "rt").read() == "x" * 1000
+assert len(open(downloads_fp, "rt").readlines()) == 7
+pool.close()
+pool.join()
+
+shutil.rmtree(temp_folder)
+
+print("Success")
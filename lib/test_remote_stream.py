@@ -0,0 +1,267 @@
+#!/usr/bin/python
+
+import io
+import os
+import sys
+import gzip
+import time
+import socket
+import struct
+import shutil
+import tempfile
+import threading
+import subprocess
+from lib.stream_helpers import GzipStreamReader
+from lib.stream_helpers import ResumableStream
+from lib.stream_helpers import open_s3_stream
+from lib.stream_helpers import open_ftp_stream
+from lib.fastq_helpers import clean_fastq_stream
+
+fastq = "".join([
+    "@read{} description\nACGTACGT\n+\nIIIIIIII\n".format(ix)
+    for ix in range(10000)
+]).encode()
+
+
+class FlakyConnection(object):
+    """Local stand-in for a remote file whose connection drops."""
+
+    def __init__(self, data, offset, fail_after):
+        self.handle = io.BytesIO(data[offset:])
+        self.fail_after = fail_after
+        self.n_read = 0
+
+    def read(self, size=-1):
+        if self.n_read >= self.fail_after:
+            raise IOError("Connection reset")
+        data = self.handle.read(min(size, self.fail_after - self.n_read))
+        self.n_read += len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+def flaky_stream(data, fail_after=10000, **kwargs):
+    offsets = []
+
+    def open_at(offset):
+        offsets.append(offset)
+        return FlakyConnection(data, offset, fail_after)
+
+    stream = ResumableStream(
+        open_at, size=len(data), name="test", retry_wait=0, **kwargs
+    )
+    return stream, offsets
+
+
+# The stream resumes from the last byte read after each failure
+stream, offsets = flaky_stream(fastq)
+assert io.BufferedReader(stream).read() == fastq
+assert len(offsets) == 1 + len(fastq) // 10000
+assert offsets == sorted(offsets)
+assert offsets[1] == 10000
+
+# Compressed data (with multiple gzip members) is decompressed as it is read
+compressed = io.BytesIO()
+with gzip.GzipFile(fileobj=compressed, mode="wb") as fo:
+    fo.write(fastq[:1000])
+with gzip.GzipFile(fileobj=compressed, mode="wb") as fo:
+    fo.write(fastq[1000:])
+stream, offsets = flaky_stream(compressed.getvalue(), fail_after=5000)
+f_in = io.BufferedReader(GzipStreamReader(stream))
+f_out = io.BytesIO()
+read_stats = clean_fastq_stream(f_in, f_out)
+assert read_stats == {"reads": 10000, "bases": 80000}
+assert f_out.getvalue().split(b"\n")[0] == b"@read0-r1"
+
+# Give up after too many failures
+stream, offsets = flaky_stream(fastq, fail_after=0, max_retries=2)
+try:
+    stream.read(100)
+    failed = False
+except IOError:
+    failed = True
+assert failed
+assert len(offsets) == 3
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class CuttingProxy(object):
+    """
+    Forward TCP connections to a server, resetting each connection once
+    it has returned a number of bytes (like a connection which drops).
+    """
+
+    def __init__(self, upstream_port, cut_after):
+        self.upstream_port = upstream_port
+        self.cut_after = cut_after
+        self.n_connections = 0
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(16)
+        self.port = self.server.getsockname()[1]
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+
+    def accept(self):
+        while True:
+            client, addr = self.server.accept()
+            self.n_connections += 1
+            upstream = socket.create_connection(
+                ("127.0.0.1", self.upstream_port)
+            )
+            for target in [self.to_upstream, self.to_client]:
+                thread = threading.Thread(target=target, args=(client, upstream))
+                thread.daemon = True
+                thread.start()
+
+    def to_upstream(self, client, upstream):
+        try:
+            while True:
+                data = client.recv(65536)
+                if len(data) == 0:
+                    break
+                upstream.sendall(data)
+        except socket.error:
+            pass
+
+    def to_client(self, client, upstream):
+        n_sent = 0
+        try:
+            while n_sent < self.cut_after:
+                data = upstream.recv(min(65536, self.cut_after - n_sent))
+                if len(data) == 0:
+                    break
+                client.sendall(data)
+                n_sent += len(data)
+        except socket.error:
+            pass
+        # Reset the connection, rather than closing it cleanly (stopping
+        # the other thread reading from it first)
+        client.setsockopt(
+            socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0)
+        )
+        client.shutdown(socket.SHUT_RD)
+        client.close()
+        upstream.close()
+
+
+temp_folder = tempfile.mkdtemp()
+compressed = io.BytesIO()
+with gzip.GzipFile(fileobj=compressed, mode="wb", compresslevel=0) as fo:
+    fo.write(fastq)
+compressed = compressed.getvalue()
+
+# S3 (served by moto): the connection is reset every 100kB, and the stream
+# resumes each time at the byte where it was cut off (reading less than
+# that at a time, as a read which is cut off is lost)
+os.environ.update({
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "AWS_DEFAULT_REGION": "us-east-1",
+})
+import boto3
+s3_port = free_port()
+moto = subprocess.Popen(
+    [sys.executable, "-m", "moto.server", "-p", str(s3_port)],
+    stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT
+)
+try:
+    s3 = boto3.client(
+        "s3", endpoint_url="http://127.0.0.1:{}".format(s3_port)
+    )
+    for attempt in range(100):
+        try:
+            s3.create_bucket(Bucket="bucket")
+            break
+        except Exception:
+            time.sleep(0.1)
+    s3.put_object(Bucket="bucket", Key="reads.fastq.gz", Body=compressed)
+
+    proxy = CuttingProxy(s3_port, cut_after=100000)
+    flaky_s3 = boto3.client(
+        "s3", endpoint_url="http://127.0.0.1:{}".format(proxy.port)
+    )
+    stream = open_s3_stream(
+        "s3://bucket/reads.fastq.gz", client=flaky_s3, retry_wait=0,
+        max_retries=1
+    )
+    assert io.BufferedReader(
+        GzipStreamReader(stream, chunk_size=65536)
+    ).read() == fastq
+    assert proxy.n_connections > len(compressed) // 100000
+finally:
+    moto.terminate()
+    moto.wait()
+
+# FTP (served by pyftpdlib): each transfer stops after 100kB, and the
+# stream resumes each time with REST
+from pyftpdlib.servers import ThreadedFTPServer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.filesystems import AbstractedFS
+
+with open(os.path.join(temp_folder, "reads.fastq.gz"), "wb") as fo:
+    fo.write(compressed)
+rest_offsets = []
+
+
+class TruncatedFile(object):
+    """A file which ends after 100kB (from wherever it is opened)."""
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.remaining = 100000
+
+    def seek(self, offset, *args):
+        rest_offsets.append(offset)
+        return self.handle.seek(offset, *args)
+
+    def read(self, size=-1):
+        data = self.handle.read(min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.handle, name)
+
+
+class TruncatingFS(AbstractedFS):
+    def open(self, filename, mode):
+        return TruncatedFile(AbstractedFS.open(self, filename, mode))
+
+
+authorizer = DummyAuthorizer()
+authorizer.add_anonymous(temp_folder)
+handler = type("Handler", (FTPHandler,), {
+    "authorizer": authorizer,
+    "abstracted_fs": TruncatingFS,
+    "use_sendfile": False,
+})
+ftp_server = ThreadedFTPServer(("127.0.0.1", 0), handler)
+thread = threading.Thread(target=ftp_server.serve_forever)
+thread.daemon = True
+thread.start()
+stream = open_ftp_stream(
+    "ftp://127.0.0.1:{}/reads.fastq.gz".format(ftp_server.address[1]),
+    retry_wait=0, max_retries=1
+)
+assert io.BufferedReader(
+    GzipStreamReader(stream, chunk_size=65536)
+).read() == fastq
+stream.close()
+assert rest_offsets == list(range(100000, len(compressed), 100000))
+ftp_server.close_all()
+
+shutil.rmtree(temp_folder)
+
+print("Success")
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+
+import numpy as np
+import pandas as pd
+from aln_helpers import SubjectMoments
+from aln_helpers import HISTOGRAM_BINS
+from aln_helpers import parse_alignment
+
+fp = "/usr/map_viruses/tests/example.aln"
+
+aln = pd.read_table(fp, header=None, sep="\t")
+aln = aln.loc[:, [1, 2, 3, 9]]
+aln.columns = ["sseqid", "pident", "length", "bitscore"]
+
+output = parse_alignment(fp, quantiles=True)
+assert len(output) == aln["sseqid"].unique().shape[0]
+
+# The mean and variance match those computed from every alignment
+for r in output:
+    sub = aln.loc[aln["sseqid"] == r["protein"]]
+    assert r["nreads"] == sub.shape[0]
+    for k, col in [("pctid", "pident"), ("alen", "length"), ("bitscore", "bitscore")]:
+        values = sub[col].values.astype(np.float64)
+        assert abs(r[k] - values.mean()) < 1e-6, (k, r[k], values.mean())
+        assert abs(r[k + "_var"] - values.var()) < 1e-4, (k, r[k + "_var"], values.var())
+
+        # The median is within one histogram bin of the exact value, with
+        # the range of the histogram doubled to hold the largest value
+        lo, hi, n_bins = HISTOGRAM_BINS[k]
+        width = (hi - lo) / n_bins
+        while lo + width * n_bins < values.max():
+            width *= 2
+        assert abs(r[k + "_median"] - np.median(values)) <= width, (k, r[k + "_median"], np.median(values))
+
+# Merging two partial accumulators gives the same result as one pass
+np.random.seed(0)
+ix = np.random.randint(0, 50, 10000)
+values = np.round(np.random.uniform(0, 100, 10000), 2)
+
+single = SubjectMoments(bins=HISTOGRAM_BINS["pctid"])
+single.add(ix, values)
+
+first = SubjectMoments(bins=HISTOGRAM_BINS["pctid"])
+second = SubjectMoments(bins=HISTOGRAM_BINS["pctid"])
+first.add(ix[:4000], values[:4000])
+second.add(ix[4000:], values[4000:])
+second.merge(first)
+
+subjects = np.arange(50)
+for a, b in [
+    (single.count, second.count),
+    (single.total, second.total),
+    (single.total_sq, second.total_sq),
+    (single.mean(subjects), second.mean(subjects)),
+    (single.var(subjects), second.var(subjects)),
+    (single.quantile(subjects, 0.5), second.quantile(subjects, 0.5)),
+]:
+    assert (a[:50] == b[:50]).all()
+
+# Values past the top of the initial range widen the histogram rather
+# than being clipped, in whichever order they are merged
+values = np.round(np.random.uniform(0, 1000, 10000), 2)
+values[ix == 0] = np.random.uniform(5000, 6000, (ix == 0).sum())
+single = SubjectMoments(bins=HISTOGRAM_BINS["bitscore"])
+single.add(ix, values)
+for split in [10, 4000, 9990]:
+    first = SubjectMoments(bins=HISTOGRAM_BINS["bitscore"])
+    second = SubjectMoments(bins=HISTOGRAM_BINS["bitscore"])
+    first.add(ix[:split], values[:split])
+    second.add(ix[split:], values[split:])
+    for a, b in [(first, second), (second, first)]:
+        merged = SubjectMoments(bins=HISTOGRAM_BINS["bitscore"])
+        merged.merge(a)
+        merged.merge(b)
+        assert (merged.quantile(subjects, 0.5) == single.quantile(subjects, 0.5)).all()
+
+lo, hi, n_bins = HISTOGRAM_BINS["bitscore"]
+medians = single.quantile(subjects, 0.5)
+for i in subjects:
+    width = (hi - lo) / n_bins * 2 ** (5 if i == 0 else 3)
+    assert abs(medians[i] - np.median(values[ix == i])) <= width, (i, medians[i])
+assert medians[0] > 5000
+
+print("Success")
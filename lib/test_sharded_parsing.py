@@ -0,0 +1,67 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import numpy as np
+from aln_helpers import shard_offsets
+from aln_helpers import parse_alignment
+
+fp = "/usr/map_viruses/tests/example.aln"
+
+temp_folder = tempfile.mkdtemp()
+
+# Reads with alignments to several proteins, with a range of scores
+align_fp = os.path.join(temp_folder, "multimapping.aln")
+np.random.seed(0)
+with open(align_fp, "wt") as fo:
+    for read in range(2000):
+        for subject in np.unique(np.random.randint(0, 20, np.random.randint(1, 4))):
+            start = np.random.randint(1, 70)
+            fo.write("read{}\tprot{}\t{}\t30\t1\t90\t{}\t{}\t1e-5\t{}\t90\t100\n".format(
+                read, subject, np.random.randint(70, 100), start, start + 29,
+                np.random.randint(40, 60)
+            ))
+
+# Shards start at the beginning of a line, and keep each read together
+with open(align_fp, "rb") as f:
+    data = f.read()
+shards = shard_offsets(align_fp, 7, group_reads=True)
+assert len(shards) == 7
+assert shards[0][0] == 0 and shards[-1][1] == len(data)
+for (start, end), (next_start, next_end) in zip(shards[:-1], shards[1:]):
+    assert end == next_start
+    assert data[end - 1:end] == b"\n"
+    last_read = data[start:end].splitlines()[-1].split(b"\t")[0]
+    first_read = data[next_start:next_end].splitlines()[0].split(b"\t")[0]
+    assert last_read != first_read
+
+# Splitting a file into more shards than lines
+with open(fp, "rb") as f:
+    n_lines = len(f.read().splitlines())
+assert len(shard_offsets(fp, 10 * n_lines)) == n_lines
+
+# Parsing in parallel gives exactly the same result as a single process
+for input_fp, method, quantiles in [
+    (fp, "all", False),
+    (fp, "em", True),
+    (align_fp, "all", True),
+    (align_fp, "best", False),
+    (align_fp, "em", False),
+]:
+    single = parse_alignment(
+        input_fp, multimapping=method, quantiles=quantiles
+    )
+    for workers in [2, 5]:
+        sharded = parse_alignment(
+            input_fp,
+            chunksize=500,
+            multimapping=method,
+            quantiles=quantiles,
+            workers=workers
+        )
+        assert sharded == single, (input_fp, method, workers)
+
+shutil.rmtree(temp_folder)
+
+print("Success")
@@ -0,0 +1,68 @@
+#!/usr/bin/python
+
+import os
+import sys
+import shutil
+import tempfile
+from lib.fastq_helpers import get_sra
+
+temp_folder = tempfile.mkdtemp()
+bin_folder = os.path.join(temp_folder, "bin")
+os.mkdir(bin_folder)
+args_fp = os.path.join(temp_folder, "fasterq-dump.args")
+
+# SRA-style output for three spots, with both reads of each spot sharing
+# the same name
+record = "@SRR000001.{0} {0} length=4\nACGT\n+SRR000001.{0} {0} length=4\nIIII\n"
+spots = "".join([record.format(spot) * 2 for spot in range(1, 4)])
+spots_fp = os.path.join(temp_folder, "spots.fastq")
+with open(spots_fp, "wt") as fo:
+    fo.write(spots)
+
+# Stand-ins for the SRA toolkit: prefetch writes an (empty) archive to a
+# folder named for the accession, and fasterq-dump records its arguments
+# and writes the reads to STDOUT
+shims = {
+    "prefetch": """
+import os
+import sys
+folder = os.path.join(sys.argv[2], sys.argv[3])
+os.makedirs(folder)
+open(os.path.join(folder, sys.argv[3] + ".sra"), "wt").close()
+""",
+    "fasterq-dump": """
+import sys
+with open("{}", "wt") as fo:
+    fo.write(" ".join(sys.argv[1:]))
+sys.stdout.write(open("{}", "rt").read())
+""".format(args_fp, spots_fp),
+}
+for name, script in shims.items():
+    fp = os.path.join(bin_folder, name)
+    with open(fp, "wt") as fo:
+        fo.write("#!{}\n{}".format(sys.executable, script))
+    os.chmod(fp, 0o755)
+os.environ["PATH"] = bin_folder + ":" + os.environ["PATH"]
+
+# Every read from each spot is streamed out of fasterq-dump, with the
+# headers cleaned up and numbered (-rN) as they are read
+fp_out = os.path.join(temp_folder, "SRR000001.fastq")
+read_stats = get_sra("SRR000001", temp_folder, fp_out, threads=4)
+assert read_stats == {"reads": 6, "bases": 24}
+lines = open(fp_out, "rt").read().split("\n")
+assert lines[0::4][:6] == [
+    "@SRR000001.{}-r{}".format(1 + ix // 2, ix + 1) for ix in range(6)
+]
+assert lines[2::4][:6] == ["+" + line[1:] for line in lines[0::4][:6]]
+assert lines[1::4][:6] == ["ACGT"] * 6
+
+# The reads were extracted with the threads given, from the archive which
+# was downloaded (and then removed)
+args = open(args_fp, "rt").read().split(" ")
+assert args[:4] == ["--stdout", "--split-spot", "--threads", "4"]
+assert args[-1] == os.path.join(temp_folder, "SRR000001", "SRR000001.sra")
+assert not os.path.exists(os.path.join(temp_folder, "SRR000001"))
+
+shutil.rmtree(temp_folder)
+
+print("Success")
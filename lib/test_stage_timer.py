@@ -0,0 +1,68 @@
+#!/usr/bin/python
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+from timing_helpers import StageTimer
+
+temp_folder = tempfile.mkdtemp()
+
+timer = StageTimer()
+
+with timer.stage("sleep"):
+    time.sleep(0.2)
+
+# CPU time used by subprocesses is recorded separately
+with timer.stage("subprocess"):
+    subprocess.check_call([
+        "python", "-c", "sum(i * i for i in range(3000000))"
+    ])
+
+# Bytes written to disk
+fp = os.path.join(temp_folder, "data.bin")
+with timer.stage("write"):
+    with open(fp, "wb") as fo:
+        fo.write(b"0" * 4000000)
+        fo.flush()
+        os.fsync(fo.fileno())
+
+# Stages which fail are still recorded
+try:
+    with timer.stage("failure"):
+        raise ValueError("expected")
+except ValueError:
+    pass
+
+timings = timer.to_dict()
+assert [name for name, t in timer.items()] == ["sleep", "subprocess", "write", "failure"]
+for name, t in timings.items():
+    for k in [
+        "wall_seconds", "cpu_seconds", "children_cpu_seconds", "read_bytes",
+        "write_bytes", "peak_rss_mb", "children_peak_rss_mb"
+    ]:
+        assert k in t, (name, k)
+
+assert timings["sleep"]["wall_seconds"] >= 0.2
+assert timings["sleep"]["cpu_seconds"] < 0.1
+assert timings["subprocess"]["children_cpu_seconds"] > 0
+assert timings["subprocess"]["children_peak_rss_mb"] > 0
+assert timings["write"]["peak_rss_mb"] > 0
+if "write_chars" in timings["write"]:
+    assert timings["write"]["write_chars"] >= 4000000
+
+# Repeated stages are combined
+copy = timer.copy()
+with copy.stage("sleep"):
+    time.sleep(0.1)
+assert copy.to_dict()["sleep"]["wall_seconds"] >= 0.3
+assert timer.to_dict()["sleep"]["wall_seconds"] < 0.3
+
+# Timings can be written to JSON
+json.dumps(timer.to_dict())
+
+shutil.rmtree(temp_folder)
+
+print("Success")
@@ -0,0 +1,151 @@
+#!/usr/bin/python
+
+import os
+import gzip
+import json
+import shutil
+import tempfile
+import pandas as pd
+from lib import db_helpers
+from lib.db_helpers import parse_gpff
+from lib.db_helpers import iter_records
+from lib.db_helpers import build_database
+from lib.db_helpers import write_database
+from lib.db_helpers import iter_record_batches
+from lib.db_helpers import read_database_metadata
+from lib.metadata_helpers import MetadataIndex
+
+gpff_fp = "/usr/map_viruses/tests/example.gpff"
+tsv_fp = "/usr/map_viruses/tests/example.tsv"
+fastp_fp = "/usr/map_viruses/tests/example.fastp"
+
+temp_folder = tempfile.mkdtemp()
+
+# Expected metadata and sequences for the proteins in the GenBank file
+expected = pd.read_table(tsv_fp, sep="\t", dtype=str)
+sequences = {}
+for line in open(fastp_fp, "rt"):
+    if line.startswith(">"):
+        name = line[1:].strip()
+        sequences[name] = ""
+    else:
+        sequences[name] += line.strip()
+
+# Records are split into batches at record boundaries
+batches = list(iter_record_batches([gpff_fp], batch_size=7))
+assert [len(b) for b in batches] == [7, 7, 7, 7, 2]
+assert all(t.startswith("LOCUS") and t.endswith("//\n") for b in batches for t in b)
+assert "".join(["".join(b) for b in batches]) == open(gpff_fp, "rt").read()
+
+# Compressed files are read in the same way
+gz_fp = os.path.join(temp_folder, "example.gpff.gz")
+with gzip.open(gz_fp, "wt") as fo:
+    fo.write(open(gpff_fp, "rt").read())
+
+records = list(parse_gpff([gpff_fp]))
+assert len(records) == 30
+for threads, batch_size, fps in [
+    (1, 1000, [gpff_fp]),
+    (3, 4, [gpff_fp]),
+    (2, 7, [gz_fp]),
+]:
+    assert list(parse_gpff(fps, threads=threads, batch_size=batch_size)) == records
+
+# The sequences and metadata match the existing database
+for r in records:
+    assert r["sequence"] == sequences[r["protein"]], r["protein"]
+
+prefix = os.path.join(temp_folder, "db")
+diff = build_database([gpff_fp], prefix, threads=2, batch_size=4)
+assert len(diff["added"]) == 30 and diff["sequences_changed"]
+assert json.load(open(prefix + ".diff.json", "rt")) == diff
+
+tsv = pd.read_table(prefix + ".tsv", sep="\t", dtype=str)
+assert list(tsv.columns) == list(expected.columns)
+expected = expected.set_index("protein").loc[tsv["protein"].values].reset_index()
+pd.testing.assert_frame_equal(tsv, expected[tsv.columns])
+assert tsv["genome"].isnull().sum() == 5
+assert tsv["region"].str.endswith(")").sum() == 5
+
+fastp = open(prefix + ".fastp", "rt").read().split("\n")
+assert fastp[:-1:2] == [">" + p for p in tsv["protein"]]
+assert fastp[1::2] == [sequences[p] for p in tsv["protein"]]
+
+metadata = read_database_metadata(prefix + ".tsv")
+assert metadata["length"].dtype.kind == "i"
+assert metadata["taxid"].values[0] == "1337877"
+index = MetadataIndex(prefix + ".idx")
+assert len(index) == 30
+pd.testing.assert_frame_equal(
+    index.detected_metadata(["YP_008320337"]).reset_index(drop=True),
+    metadata[metadata["genome"] == "NC_021865.1"].reset_index(drop=True)
+)
+
+# Nothing is done if the input files are unchanged
+mtime = os.path.getmtime(prefix + ".tsv")
+diff = build_database([gpff_fp], prefix)
+assert diff["added"] == [] and not diff["sequences_changed"]
+assert os.path.getmtime(prefix + ".tsv") == mtime
+
+# Only the records which are new or have changed are parsed again
+parsed = []
+parse_gpff_records = db_helpers.parse_gpff_records
+
+
+def count_parsed(texts):
+    parsed.extend(texts)
+    return parse_gpff_records(texts)
+
+
+db_helpers.parse_gpff_records = count_parsed
+
+texts = list(iter_records(gpff_fp))
+new_texts = (
+    texts[:3] +
+    # Change the metadata for a protein
+    [texts[3].replace('/product="', '/product="new ')] +
+    # Change the sequence of another protein
+    [texts[4].replace("\n        1 m", "\n        1 a")] +
+    # Remove a protein, and add a new one
+    texts[6:] +
+    [texts[5].replace(records[5]["protein"], "NEW_PROTEIN")]
+)
+assert new_texts[3] != texts[3] and new_texts[4] != texts[4]
+updated_fp = os.path.join(temp_folder, "updated.gpff")
+with open(updated_fp, "wt") as fo:
+    fo.write("".join(new_texts))
+
+diff = build_database([updated_fp], prefix, batch_size=4)
+assert len(parsed) == 3
+assert diff["added"] == ["NEW_PROTEIN"]
+assert diff["removed"] == [records[5]["protein"]]
+assert diff["changed"] == [records[3]["protein"], records[4]["protein"]]
+assert diff["sequences_changed"]
+
+# The result is the same as building the database from scratch
+db_helpers.parse_gpff_records = parse_gpff_records
+full_prefix = os.path.join(temp_folder, "full")
+build_database([updated_fp], full_prefix, threads=2)
+for ending in [".fastp", ".tsv", ".manifest"]:
+    assert open(prefix + ending, "rb").read() == open(full_prefix + ending, "rb").read(), ending
+assert read_database_metadata(prefix + ".tsv")["product"].values[3].startswith("new ")
+
+# Changes to the metadata alone leave the sequences unchanged
+with open(updated_fp, "wt") as fo:
+    fo.write("".join(new_texts).replace("hypothetical protein", "unknown protein"))
+diff = build_database([updated_fp], prefix, threads=2)
+assert len(diff["changed"]) > 0 and not diff["sequences_changed"]
+assert MetadataIndex(prefix + ".idx").detected_metadata(
+    ["YP_008320364"]
+)["product"].str.contains("unknown protein").any()
+
+# Protein names must be unique
+try:
+    write_database(parse_gpff([gpff_fp, gpff_fp]), prefix, chunk_size=7)
+    assert False
+except AssertionError as e:
+    assert "not unique" in str(e)
+
+shutil.rmtree(temp_folder)
+
+print("Success")
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+"""Functions to record the time and resources used by each stage of a run."""
+
+import sys
+import time
+import logging
+import resource
+from contextlib import contextmanager
+
+# ru_maxrss is reported in bytes on macOS, and in kilobytes elsewhere
+RSS_UNITS = 1 if sys.platform == "darwin" else 1024
+
+# ru_inblock and ru_oublock count blocks of 512 bytes
+BLOCK_SIZE = 512
+
+
+def read_proc_io(fp="/proc/self/io"):
+    """
+    Return the bytes read and written by this process (including any
+    children which have exited), or None where not available.
+    """
+    values = {}
+    try:
+        with open(fp, "rt") as f:
+            for line in f:
+                k, v = line.split(":", 1)
+                values[k.strip()] = int(v)
+    except (IOError, OSError, ValueError):
+        return None
+    return values
+
+
+def resource_snapshot():
+    """Return the resources used so far by this process and its children."""
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    snapshot = {
+        "wall": time.time(),
+        "cpu": self_usage.ru_utime + self_usage.ru_stime,
+        "children_cpu": child_usage.ru_utime + child_usage.ru_stime,
+        "read_blocks": self_usage.ru_inblock + child_usage.ru_inblock,
+        "write_blocks": self_usage.ru_oublock + child_usage.ru_oublock,
+        "peak_rss": self_usage.ru_maxrss * RSS_UNITS,
+        "children_peak_rss": child_usage.ru_maxrss * RSS_UNITS,
+    }
+    proc_io = read_proc_io()
+    if proc_io is not None:
+        snapshot["read_chars"] = proc_io.get("rchar", 0)
+        snapshot["write_chars"] = proc_io.get("wchar", 0)
+    return snapshot
+
+
+class StageTimer(object):
+    """
+    Record the wall time, CPU time (of this process and of its children),
+    peak memory and I/O for each named stage of a run.
+    """
+
+    def __init__(self, timings=None):
+        # Timings for each stage, in the order they were first run
+        self.timings = {}
+        self.order = []
+        for name, timing in (timings or []):
+            self.add(name, dict(timing))
+
+    def add(self, name, timing):
+        """Add the timing for a stage, combined with any earlier runs."""
+        if name not in self.timings:
+            self.timings[name] = timing
+            self.order.append(name)
+            return
+        previous = self.timings[name]
+        for k, v in timing.items():
+            if k.startswith("peak_rss") or k.startswith("children_peak_rss"):
+                previous[k] = max(previous.get(k, 0), v)
+            else:
+                previous[k] = previous.get(k, 0) + v
+
+    @contextmanager
+    def stage(self, name):
+        """Record the resources used by everything run within a block."""
+        start = resource_snapshot()
+        try:
+            yield
+        finally:
+            end = resource_snapshot()
+            timing = {
+                "wall_seconds": round(end["wall"] - start["wall"], 3),
+                "cpu_seconds": round(end["cpu"] - start["cpu"], 3),
+                "children_cpu_seconds": round(
+                    end["children_cpu"] - start["children_cpu"], 3
+                ),
+                "read_bytes": BLOCK_SIZE * (
+                    end["read_blocks"] - start["read_blocks"]
+                ),
+                "write_bytes": BLOCK_SIZE * (
+                    end["write_blocks"] - start["write_blocks"]
+                ),
+                # Peak memory is the high-water mark at the end of the stage
+                "peak_rss_mb": round(end["peak_rss"] / 1e6, 1),
+                "children_peak_rss_mb": round(end["children_peak_rss"] / 1e6, 1),
+            }
+            if "read_chars" in start and "read_chars" in end:
+                timing["read_chars"] = end["read_chars"] - start["read_chars"]
+                timing["write_chars"] = end["write_chars"] - start["write_chars"]
+            self.add(name, timing)
+            logging.info("Stage {}: {:.2f}s wall, {:.2f}s CPU ({:.2f}s in subprocesses)".format(
+                name,
+                timing["wall_seconds"],
+                timing["cpu_seconds"],
+                timing["children_cpu_seconds"],
+            ))
+
+    def items(self):
+        """Return (name, timing) for each stage, in order."""
+        return [(name, self.timings[name]) for name in self.order]
+
+    def to_dict(self):
+        """Return the timings for every stage, keyed by stage name."""
+        return dict(self.items())
+
+    def copy(self):
+        return StageTimer(timings=self.items())
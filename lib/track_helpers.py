@@ -0,0 +1,108 @@
+#!/usr/bin/python
+"""Functions to save and read the depth of coverage along each protein."""
+
+import logging
+import numpy as np
+from lib.aln_helpers import _segment_positions
+from lib.store_helpers import ArrayStore
+from lib.store_helpers import write_arrays
+
+
+def coverage_tracks(acc):
+    """
+    Return the depth along every subject with alignments, run-length
+    encoded as a dict of arrays. The runs for subject i are found at
+    run_indptr[i]:run_indptr[i + 1], each giving the position (0-based)
+    where the run starts and the depth along the run.
+    """
+    detected = acc.detected()
+    subject_len = acc.subject_len[detected]
+    if detected.shape[0] == 0:
+        return {
+            "protein": acc.names(detected),
+            "length": subject_len,
+            "run_indptr": np.zeros(1, dtype=np.int64),
+            "run_start": np.zeros(0, dtype=np.uint32),
+            "run_depth": np.zeros(0, dtype=np.uint32),
+        }
+
+    # Every difference array sums to zero, so a single cumsum over the
+    # flat buffer gives the depth at each position of every subject
+    depth = np.cumsum(acc.events[:acc.events_used])
+    depth = depth[_segment_positions(acc.offsets[detected], subject_len)]
+
+    # A run starts at the start of each subject, or where the depth changes
+    segment_start = np.concatenate([[0], np.cumsum(subject_len)[:-1]])
+    is_start = np.ones(depth.shape[0], dtype=bool)
+    is_start[1:] = depth[1:] != depth[:-1]
+    is_start[segment_start] = True
+    run_pos = np.flatnonzero(is_start)
+
+    # Number of runs for each subject
+    run_indptr = np.zeros(detected.shape[0] + 1, dtype=np.int64)
+    run_indptr[1:] = np.cumsum(np.add.reduceat(is_start, segment_start))
+
+    return {
+        "protein": acc.names(detected),
+        "length": subject_len,
+        "run_indptr": run_indptr,
+        "run_start": (
+            run_pos - np.repeat(segment_start, np.diff(run_indptr))
+        ).astype(np.uint32),
+        "run_depth": depth[run_pos].astype(np.uint32),
+    }
+
+
+def write_coverage_tracks(fp, acc, attrs=None):
+    """Write the depth along every subject with alignments to a file."""
+    arrays = coverage_tracks(acc)
+    logging.info("Writing coverage tracks for {:,} proteins ({:,} runs) to {}".format(
+        arrays["length"].shape[0], arrays["run_start"].shape[0], fp
+    ))
+    return write_arrays(fp, arrays, attrs=attrs)
+
+
+class CoverageTracks(object):
+    """
+    Read the depth along each protein from write_coverage_tracks. The file
+    is memory-mapped, so only the runs for the proteins used are read.
+    """
+
+    def __init__(self, fp):
+        self.store = ArrayStore(fp)
+        self.attrs = self.store.attrs
+        self.proteins = [
+            p.decode("utf-8") if isinstance(p, bytes) else str(p)
+            for p in self.store["protein"]
+        ]
+        self.index = {p: ix for ix, p in enumerate(self.proteins)}
+
+    def __contains__(self, protein):
+        return protein in self.index
+
+    def __len__(self):
+        return len(self.proteins)
+
+    def length(self, protein):
+        """Return the length of a protein."""
+        return int(self.store["length"][self.index[protein]])
+
+    def runs(self, protein):
+        """Return the start position and depth of each run along a protein."""
+        ix = self.index[protein]
+        indptr = self.store["run_indptr"]
+        start, end = indptr[ix], indptr[ix + 1]
+        return self.store["run_start"][start:end], self.store["run_depth"][start:end]
+
+    def depth(self, protein, start=0, end=None):
+        """Return the depth at each position (0-based) from start to end."""
+        if end is None:
+            end = self.length(protein)
+        msg = "Positions must be within the protein ({}:{})".format(start, end)
+        assert 0 <= start <= end <= self.length(protein), msg
+
+        run_start, run_depth = self.runs(protein)
+        run_ix = np.searchsorted(
+            run_start, np.arange(start, end), side="right"
+        ) - 1
+        return np.asarray(run_depth[run_ix])
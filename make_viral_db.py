@@ -1,12 +1,36 @@
 #!/usr/bin/python
 """Make a database of viral genomes."""
 
-import gzip
+import os
+import sys
 import logging
 import argparse
-import pandas as pd
-from Bio import GenBank
+from multiprocessing.pool import ThreadPool
 from lib.exec_helpers import run_cmds
+from lib.db_helpers import build_database
+from lib.store_helpers import ArrayStore
+from lib.prefilter_helpers import ALPHABETS
+from lib.prefilter_helpers import SEED_SHAPE
+from lib.prefilter_helpers import build_prefilter
+
+# Protein records for viral genomes in RefSeq
+REFSEQ_GPFF = [
+    "ftp://ftp.ncbi.nlm.nih.gov/refseq/release/viral/viral.1.protein.gpff.gz",
+    "ftp://ftp.ncbi.nlm.nih.gov/refseq/release/viral/viral.2.protein.gpff.gz",
+]
+
+
+def download_files(urls):
+    """
+    Download a set of files at the same time, returning the local paths
+    (any earlier copies are overwritten).
+    """
+    fps = [url.split("/")[-1] for url in urls]
+    pool = ThreadPool(len(urls))
+    pool.map(lambda args: run_cmds(["wget", "-O", args[0], args[1]]), zip(fps, urls))
+    pool.close()
+    pool.join()
+    return fps
 
 
 if __name__ == "__main__":
@@ -17,6 +41,37 @@ if __name__ == "__main__":
     parser.add_argument("--prefix",
                         type=str,
                         help="""Prefix for output files.""")
+    parser.add_argument("--gpff",
+                        type=str,
+                        nargs="+",
+                        default=None,
+                        help="""Local GenBank protein files (.gpff or .gpff.gz)
+                                to use instead of downloading RefSeq.""")
+    parser.add_argument("--threads",
+                        type=int,
+                        default=4,
+                        help="""Number of processes used to parse the
+                                GenBank files.""")
+    parser.add_argument("--rebuild",
+                        action="store_true",
+                        help="""Rebuild the whole database, rather than
+                                updating the records which have changed.""")
+    parser.add_argument("--prefilter",
+                        action="store_true",
+                        help="""Also write the seeds in every protein to a
+                                filter (ending .prefilter), used to skip the
+                                reads which can't align (map_viruses.py
+                                --prefilter).""")
+    parser.add_argument("--prefilter-alphabet",
+                        type=str,
+                        choices=sorted(ALPHABETS.keys()),
+                        default="full",
+                        help="""Amino acid alphabet used for the seeds.""")
+    parser.add_argument("--prefilter-shape",
+                        type=str,
+                        default=SEED_SHAPE,
+                        help="""Positions of each seed which must match (1)
+                                or are ignored (0).""")
 
     args = parser.parse_args()
 
@@ -32,73 +87,42 @@ if __name__ == "__main__":
     consoleHandler.setFormatter(logFormatter)
     rootLogger.addHandler(consoleHandler)
 
-    dat = []
-
     # Download viral genomes from NCBI
-    for url in [
-        "ftp://ftp.ncbi.nlm.nih.gov/refseq/release/viral/viral.1.protein.gpff.gz",
-        "ftp://ftp.ncbi.nlm.nih.gov/refseq/release/viral/viral.2.protein.gpff.gz",
-    ]:
-        run_cmds([
-            "wget", url
-        ])
-        fp = url.split("/")[-1]
-        with gzip.open(fp, "rt") as handle:
-            for ix, record in enumerate(GenBank.parse(handle)):
-                taxid = None
-                product = None
-                locus_tag = None
-                coded_by = None
-                genome = None
-                genome_range = None
-
-                for feature in record.features:
-                    for qualifier in feature.qualifiers:
-                        if feature.key == "source":
-                            if qualifier.key == "/db_xref=":
-                                taxid = qualifier.value.strip('"')
-                                taxid = taxid.replace("taxon:", "")
-                        elif feature.key == "Protein":
-                            if qualifier.key == "/product=":
-                                product = qualifier.value.strip('"')
-                        elif feature.key == "CDS":
-                            if qualifier.key == "/locus_tag=":
-                                locus_tag = qualifier.value.strip('"')
-                            elif qualifier.key == "/coded_by=":
-                                coded_by = qualifier.value.strip('"')
-                                genome, genome_range = coded_by.split(":", 1)
-                                genome = genome.replace("complement(", "")
-                                genome = genome.replace("join(", "")
-                dat.append({
-                    "protein": record.locus,
-                    "sequence": record.sequence,
-                    "organism": record.organism,
-                    "taxonomy": '; '.join(record.taxonomy),
-                    "definition": record.definition,
-                    "taxid": taxid,
-                    "product": product,
-                    "locus_tag": locus_tag,
-                    "genome": genome,
-                    "region": genome_range,
-                    "length": len(record.sequence),
-                })
-                if ix > 0 and ix % 1e3 == 0:
-                    logging.info("Parsed {:,} sequence records".format(ix))
-
-    df = pd.DataFrame(dat)
-
-    # Make sure all of the protein names are unique
-    assert df.shape[0] == len(df["protein"].unique())
-
-    logging.info("Writing protein sequences to {}.fastp".format(args.prefix))
-    with open("{}.fastp".format(args.prefix), "wt") as handle:
-        for ix, r in df.iterrows():
-            handle.write(">{}\n{}\n".format(r["protein"], r["sequence"]))
-
-    del df["sequence"]
-
-    logging.info("Writing mappings to {}.tsv".format(args.prefix))
-    df.to_csv("{}.tsv".format(args.prefix), sep="\t", index=None)
+    if args.gpff is None:
+        gpff_fps = download_files(REFSEQ_GPFF)
+    else:
+        gpff_fps = args.gpff
+
+    # Write the sequences, metadata and metadata index (only parsing the
+    # records which have changed since the last build)
+    diff = build_database(
+        gpff_fps, args.prefix, threads=args.threads, rebuild=args.rebuild
+    )
+
+    # Write the seeds for the prefilter, if the sequences or seeds have changed
+    prefilter_fp = args.prefix + ".prefilter"
+    if args.prefilter and (
+        args.rebuild or diff["sequences_changed"] or
+        not os.path.exists(prefilter_fp) or
+        ArrayStore(prefilter_fp).attrs["shape"] != args.prefilter_shape or
+        ArrayStore(prefilter_fp).attrs["alphabet"] !=
+        ALPHABETS[args.prefilter_alphabet]
+    ):
+        build_prefilter(
+            "{}.fastp".format(args.prefix),
+            prefilter_fp,
+            alphabet=args.prefilter_alphabet,
+            shape=args.prefilter_shape,
+        )
+
+    # DIAMOND only needs to index the sequences again if they have changed
+    if not diff["sequences_changed"] and os.path.exists(args.prefix + ".dmnd"):
+        logging.info("Protein sequences are unchanged, not formatting the DIAMOND database")
+        sys.exit(0)
+
+    # Remove the old database first, so that it is never out of date
+    if os.path.exists(args.prefix + ".dmnd"):
+        os.unlink(args.prefix + ".dmnd")
 
     logging.info("Formatting the DIAMOND database")
     run_cmds([
@@ -2,23 +2,731 @@
 """Wrapper script to align FASTQ file(s) against a set of viral genomes."""
 
 import os
+import sys
+import json
+import math
 import uuid
 import time
 import shutil
 import logging
 import argparse
-import pandas as pd
+import traceback
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from lib.exec_helpers import align_reads
+from lib.exec_helpers import return_file
 from lib.exec_helpers import return_results
+from lib.exec_helpers import s3_object_info
 from lib.exec_helpers import return_alignments
 from lib.exec_helpers import exit_and_clean_up
 from lib.exec_helpers import get_reference_database
+from lib.exec_helpers import release_cached
+from lib.fastq_helpers import split_fastq
 from lib.fastq_helpers import get_reads_from_url
-from lib.fastq_helpers import count_fastq_reads
-from lib.aln_helpers import parse_alignment
+from lib.aln_helpers import make_accumulators
 from lib.aln_helpers import summarize_genomes
+from lib.aln_helpers import summarize_alignments
+from lib.aln_helpers import accumulate_alignments
+from lib.metadata_helpers import MetadataIndex
+from lib.metadata_helpers import load_metadata
+from lib.metadata_helpers import metadata_vocabulary
+from lib.resource_helpers import diamond_memory
+from lib.resource_helpers import plan_alignment
+from lib.resource_helpers import parse_workers
+from lib.partial_helpers import parse_shard
+from lib.partial_helpers import write_partial
+from lib.partial_helpers import merge_partials
+from lib.timing_helpers import StageTimer
+from lib.track_helpers import write_coverage_tracks
+from lib.checkpoint_helpers import Checkpoints
+from lib.checkpoint_helpers import local_file_settings
+from lib.prefilter_helpers import Prefilter
+from lib.prefilter_helpers import prefilter_fastq
+
+LOG_FORMAT = '%(asctime)s %(levelname)-8s [map_viruses.py] %(message)s'
+
+
+def make_temp_folder(parent_folder):
+    """Make a new temporary folder with a random name."""
+    temp_folder = os.path.join(parent_folder, str(uuid.uuid4())[:8])
+    assert os.path.exists(temp_folder) is False
+    os.mkdir(temp_folder)
+    return temp_folder
+
+
+def add_log_file(log_fp):
+    """Write all logging messages to a file, returning the handler."""
+    fileHandler = logging.FileHandler(log_fp)
+    fileHandler.setFormatter(logging.Formatter(LOG_FORMAT))
+    logging.getLogger().addHandler(fileHandler)
+    return fileHandler
+
+
+def start_logging(log_fp):
+    """Write all logging messages to a file and to STDOUT."""
+    rootLogger = logging.getLogger()
+    rootLogger.setLevel(logging.INFO)
+
+    # Write to file
+    add_log_file(log_fp)
+    # Also write to STDOUT
+    consoleHandler = logging.StreamHandler()
+    consoleHandler.setFormatter(logging.Formatter(LOG_FORMAT))
+    rootLogger.addHandler(consoleHandler)
+
+
+def sample_checkpoints(args, input_str, output_path, temp_folder,
+                       enabled=True):
+    """
+    The stages for a single sample, with the settings which affect the
+    output of each stage, recorded in the temporary folder.
+    """
+    stages = [
+        ("fetch_db", {
+            "ref_db": local_file_settings(args.ref_db),
+            "metadata": local_file_settings(args.metadata),
+            "prefilter": local_file_settings(args.prefilter),
+        }),
+        ("fetch_reads", {
+            "input": local_file_settings(input_str),
+            "shard": args.shard,
+            "prefilter_min_hits": args.prefilter_min_hits,
+            "query_gencode": args.query_gencode,
+            "align_chunks": args.align_chunks,
+        }),
+        ("align", {
+            "query_gencode": args.query_gencode,
+            "blocks": args.blocks,
+            "index_chunks": args.index_chunks,
+            "stream_alignments": args.stream_alignments,
+            "keep_alignments": args.keep_alignments,
+        }),
+        ("parse", {
+            "multimapping": args.multimapping,
+            "quantiles": args.quantiles,
+        }),
+        ("summarize", {}),
+        ("upload", {
+            "output_path": output_path,
+            "coverage_tracks": args.coverage_tracks,
+        }),
+    ]
+    # Shards are summarized once they are merged
+    if args.shard is not None:
+        stages = [s for s in stages if s[0] != "summarize"]
+    return Checkpoints(
+        temp_folder, stages, enabled=enabled,
+        hash_files=args.checkpoint_hashes
+    )
+
+
+def fetch_reads(input_str, args, temp_folder, timer, prefilter=None):
+    """
+    Get the reads for a sample (cleaning up the headers), keeping only a
+    single shard if --shard is given and the reads with seeds in the
+    prefilter (if any), and splitting them into the chunks which are
+    aligned at the same time. Returns the path to the cleaned reads, the
+    paths to each chunk and the number of reads and bases.
+    """
+    read_fp, read_stats = get_reads_from_url(
+        input_str, temp_folder, threads=args.threads, timer=timer
+    )
+
+    # The reads were counted when the headers were cleaned up
+    n_reads = read_stats["reads"]
+    logging.info("Reads in input file: {}".format(n_reads))
+
+    # Only align the reads in a single shard of the sample
+    if args.shard is not None:
+        shard, n_shards = parse_shard(args.shard)
+        with timer.stage("read_split"):
+            (shard_fp, n_reads), = split_fastq(
+                read_fp, n_shards, n_reads, chunks=[shard]
+            )
+        os.unlink(read_fp)
+        read_fp = shard_fp
+
+    # Drop the reads which share no seeds with the reference database
+    if prefilter is not None:
+        with timer.stage("prefilter"):
+            prefilter_fp = read_fp + ".prefiltered"
+            read_stats["prefilter"] = prefilter_fastq(
+                read_fp,
+                prefilter_fp,
+                prefilter,
+                min_hits=args.prefilter_min_hits,
+                threads=args.threads,
+            )
+            read_stats["prefilter"]["min_hits"] = args.prefilter_min_hits
+        os.unlink(read_fp)
+        read_fp = prefilter_fp
+        n_reads = read_stats["prefilter"]["kept"]
+
+    # Split the reads into chunks which are aligned at the same time
+    if args.align_chunks > 1:
+        with timer.stage("read_split"):
+            read_fps = [
+                fp for fp, n in split_fastq(read_fp, args.align_chunks, n_reads)
+            ]
+        os.unlink(read_fp)
+    else:
+        read_fps = [read_fp]
+
+    return read_fp, read_fps, read_stats
+
+
+def align_and_parse(read_fps, read_fp, db_fp, metadata, args,
+                    temp_folder, timer, checkpoints):
+    """
+    Align one or more chunks of reads (at the same time), and add all of
+    the alignments to a single set of accumulators. Returns the
+    accumulators and the path to the alignments. Alignments are skipped
+    if they were finished in a previous run.
+    """
+    acc, assigner = make_accumulators(
+        multimapping=args.multimapping,
+        vocabulary=metadata_vocabulary(metadata),
+        quantiles=args.quantiles,
+    )
+
+    if len(read_fps) == 1 and args.stream_alignments:
+        # Parse the alignments as they are made (timed together)
+        with timer.stage("alignment"):
+            stream = align_reads(
+                read_fps[0],           # FASTQ file path
+                db_fp,                 # Local path to DB
+                temp_folder,           # Folder for results
+                query_gencode=args.query_gencode,
+                threads=args.threads,
+                blocks=args.blocks,
+                stream=True,
+                keep_alignments=args.keep_alignments,
+                index_chunks=args.index_chunks,
+            )
+            try:
+                n_parsed = accumulate_alignments(stream, acc, assigner)
+
+                # Make sure that DIAMOND finished without error
+                align_fp = stream.close()
+            finally:
+                # Don't leave DIAMOND or pigz running if parsing failed
+                stream.kill()
+        checkpoints.complete(
+            "align",
+            {"align_fps": [align_fp]},
+            files=[align_fp] if args.keep_alignments else [],
+        )
+
+    elif len(read_fps) == 1:
+        # Run the alignment
+        if checkpoints.skip("align"):
+            align_fp, = checkpoints.values("align")["align_fps"]
+        else:
+            with timer.stage("alignment"):
+                align_fp = align_reads(
+                    read_fps[0],           # FASTQ file path
+                    db_fp,                 # Local path to DB
+                    temp_folder,           # Folder for results
+                    query_gencode=args.query_gencode,
+                    threads=args.threads,
+                    blocks=args.blocks,
+                    index_chunks=args.index_chunks,
+                )
+            checkpoints.complete(
+                "align", {"align_fps": [align_fp]}, files=[align_fp]
+            )
+
+        # Process the alignments, calculating genome coverage
+        with timer.stage("parsing"):
+            n_parsed = accumulate_alignments(
+                align_fp, acc, assigner, workers=parse_workers(args.threads)
+            )
+
+    else:
+        if checkpoints.skip("align"):
+            align_fps = checkpoints.values("align")["align_fps"]
+        else:
+            # Split the threads between the chunks
+            threads = max(1, args.threads // len(read_fps))
+            logging.info("Aligning {:,} chunks with {:,} threads each".format(
+                len(read_fps), threads
+            ))
+            with timer.stage("alignment"):
+                pool = ThreadPool(len(read_fps))
+                align_fps = pool.map(
+                    lambda fp: align_reads(
+                        fp,
+                        db_fp,
+                        temp_folder,
+                        query_gencode=args.query_gencode,
+                        threads=threads,
+                        blocks=args.blocks,
+                        index_chunks=args.index_chunks,
+                    ),
+                    read_fps
+                )
+                pool.close()
+                pool.join()
+            checkpoints.complete(
+                "align", {"align_fps": align_fps}, files=align_fps
+            )
+
+        # Process the alignments for each chunk in order
+        n_parsed = 0
+        workers = parse_workers(args.threads)
+        with timer.stage("parsing"):
+            for fp in align_fps:
+                n_parsed += accumulate_alignments(
+                    fp, acc, assigner, workers=workers
+                )
+
+        # Combine the alignments, if they are being returned
+        align_fp = "{}.sam".format(read_fp)
+        if args.keep_alignments:
+            with open(align_fp, "wb") as fo:
+                for fp in align_fps:
+                    with open(fp, "rb") as f:
+                        shutil.copyfileobj(f, fo)
+
+    logging.info("Parsed {:,} alignments".format(n_parsed))
+
+    return acc, assigner, align_fp, n_parsed
+
+
+def return_coverage_tracks(acc, input_str, output_path, temp_folder):
+    """Save the depth along each detected protein next to the results."""
+    track_fp = os.path.join(temp_folder, "temp.tracks")
+    write_coverage_tracks(track_fp, acc, attrs={"input": input_str})
+    return_file(track_fp, output_path.replace(".json.gz", ".tracks"))
+
+
+def summarize_sample(protein_abund, metadata):
+    """Add the metadata for each protein and summarize each genome."""
+
+    # Fetch only the metadata needed for the detected proteins
+    if isinstance(metadata, MetadataIndex):
+        metadata = metadata.detected_metadata(
+            [p["protein"] for p in protein_abund]
+        )
+
+    # From a set of alignments against proteins, summarize the genome
+    protein_abund, genome_dat = summarize_genomes(protein_abund, metadata)
+
+    return {
+        "proteins": protein_abund,
+        "genomes": genome_dat,
+    }
+
+
+def process_sample(input_str, output_path, db_fp, metadata, args,
+                   temp_folder, timer=None, checkpoints=None, prefilter=None):
+    """
+    Align a single sample, summarize the genomes and save the results,
+    recording the resources used by each stage with a StageTimer. Stages
+    which were finished in a previous run (recorded with Checkpoints in
+    the same temporary folder) are skipped. If a Prefilter is given, only
+    the reads with seeds in the reference database are aligned.
+    """
+
+    # Keep track of the time elapsed to process the sample
+    start_time = time.time()
+    if timer is None:
+        timer = StageTimer()
+    if checkpoints is None:
+        checkpoints = sample_checkpoints(
+            args, input_str, output_path, temp_folder, enabled=False
+        )
+
+    logging.info("Processing input argument: " + input_str)
+    if checkpoints.skip("upload"):
+        logging.info("Results were already written to " + output_path)
+        return
+
+    # Get the input reads
+    if checkpoints.skip("fetch_reads"):
+        values = checkpoints.values("fetch_reads")
+        read_fp, read_fps = values["read_fp"], values["read_fps"]
+        read_stats = values["read_stats"]
+    else:
+        read_fp, read_fps, read_stats = fetch_reads(
+            input_str, args, temp_folder, timer, prefilter=prefilter
+        )
+        checkpoints.complete("fetch_reads", {
+            "read_fp": read_fp,
+            "read_fps": read_fps,
+            "read_stats": read_stats,
+        }, files=read_fps)
+
+    # Restore the accumulators if the alignments were already parsed
+    if checkpoints.skip("parse"):
+        values = checkpoints.values("parse")
+        acc, assigner, attrs = merge_partials(
+            [values["partial_fp"]], vocabulary=metadata_vocabulary(metadata)
+        )
+        align_fp, n_parsed = values["align_fp"], values["n_parsed"]
+    else:
+        acc, assigner, align_fp, n_parsed = align_and_parse(
+            read_fps, read_fp, db_fp, metadata, args, temp_folder, timer,
+            checkpoints
+        )
+        if checkpoints.enabled:
+            partial_fp = os.path.join(temp_folder, "parsed.partial")
+            write_partial(partial_fp, acc, assigner, {
+                "input": input_str,
+                "shard": 0,
+                "n_shards": 1,
+                "multimapping": args.multimapping,
+                "quantiles": args.quantiles,
+                "ref_db_url": args.ref_db,
+                "total_reads": read_stats["reads"],
+                "total_bases": read_stats["bases"],
+                "nalignments": n_parsed,
+            })
+            checkpoints.complete("parse", {
+                "partial_fp": partial_fp,
+                "align_fp": align_fp,
+                "n_parsed": n_parsed,
+            }, files=[partial_fp] + ([align_fp] if args.keep_alignments else []))
+
+    # Summarize the genomes (shards are summarized once they are merged)
+    if args.shard is not None:
+        results = None
+    elif checkpoints.skip("summarize"):
+        with open(checkpoints.values("summarize")["results_fp"], "rt") as f:
+            results = json.load(f)
+    else:
+        with timer.stage("summarization"):
+            results = summarize_sample(
+                summarize_alignments(acc, assigner), metadata
+            )
+        if checkpoints.enabled:
+            results_fp = os.path.join(temp_folder, "results.json")
+            with open(results_fp, "wt") as fo:
+                json.dump(results, fo)
+            checkpoints.complete(
+                "summarize", {"results_fp": results_fp}, files=[results_fp]
+            )
+
+    # If --keep-alignments is given, return the alignment file
+    if args.keep_alignments:
+        if args.shard is not None:
+            sam_path = output_path[:-len(".partial")] + ".sam.gz"
+        else:
+            sam_path = output_path.replace(".json.gz", ".sam.gz")
+        # The alignments are kept until the upload stage is finished, in
+        # case the run is resumed
+        with timer.stage("upload"):
+            return_alignments(
+                align_fp, sam_path, threads=args.threads,
+                keep=checkpoints.enabled
+            )
+
+    # Read in the logs
+    logging.info("Reading in the logs")
+    logs = open(os.path.join(temp_folder, "log.txt"), 'rt').readlines()
+
+    # Save the alignments for this shard, to be merged with the others
+    if args.shard is not None:
+        shard, n_shards = parse_shard(args.shard)
+        partial_fp = os.path.join(temp_folder, "temp.partial")
+        with timer.stage("upload"):
+            write_partial(partial_fp, acc, assigner, {
+                "input": input_str,
+                "shard": shard,
+                "n_shards": n_shards,
+                "multimapping": args.multimapping,
+                "quantiles": args.quantiles,
+                "ref_db": db_fp,
+                "ref_db_url": args.ref_db,
+                "total_reads": read_stats["reads"],
+                "total_bases": read_stats["bases"],
+                "prefilter": read_stats.get("prefilter"),
+                "nalignments": n_parsed,
+                "logs": logs,
+                "time_elapsed": time.time() - start_time,
+                "timings": timer.to_dict(),
+            })
+            return_file(partial_fp, output_path)
+        checkpoints.complete("upload")
+        return
+
+    # If --coverage-tracks is given, return the depth along each protein
+    if args.coverage_tracks:
+        with timer.stage("upload"):
+            return_coverage_tracks(acc, input_str, output_path, temp_folder)
+
+    # Wrap up all of the results into a single JSON
+    # and write it to the output folder
+    output = {
+        "input": input_str,
+        "output_path": output_path,
+        "logs": logs,
+        "ref_db": db_fp,
+        "ref_db_url": args.ref_db,
+        "results": results,
+        "total_reads": read_stats["reads"],
+        "total_bases": read_stats["bases"],
+        "time_elapsed": time.time() - start_time,
+        "timings": timer.to_dict(),
+    }
+    if "prefilter" in read_stats:
+        output["prefilter"] = read_stats["prefilter"]
+    return_results(output, output_path, threads=args.threads)
+    checkpoints.complete("upload")
+
+
+def merge_shards(args):
+    """Combine the partial results from every shard of a sample."""
+
+    # Keep track of the time elapsed to merge the shards
+    start_time = time.time()
+    timer = StageTimer()
+
+    temp_folder = make_temp_folder(args.temp_folder)
+    start_logging(os.path.join(temp_folder, "log.txt"))
+
+    try:
+        with timer.stage("metadata_fetch"):
+            metadata_fp = get_reference_database(
+                args.metadata,
+                temp_folder,
+                cache_folder=args.cache_folder,
+                cache_size=int(args.cache_size * 1e9),
+            )
+        with timer.stage("metadata_load"):
+            metadata = load_metadata(metadata_fp)
+        # Shards may have the same file name in different folders, so each
+        # is saved locally by its position in the list
+        with timer.stage("partial_fetch"):
+            partial_fps = [
+                get_reference_database(
+                    fp, temp_folder, local_name="shard_{}.partial".format(ix)
+                )
+                for ix, fp in enumerate(args.partials)
+            ]
+
+        with timer.stage("merge"):
+            acc, assigner, attrs = merge_partials(
+                partial_fps, vocabulary=metadata_vocabulary(metadata)
+            )
+        with timer.stage("summarization"):
+            results = summarize_sample(
+                summarize_alignments(acc, assigner), metadata
+            )
+        # The metadata can now be removed from the cache by other runs
+        release_cached(metadata_fp)
+        if args.coverage_tracks:
+            with timer.stage("upload"):
+                return_coverage_tracks(
+                    acc, attrs[0]["input"], args.output_path, temp_folder
+                )
+
+        # Keep the logs from every shard, followed by the logs for the merge
+        logs = []
+        for a in attrs:
+            logs.extend(a["logs"])
+        logs.extend(open(os.path.join(temp_folder, "log.txt"), 'rt').readlines())
+
+        output = {
+            "input": attrs[0]["input"],
+            "output_path": args.output_path,
+            "logs": logs,
+            "ref_db": attrs[0]["ref_db"],
+            "ref_db_url": attrs[0]["ref_db_url"],
+            "results": results,
+            "total_reads": attrs[0]["total_reads"],
+            "total_bases": attrs[0]["total_bases"],
+            "time_elapsed": time.time() - start_time + sum(
+                a["time_elapsed"] for a in attrs
+            ),
+            "timings": timer.to_dict(),
+            "shard_timings": [a["timings"] for a in attrs],
+        }
+        # The reads kept by the prefilter in every shard
+        if attrs[0].get("prefilter") is not None:
+            output["prefilter"] = {
+                "reads": sum(a["prefilter"]["reads"] for a in attrs),
+                "kept": sum(a["prefilter"]["kept"] for a in attrs),
+                "min_hits": attrs[0]["prefilter"]["min_hits"],
+            }
+        return_results(output, args.output_path)
+    except:
+        exit_and_clean_up(temp_folder)
+
+    # Delete any files that were created for the merge
+    logging.info("Removing temporary folder: " + temp_folder)
+    shutil.rmtree(temp_folder)
+
+    # Stop logging
+    logging.info("Done")
+    logging.shutdown()
+
+
+def auto_or_number(value):
+    """Parse a number, or "auto"."""
+    if value == "auto":
+        return value
+    return float(value) if "." in value else int(value)
+
+
+def resolve_alignment_plan(args, db_size):
+    """
+    Pick any settings for DIAMOND which are "auto" from the memory and CPUs
+    available, and return the plan.
+    """
+    plan = plan_alignment(
+        db_size,
+        cpus=None if args.threads == "auto" else args.threads * args.batch_workers,
+        n_jobs=args.align_chunks * args.batch_workers,
+    )
+    if args.blocks == "auto":
+        args.blocks = plan["block_size"]
+        args.index_chunks = plan["index_chunks"]
+    if args.threads == "auto":
+        # Threads are divided between the chunks aligned at the same time
+        args.threads = plan["threads"] * args.align_chunks
+
+    # Describe the settings which will be used
+    plan.update({
+        "block_size": args.blocks,
+        "index_chunks": args.index_chunks,
+        "threads": args.threads,
+        "db_blocks": int(math.ceil(db_size / 1e9 / args.blocks)),
+        "expected_memory_gb": round(diamond_memory(
+            args.blocks,
+            4 if args.index_chunks is None else args.index_chunks
+        ), 2),
+    })
+    return plan
+
+
+def read_manifest(manifest_fp):
+    """Read a list of (input, output path) pairs from a manifest file."""
+    samples = []
+    with open(manifest_fp, "rt") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if len(line) == 0 or line.startswith("#"):
+                continue
+            fields = line.split("\t")
+            msg = "Manifest lines must have an input and output path ({})"
+            assert len(fields) == 2, msg.format(line)
+            samples.append((fields[0], fields[1]))
+    return samples
+
+
+def validate_sample(input_str, output_path, ending=".json.gz"):
+    """Check the input and output paths for a single sample."""
+    # Make sure that the output path ends with .json.gz (or .partial)
+    msg = "Output path must end with {} ({})".format(ending, output_path)
+    assert output_path.endswith(ending), msg
+
+    # Make sure that the input doesn't have any odd characters
+    for k in [",", "+", " "]:
+        assert k not in input_str
+
+
+# Shared by every sample processed in a batch (inherited by the workers)
+BATCH = {}
+
+
+def process_batch_sample(sample):
+    """Process one sample from a batch in its own temporary folder."""
+    input_str, output_path = sample
+    args = BATCH["args"]
+
+    # Start from the timings for the stages shared by every sample
+    timer = BATCH["timer"].copy()
+
+    temp_folder = make_temp_folder(args.temp_folder)
+    fileHandler = add_log_file(os.path.join(temp_folder, "log.txt"))
+    try:
+        process_sample(
+            input_str,
+            output_path,
+            BATCH["db_fp"],
+            BATCH["metadata"],
+            args,
+            temp_folder,
+            timer=timer,
+            prefilter=BATCH["prefilter"],
+        )
+        success = True
+    except:
+        logging.info("There was an unexpected failure processing " + input_str)
+        for line in traceback.format_exc().split("\n"):
+            logging.info(line)
+        success = False
+
+    # Delete any files that were created for this sample
+    keep = args.keep_temp_on_failure and not success
+    logging.info("{} temporary folder: {}".format(
+        "Keeping" if keep else "Removing", temp_folder
+    ))
+    logging.getLogger().removeHandler(fileHandler)
+    fileHandler.close()
+    if not keep:
+        shutil.rmtree(temp_folder)
+
+    return input_str, success
+
+
+def merge_main(argv):
+    """Parse the arguments for the merge subcommand."""
+    parser = argparse.ArgumentParser(
+        prog="map_viruses.py merge",
+        description="""
+    Combine the partial results from every shard of a sample (from
+    --shard i/N) into the final results.
+    """)
+
+    parser.add_argument("partials",
+                        type=str,
+                        nargs="+",
+                        help="""Partial results for every shard of the sample.
+                                (Supported: s3://, or local path).""")
+    parser.add_argument("--metadata",
+                        type=str,
+                        required=True,
+                        help="""TSV with metadata linking proteins and genomes,
+                                or the metadata index (ending .idx).""")
+    parser.add_argument("--output-path",
+                        type=str,
+                        required=True,
+                        help="""Folder to place results [ending  with .json.gz].
+                                (Supported: s3://, or local path).""")
+    parser.add_argument("--temp-folder",
+                        type=str,
+                        default='/share',
+                        help="Folder used for temporary files.")
+    parser.add_argument("--cache-folder",
+                        type=str,
+                        default=None,
+                        help="""Folder used to cache reference files from S3,
+                                shared by all jobs on the same host.""")
+    parser.add_argument("--cache-size",
+                        type=float,
+                        default=100,
+                        help="""Maximum size of the cache (in GB). The least
+                                recently used files are removed first.""")
+    parser.add_argument("--coverage-tracks",
+                        action="store_true",
+                        help="""Save the depth along each detected protein
+                                (ending .tracks, next to the results).""")
+
+    args = parser.parse_args(argv)
+    msg = "Output path must end with .json.gz"
+    assert args.output_path.endswith(".json.gz"), msg
+
+    merge_shards(args)
+
 
 if __name__ == "__main__":
+    # Combine the partial results from each shard of a sample
+    if len(sys.argv) > 1 and sys.argv[1] == "merge":
+        merge_main(sys.argv[2:])
+        sys.exit(0)
+
     parser = argparse.ArgumentParser(description="""
     Align a set of reads against a reference database with DIAMOND,
     calculate per-genome coverage metrics, and save the results.
@@ -26,7 +734,6 @@ if __name__ == "__main__":
 
     parser.add_argument("--input",
                         type=str,
-                        required=True,
                         help="""Location for input file(s). Comma-separated.
                                 (Supported: sra://, s3://, or ftp://).""")
     parser.add_argument("--ref-db",
@@ -37,168 +744,322 @@ if __name__ == "__main__":
     parser.add_argument("--metadata",
                         type=str,
                         required=True,
-                        help="TSV with metadata linking proteins and genomes.")
+                        help="""TSV with metadata linking proteins and genomes,
+                                or the metadata index (ending .idx).""")
     parser.add_argument("--output-path",
                         type=str,
-                        required=True,
                         help="""Folder to place results [ending  with .json.gz].
                                 (Supported: s3://, or local path).""")
+    parser.add_argument("--manifest",
+                        type=str,
+                        help="""Process a batch of samples, listed in a file with
+                                the input and output path for each sample
+                                (tab-separated, one sample per line), in
+                                place of --input and --output-path.""")
+    parser.add_argument("--batch-workers",
+                        type=int,
+                        default=1,
+                        help="""Number of samples from a batch to process
+                                at the same time.""")
     parser.add_argument("--overwrite",
                         action="store_true",
                         help="""Overwrite output files. Off by default.""")
     parser.add_argument("--blocks",
-                        type=int,
+                        type=auto_or_number,
                         default=5,
                         help="""Number of blocks used when aligning.
-                              Value relates to the amount of memory used.""")
+                              Value relates to the amount of memory used.
+                              Use "auto" to pick the block size and index
+                              chunks from the memory available and the size
+                              of the reference database.""")
+    parser.add_argument("--index-chunks",
+                        type=int,
+                        default=None,
+                        help="""Number of chunks used for the seed index when
+                                aligning (fewer chunks use more memory).""")
     parser.add_argument("--query-gencode",
                         type=int,
                         default=11,
                         help="Genetic code used to translate nucleotides.")
-    parser.add_argument("--threads",
+    parser.add_argument("--prefilter",
+                        type=str,
+                        default=None,
+                        help="""Seeds in the reference database (ending
+                                .prefilter, from make_viral_db.py --prefilter).
+                                Reads which share fewer than
+                                --prefilter-min-hits seeds with the database
+                                are not aligned.
+                                (Supported: s3://, ftp://, or local path).""")
+    parser.add_argument("--prefilter-min-hits",
                         type=int,
+                        default=1,
+                        help="""Number of seeds a read must share with the
+                                reference database to be aligned.""")
+    parser.add_argument("--threads",
+                        type=auto_or_number,
                         default=16,
-                        help="Number of threads to use aligning.")
+                        help="""Number of threads to use aligning, and
+                                processes to use parsing the alignments.
+                                Use "auto" to match the CPUs available.""")
+    parser.add_argument("--multimapping",
+                        type=str,
+                        choices=["all", "best", "em"],
+                        default="all",
+                        help="""How to count reads aligning to more than one
+                                protein: count every alignment (all), split
+                                evenly across the top-scoring alignments (best),
+                                or assign fractionally by expectation-maximization
+                                (em).""")
+    parser.add_argument("--shard",
+                        type=str,
+                        default=None,
+                        help="""Only align shard i of N (e.g. 0/4) of the reads,
+                                and write the partial results (ending .partial)
+                                to be combined with `map_viruses.py merge`.""")
+    parser.add_argument("--align-chunks",
+                        type=int,
+                        default=1,
+                        help="""Split the reads into chunks which are aligned
+                                at the same time, splitting the threads between
+                                them.""")
+    parser.add_argument("--quantiles",
+                        action="store_true",
+                        help="""Report the approximate median pctid, alen and
+                                bitscore for each protein.""")
     parser.add_argument("--keep-alignments",
                         action="store_true",
                         help="Return the raw alignment files.")
+    parser.add_argument("--coverage-tracks",
+                        action="store_true",
+                        help="""Save the depth along each detected protein
+                                (ending .tracks, next to the results).""")
+    parser.add_argument("--stream-alignments",
+                        action="store_true",
+                        help="""Parse alignments as DIAMOND writes them,
+                                without saving an uncompressed copy.""")
     parser.add_argument("--temp-folder",
                         type=str,
                         default='/share',
                         help="Folder used for temporary files.")
+    parser.add_argument("--work-dir",
+                        type=str,
+                        default=None,
+                        help="""Folder used for the temporary files of a single
+                                sample, in place of a new folder in
+                                --temp-folder. Each stage is recorded there as
+                                it is finished, and a run with the same
+                                --work-dir resumes after the last stage
+                                finished. Kept if the run fails.""")
+    parser.add_argument("--keep-temp-on-failure",
+                        action="store_true",
+                        help="""Keep the temporary folder if the run fails,
+                                so that it can be resumed with --work-dir.""")
+    parser.add_argument("--checkpoint-hashes",
+                        action="store_true",
+                        help="""Check the files kept for each stage by their
+                                content hash, rather than their size and
+                                modification time, before resuming.""")
+    parser.add_argument("--cache-folder",
+                        type=str,
+                        default=None,
+                        help="""Folder used to cache reference files from S3,
+                                shared by all jobs on the same host.""")
+    parser.add_argument("--cache-size",
+                        type=float,
+                        default=100,
+                        help="""Maximum size of the cache (in GB). The least
+                                recently used files are removed first.""")
+    parser.add_argument("--dry-run",
+                        action="store_true",
+                        help="""Print the plan for the alignment (block size,
+                                index chunks and threads) without aligning.""")
 
     args = parser.parse_args()
 
-    # Make sure that the output path ends with .json.gz
-    assert args.output_path.endswith(".json.gz")
-
-    # Make sure that the input doesn't have any odd characters
-    for k in [",", "+", " "]:
-        assert k not in args.input
-
-    # Make a temporary folder for all files to be placed in
-    temp_folder = os.path.join(args.temp_folder, str(uuid.uuid4())[:8])
-    assert os.path.exists(temp_folder) is False
-    os.mkdir(temp_folder)
-
-    # Set up logging
-    log_fp = os.path.join(temp_folder, "log.txt")
-    logFormatter = logging.Formatter(
-        '%(asctime)s %(levelname)-8s [map_viruses.py] %(message)s'
-    )
-    rootLogger = logging.getLogger()
-    rootLogger.setLevel(logging.INFO)
+    if args.manifest is None:
+        msg = "Must provide --input and --output-path, or --manifest"
+        assert args.input is not None and args.output_path is not None, msg
+        samples = [(args.input, args.output_path)]
+    else:
+        msg = "Cannot provide --input or --output-path with --manifest"
+        assert args.input is None and args.output_path is None, msg
+        samples = read_manifest(args.manifest)
 
-    # Write to file
-    fileHandler = logging.FileHandler(log_fp)
-    fileHandler.setFormatter(logFormatter)
-    rootLogger.addHandler(fileHandler)
-    # Also write to STDOUT
-    consoleHandler = logging.StreamHandler()
-    consoleHandler.setFormatter(logFormatter)
-    rootLogger.addHandler(consoleHandler)
+    if args.shard is not None:
+        msg = "Cannot provide --shard with --manifest"
+        assert args.manifest is None, msg
+        parse_shard(args.shard)
+        msg = "With --shard, use --coverage-tracks when merging the shards"
+        assert args.coverage_tracks is False, msg
+    if args.work_dir is not None:
+        msg = "Cannot provide --work-dir with --manifest"
+        assert args.manifest is None, msg
+    if args.align_chunks > 1:
+        msg = "Cannot stream alignments with --align-chunks"
+        assert args.stream_alignments is False, msg
 
-    # Get the reference database files
-    try:
-        db_fp = get_reference_database(
-            args.ref_db,
-            temp_folder,
-            ending=".dmnd"
+    for input_str, output_path in samples:
+        validate_sample(
+            input_str,
+            output_path,
+            ending=".json.gz" if args.shard is None else ".partial"
         )
-    except:
-        exit_and_clean_up(temp_folder)
-
-    logging.info("Reference database: " + db_fp)
 
-    try:
-        metadata_fp = get_reference_database(
-            args.metadata,
-            temp_folder
-        )
-    except:
-        exit_and_clean_up(temp_folder)
+    # Print the plan for the alignment, without fetching or aligning anything
+    if args.dry_run:
+        if args.ref_db.startswith("s3://"):
+            db_size = s3_object_info(args.ref_db)[1]
+        else:
+            db_size = os.path.getsize(args.ref_db)
+        print(json.dumps(
+            resolve_alignment_plan(args, db_size), indent=4, sort_keys=True
+        ))
+        sys.exit(0)
 
-    logging.info("Metadata file: " + metadata_fp)
+    # Make a temporary folder for all files to be placed in (or reuse the
+    # work directory from a previous run)
+    if args.work_dir is not None:
+        temp_folder = args.work_dir
+        if not os.path.exists(temp_folder):
+            os.makedirs(temp_folder)
+    else:
+        temp_folder = make_temp_folder(args.temp_folder)
+    keep_temp = args.keep_temp_on_failure or args.work_dir is not None
 
-    try:
-        metadata = pd.read_table(metadata_fp, sep='\t')
-    except:
-        exit_and_clean_up(temp_folder)
+    # Set up logging
+    start_logging(os.path.join(temp_folder, "log.txt"))
 
-    logging.info("Read in metadata file")
+    # Record the resources used by each stage
+    timer = StageTimer()
 
-    # Align each of the inputs and calculate the overall abundance
+    # Record each stage as it is finished, so that a failed run can be resumed
+    if args.manifest is None:
+        checkpoints = sample_checkpoints(
+            args, args.input, args.output_path, temp_folder, enabled=keep_temp
+        )
+    else:
+        checkpoints = Checkpoints(
+            temp_folder, [("fetch_db", {})], enabled=False
+        )
 
-    # Keep track of the time elapsed to process the sample
-    start_time = time.time()
+    # Get the reference database files
+    if checkpoints.skip("fetch_db"):
+        values = checkpoints.values("fetch_db")
+        db_fp, metadata_fp = values["db_fp"], values["metadata_fp"]
+        prefilter_fp = values["prefilter_fp"]
+    else:
+        try:
+            with timer.stage("db_fetch"):
+                db_fp = get_reference_database(
+                    args.ref_db,
+                    temp_folder,
+                    ending=".dmnd",
+                    cache_folder=args.cache_folder,
+                    cache_size=int(args.cache_size * 1e9),
+                )
+            with timer.stage("metadata_fetch"):
+                metadata_fp = get_reference_database(
+                    args.metadata,
+                    temp_folder,
+                    cache_folder=args.cache_folder,
+                    cache_size=int(args.cache_size * 1e9),
+                )
+            if args.prefilter is not None:
+                with timer.stage("prefilter_fetch"):
+                    prefilter_fp = get_reference_database(
+                        args.prefilter,
+                        temp_folder,
+                        ending=".prefilter",
+                        cache_folder=args.cache_folder,
+                        cache_size=int(args.cache_size * 1e9),
+                    )
+            else:
+                prefilter_fp = None
+            # Only files downloaded into the temporary folder are checked
+            checkpoints.complete("fetch_db", {
+                "db_fp": db_fp,
+                "metadata_fp": metadata_fp,
+                "prefilter_fp": prefilter_fp,
+            }, files=[
+                fp for fp in [db_fp, metadata_fp, prefilter_fp]
+                if fp is not None and
+                os.path.dirname(os.path.abspath(fp)) ==
+                os.path.abspath(temp_folder)
+            ])
+        except:
+            exit_and_clean_up(temp_folder, keep=keep_temp)
 
-    logging.info("Processing input argument: " + args.input)
+    logging.info("Reference database: " + db_fp)
+    logging.info("Metadata file: " + metadata_fp)
 
-    # Capture each command in a try statement
-    # Get the input reads
-    try:
-        read_fp = get_reads_from_url(args.input, temp_folder)
-    except:
-        exit_and_clean_up(temp_folder)
+    # Size the alignment to the memory and CPUs available
+    if args.blocks == "auto" or args.threads == "auto":
+        resolve_alignment_plan(args, os.path.getsize(db_fp))
 
-    # Run the alignment
     try:
-        align_fp = align_reads(
-            read_fp,               # FASTQ file path
-            db_fp,                 # Local path to DB
-            temp_folder,           # Folder for results
-            query_gencode=args.query_gencode,
-            threads=args.threads,
-            blocks=args.blocks,
-        )
+        with timer.stage("metadata_load"):
+            metadata = load_metadata(metadata_fp)
+        if prefilter_fp is not None:
+            logging.info("Prefilter: " + prefilter_fp)
+            with timer.stage("prefilter_load"):
+                prefilter = Prefilter(prefilter_fp, gencode=args.query_gencode)
+        else:
+            prefilter = None
     except:
-        exit_and_clean_up(temp_folder)
+        exit_and_clean_up(temp_folder, keep=keep_temp)
 
-    # Process the alignments, calculating genome coverage
-    try:
-        protein_abund = parse_alignment(align_fp)
-    except:
-        exit_and_clean_up(temp_folder)
+    logging.info("Read in metadata file")
 
-    # From a set of alignments against proteins, summarize the genome
-    protein_abund, genome_dat = summarize_genomes(protein_abund, metadata)
+    if args.manifest is None:
+        # Process a single sample in the same temporary folder
+        try:
+            process_sample(
+                args.input, args.output_path, db_fp, metadata, args,
+                temp_folder, timer=timer, checkpoints=checkpoints,
+                prefilter=prefilter
+            )
+        except:
+            exit_and_clean_up(temp_folder, keep=keep_temp)
+        failed = []
 
-    # Count the total number of reads
-    logging.info("Counting the total number of reads")
-    n_reads = count_fastq_reads(read_fp)
-    logging.info("Reads in input file: {}".format(n_reads))
+    else:
+        # Process each sample in the batch with the same database
+        logging.info("Processing {:,} samples from {}".format(
+            len(samples), args.manifest
+        ))
+        BATCH["args"] = args
+        BATCH["db_fp"] = db_fp
+        BATCH["metadata"] = metadata
+        BATCH["prefilter"] = prefilter
+        BATCH["timer"] = timer
 
-    # If --keep-alignments is given, return the alignment file
-    if args.keep_alignments:
-        return_alignments(align_fp, args.output_path.replace(".json.gz", ".sam.gz"))
+        if args.batch_workers > 1:
+            pool = Pool(args.batch_workers)
+            results = pool.map(process_batch_sample, samples, chunksize=1)
+            pool.close()
+            pool.join()
+        else:
+            results = [process_batch_sample(sample) for sample in samples]
 
-    # Read in the logs
-    logging.info("Reading in the logs")
-    logs = open(log_fp, 'rt').readlines()
+        failed = [input_str for input_str, success in results if not success]
+        logging.info("Processed {:,} samples, {:,} failed".format(
+            len(results), len(failed)
+        ))
+        for input_str in failed:
+            logging.info("Failed: " + input_str)
 
-    # Wrap up all of the results into a single JSON
-    # and write it to the output folder
-    output = {
-        "input": args.input,
-        "output_path": args.output_path,
-        "logs": logs,
-        "ref_db": db_fp,
-        "ref_db_url": args.ref_db,
-        "results": {
-            "proteins": protein_abund,
-            "genomes": genome_dat,
-        },
-        "total_reads": n_reads,
-        "time_elapsed": time.time() - start_time
-    }
-    return_results(
-        output, args.output_path, temp_folder
-    )
+    # The reference files can now be removed from the cache by other runs
+    for fp in [db_fp, metadata_fp, prefilter_fp]:
+        if fp is not None:
+            release_cached(fp)
 
-    # Delete any files that were created for this sample
+    # Delete any files that were created for this run
     logging.info("Removing temporary folder: " + temp_folder)
     shutil.rmtree(temp_folder)
 
     # Stop logging
     logging.info("Done")
     logging.shutdown()
+
+    if len(failed) > 0:
+        sys.exit(1)
@@ -1,8 +1,8 @@
 #!/usr/bin/env bats
 
-@test "SRA Toolkit v2.8.2" {
+@test "SRA Toolkit v2.9.6" {
   v="$(fastq-dump --version)"
-  [[ "$v" =~ "2.8.2" ]]
+  [[ "$v" =~ "2.9.6" ]]
 }
 
 
@@ -34,12 +34,126 @@
   [[ "$h" =~ "Success" ]]
 }
 
+@test "Coverage accumulator" {
+  h="$(python /usr/map_viruses/lib/test_coverage_accumulator.py)"
+
+  [[ "$h" =~ "Success" ]]
+}
+
+@test "Alignment stream" {
+  h="$(PYTHONPATH=/usr/map_viruses python /usr/map_viruses/lib/test_alignment_stream.py)"
+
+  [[ "$h" =~ "Success" ]]
+}
+
+@test "Running moments" {
+  h="$(python /usr/map_viruses/lib/test_running_moments.py)"
+
+  [[ "$h" =~ "Success" ]]
+}
+
+@test "Sharded parsing" {
+  h="$(python /usr/map_viruses/lib/test_sharded_parsing.py)"
+
+  [[ "$h" =~ "Success" ]]
+}
+
+@test "Multi-mapping reads" {
+  h="$(python /usr/map_viruses/lib/test_multimapping.py)"
+
+  [[ "$h" =~ "Success" ]]
+}
+
 @test "Genome summary" {
   h="$(python /usr/map_viruses/lib/test_genome_summary.py)"
 
   [[ "$h" =~ "Success" ]]
 }
 
+@test "Stage timer" {
+  h="$(python /usr/map_viruses/lib/test_stage_timer.py)"
+
+  [[ "$h" =~ "Success" ]]
+}
+
+@test "Alignment plan" {
+  h="$(python /usr/map_viruses/lib/test_alignment_plan.py)"
+
+  [[ "$h" =~ "Success" ]]
+}
+
+@test "Partial results" {
+  h="$(PYTHONPATH=/usr/map_viruses python /usr/map_viruses/lib/test_partial_results.py)"
+
+  [[ "$h" =~ "Success" ]]
+}
+
+@test "Coverage tracks" {
+  h="$(PYTHONPATH=/usr/map_viruses python /usr/map_viruses/lib/test_coverage_tracks.py)"
+
+  [[ "$h" =~ "Success" ]]
+}
+
+@test "Metadata index" {
+  h="$(PYTHONPATH=/usr/map_viruses python /usr/map_viruses/lib/test_metadata_index.py)"
+
+  [[ "$h" =~ "Success" ]]
+}
+
+@test "Reference cache" {
+  h="$(PYTHONPATH=/usr/map_viruses python /usr/map_viruses/lib/test_reference_cache.py)"
+
+  [[ "$h" =~ "Success" ]]
+}
+
+@test "FASTQ cleanup" {
+  h="$(PYTHONPATH=/usr/map_viruses python /usr/map_viruses/lib/test_fastq_cleanup.py)"
+
+  [[ "$h" =~ "Success" ]]
+}
+
+@test "Output stream" {
+  h="$(PYTHONPATH=/usr/map_viruses python /usr/map_viruses/lib/test_output_stream.py)"
+
+  [[ "$h" =~ "Success" ]]
+}
+
+@test "Remote stream" {
+  h="$(PYTHONPATH=/usr/map_viruses python /usr/map_viruses/lib/test_remote_stream.py)"
+
+  [[ "$h" =~ "Success" ]]
+}
+
+@test "Viral database" {
+  h="$(PYTHONPATH=/usr/map_viruses python /usr/map_viruses/lib/test_viral_db.py)"
+
+  [[ "$h" =~ "Success" ]]
+}
+
+@test "IMG/VR index" {
+  h="$(PYTHONPATH=/usr/map_viruses python /usr/map_viruses/lib/test_img_vr_index.py)"
+
+  [[ "$h" =~ "Success" ]]
+}
+
+@test "Checkpoints" {
+  h="$(PYTHONPATH=/usr/map_viruses python /usr/map_viruses/lib/test_checkpoints.py)"
+
+  [[ "$h" =~ "Success" ]]
+}
+
+@test "Prefilter" {
+  h="$(PYTHONPATH=/usr/map_viruses python /usr/map_viruses/lib/test_prefilter.py)"
+
+  [[ "$h" =~ "Success" ]]
+}
+
+@test "SRA fetch" {
+  h="$(PYTHONPATH=/usr/map_viruses python /usr/map_viruses/lib/test_sra_fetch.py)"
+
+  [[ "$h" =~ "Success" ]]
+}
+
 @test "Integration" {
   h="$(python /usr/map_viruses/tests/integration.py)"
 